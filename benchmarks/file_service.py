@@ -0,0 +1,62 @@
+"""
+    Micro-benchmark of the per-operation cost of the FileService, comparing the descriptor relative containment checks
+    (openat2 with RESOLVE_BENEATH) against the realpath based checks it falls back to.
+
+    Run from the repository root with 'python -m benchmarks.file_service'.  The benchmark builds a small session-like
+    tree in a temporary directory and times the operations performed on every API request and every upload, once with
+    a FileService which checks paths with realpath and once with one which uses openat2.  On a kernel or in a container
+    without openat2 the second also falls back to realpath, and the two columns measure the same thing.
+"""
+
+import os
+import timeit
+import tempfile
+
+from latex.services.file_service import FileService
+
+ITERATIONS = 20000
+
+
+def build_tree(root: str):
+    os.makedirs(os.path.join(root, "session", "source", "images"))
+    os.makedirs(os.path.join(root, "session", "templates"))
+    with open(os.path.join(root, "session", "source", "images", "figure.png"), "wb") as handle:
+        handle.write(b"x" * 4096)
+
+
+def operations(service: FileService):
+    figure = os.path.join("session", "source", "images", "figure.png")
+
+    def read_file():
+        with service.open(figure, "rb") as handle:
+            handle.read()
+
+    def write_file():
+        with service.open(os.path.join("session", "source", "upload.tex"), "wb") as handle:
+            handle.write(b"x" * 1024)
+
+    def exists():
+        service.exists(figure)
+
+    def create_from():
+        service.create_from("session").create_from("source")
+
+    return {"open+read": read_file, "open+write": write_file, "exists": exists, "create_from x2": create_from}
+
+
+def main():
+    with tempfile.TemporaryDirectory() as temp_path:
+        build_tree(temp_path)
+        modes = {"realpath": FileService(temp_path, resolve_beneath=False), "openat2": FileService(temp_path)}
+
+        print(f"{'operation':<16}" + "".join(f"{mode:>14}" for mode in modes) + "   (microseconds per operation)")
+        for name in operations(modes["realpath"]):
+            timings = []
+            for service in modes.values():
+                seconds = timeit.timeit(operations(service)[name], number=ITERATIONS)
+                timings.append(seconds / ITERATIONS * 1e6)
+            print(f"{name:<16}" + "".join(f"{t:>14.2f}" for t in timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -16,7 +16,6 @@
 
 import os
 import json
-import time
 from urllib.parse import urljoin, urlparse
 import requests
 from pprint import pprint
@@ -106,12 +105,12 @@ def render_sample_tex():
     assert finalize_response.status_code == 202
 
     # At some point a worker should pick up the task and complete the compilation, at which point
-    # we can retrieve the product from the provided url.  Here we simply wait until the status changes
-    # to either 'success' or 'error'
-    session_resource = requests.get(my_session_url).json()
+    # we can retrieve the product from the provided url.  Here we wait until the status changes to
+    # either 'success' or 'error'.  The 'wait' parameter asks the server to hold each request until the
+    # compilation finishes (or up to 30 seconds), so the response comes as soon as the status changes.
+    session_resource = requests.get(my_session_url, params={"wait": 30}).json()
     while session_resource['status'] not in ['success', 'error']:
-        time.sleep(2.0)
-        session_resource = requests.get(my_session_url).json()
+        session_resource = requests.get(my_session_url, params={"wait": 30}).json()
 
     # If successful, the url for retrieving the product is /api/sessions/<session_id>/product, which
     # you can build yourself, or follow the link provided under the 'product' key in the session
@@ -202,12 +201,12 @@ def render_with_template():
     assert finalize_response.status_code == 202
 
     # At some point a worker should pick up the task and complete the compilation, at which point
-    # we can retrieve the product from the provided url.  Here we simply wait until the status changes
-    # to either 'success' or 'error'
-    session_resource = requests.get(my_session_url).json()
+    # we can retrieve the product from the provided url.  Here we wait until the status changes to
+    # either 'success' or 'error'.  The 'wait' parameter asks the server to hold each request until the
+    # compilation finishes (or up to 30 seconds), so the response comes as soon as the status changes.
+    session_resource = requests.get(my_session_url, params={"wait": 30}).json()
     while session_resource['status'] not in ['success', 'error']:
-        time.sleep(2.0)
-        session_resource = requests.get(my_session_url).json()
+        session_resource = requests.get(my_session_url, params={"wait": 30}).json()
 
     # If successful, the url for retrieving the product is /api/sessions/<session_id>/product, which
     # you can build yourself, or follow the link provided under the 'product' key in the session
@@ -228,6 +227,41 @@ def render_with_template():
         print(log_response.content)
 
 
+def render_in_one_request():
+    """
+    This example compiles the same document as render_sample_tex, but with a single request to the
+    /api/compile endpoint, which creates the session, adds the files, finalizes it and waits for the
+    compiler. This saves the round trips of the step by step process, which for small documents take
+    longer than the compilation itself.
+
+    The files are sent as multipart form data named by their paths, the same way as to the session files
+    endpoint, with the session options as json in a form field named 'session'.  If the document compiles
+    before the server's wait limit, the product comes back directly.  Otherwise the response is the session
+    resource with a 202 code, and its url in the Location header can be polled as in render_sample_tex.
+    """
+    compile_url = urljoin(SERVICE_URL, "api/compile")
+    session_data = {"compiler": "xelatex", "target": "sample1.tex"}
+
+    with open(os.path.join(TEST_FILE_DIRECTORY, "sample1.tex"), "rb") as tex_handle, \
+            open(os.path.join(TEST_FILE_DIRECTORY, "cat.jpg"), "rb") as image_handle:
+        files = {"sample1.tex": tex_handle, "cat.jpg": image_handle}
+        response = requests.post(compile_url, data={"session": json.dumps(session_data)}, files=files)
+
+    if response.status_code == 200:
+        with open('sample3-example.pdf', 'wb') as file_handle:
+            file_handle.write(response.content)
+
+    # A 422 code means the compilation failed, and the response is the session resource with a link to the log
+    elif response.status_code == 422:
+        log_response = requests.get(_patch_url(response.json()['log']['href']))
+        print(log_response.content)
+
+    # A 202 code means the compiler is still running, so the session is polled as in the examples above
+    elif response.status_code == 202:
+        print(f"Still compiling, check the session at {response.headers['Location']}")
+
+
 if __name__ == '__main__':
     render_sample_tex()
     render_with_template()
+    render_in_one_request()
@@ -9,6 +9,7 @@ from celery import Celery
 from latex.config import ConfigBase, ProductionConfig
 from latex.session import SessionManager, clear_expired_sessions
 from latex.services.time_service import TimeService
+from latex.services.downloads import validate_sendfile_mode
 
 import logging
 from logging.config import dictConfig
@@ -49,6 +50,9 @@ def create_app(config_data: ConfigBase = None) -> Flask:
     else:
         app.config.from_object(config_data)
     instance_id = app.config['INSTANCE_KEY']
+
+    # A mistyped download mode would otherwise only show up as an error on the first download
+    validate_sendfile_mode(app.config["SENDFILE_MODE"])
     logging.info(f"Creating new app with instance_id={instance_id}")
 
     # Configure the internal services
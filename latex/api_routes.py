@@ -1,14 +1,31 @@
+
+import io
+import os
 import json
-from hashlib import md5
+import base64
+import hashlib
+import binascii
+from typing import Dict, List, Tuple
 
 from flask import current_app as app
-from flask import jsonify, url_for, redirect, request, Response, send_file
-from werkzeug.exceptions import BadRequest, NotFound
+from flask import jsonify, url_for, redirect, request, Response
+from werkzeug.exceptions import BadRequest, NotFound, Gone
 
-from latex import session_manager
+from latex import session_manager, redis_client, celery
 from latex.services.time_service import TimeService
 from latex.tasks import background_run_compile
-from latex.session import validate_conversion_data
+from latex.rendering import precompile_template
+from latex.session import Session, validate_conversion_data, validate_flag, validate_limits, validate_callback, \
+    validate_rows, validate_batch_output, FINALIZED_TEXT, SUCCESS_TEXT, ERROR_TEXT
+from latex.services.result_cache import read_counters, stats_key
+from latex.services.template_cache import read_template_stats, template_stats_key
+from latex.services.template_library import TemplateLibrary, validate_template_name
+from latex.services.archive import read_archive
+from latex.services.downloads import send_download
+from latex.resources import session_resource, session_document
+
+# How often a comment is written to an idle event stream, to keep proxies from closing it
+_EVENT_HEARTBEAT_SEC = 15.0
 
 
 @app.route("/api", methods=["GET"])
@@ -21,9 +38,51 @@ def api_home():
             "value": [
                 {"name": "compiler", "required": True, "label": "compiler, use 'xelatex', 'pdflatex', or 'lualatex'"},
                 {"name": "convert", "required": False, "label": "convert to image, can be none, or {'format': 'jpeg', "
-                                                                "'dpi': 300} where format is 'jpeg', 'tiff', or 'png'"},
+                                                                "'dpi': 300} where format is 'jpeg', 'tiff', or 'png' "
+                                                                "and an optional 'pages' is 'all' or [first, last], "
+                                                                "or a list of these to make each of them from the pdf"},
+                {"name": "format_cache", "required": False, "label": "set false to compile without a precompiled "
+                                                                     "preamble format, defaults to true"},
+                {"name": "fail_fast", "required": False, "label": "set true to stop compiling at the first error, "
+                                                                  "defaults to false"},
+                {"name": "limits", "required": False, "label": "lower the server's compile limits with "
+                                                               "{'timeout': sec, 'cpu': sec, 'memory': mb, "
+                                                               "'file_size': mb}, any key may be omitted"},
+                {"name": "callback", "required": False, "label": "a url the final session document is POSTed to as json "
+                                                                 "once the session has been compiled"},
                 {"name": "target", "required": True, "label": "main target file to run through the compiler"}
             ]
+        },
+        "compile": {
+            "href": url_for(compile_document.__name__),
+            "rel": ["create-form"],
+            "method": "POST",
+            "value": [
+                {"label": "create, fill and finalize a session in one request, with json or with multipart/form-data "
+                          "holding the json in a 'session' field and files named by their paths. The options are those "
+                          "of create_session, along with the following. The product is returned if it compiles in "
+                          "time, otherwise the session is returned to be polled."},
+                {"name": "files", "required": False, "label": "list of {'path': path, 'content': base64} or "
+                                                              "{'path': path, 'sha256': digest} for a file already on "
+                                                              "the server"},
+                {"name": "templates", "required": False, "label": "list of {'target': path, 'text': latex, "
+                                                                  "'data': dictionary} templates, or with "
+                                                                  "'template': id in place of 'text' to use a "
+                                                                  "template from the template library"},
+                {"name": "wait", "required": False, "label": "the most seconds to wait for the product, up to the "
+                                                             "server's limit"}
+            ]
+        },
+        "register_template": {
+            "href": url_for(library_templates.__name__),
+            "rel": ["create-form"],
+            "method": "POST",
+            "value": [
+                {"name": "name", "required": True, "label": "name of the template"},
+                {"name": "version", "required": True, "label": "version of the template, which can't be changed "
+                                                               "once registered"},
+                {"name": "text", "required": True, "label": "latex text to be rendered by jinja2"}
+            ]
         }
     }
 
@@ -32,16 +91,19 @@ def api_home():
 
 @app.route("/api/status", methods=['GET'])
 def get_status():
-    session_ids = session_manager.get_all_session_ids()
-    sessions = {}
-    for key in session_ids:
-        session = session_manager.load_session(key)
-        if session.status not in sessions.keys():
-            sessions[session.status] = 1
-        else:
-            sessions[session.status] += 1
+    now = TimeService().now
+    sessions = {status: count for status, count in session_manager.status_counts().items() if count}
+
+    # The queue depth is the number of compile tasks the workers haven't taken from the broker yet
+    queue_depth = redis_client.llen(celery.conf.task_default_queue)
+    oldest_finalized = session_manager.oldest_in_status(FINALIZED_TEXT)
+    oldest_finalized_age = now - oldest_finalized if oldest_finalized is not None else None
 
-    return jsonify({"time": TimeService().now, "sessions": sessions})
+    result_cache = read_counters(redis_client, stats_key(session_manager.instance_key))
+    template_cache = read_template_stats(redis_client, template_stats_key(session_manager.instance_key))
+    return jsonify({"time": now, "sessions": sessions, "queue_depth": queue_depth,
+                    "oldest_finalized_age": oldest_finalized_age, "result_cache": result_cache,
+                    "template_cache": template_cache})
 
 
 @app.route("/api/sessions", methods=["GET", "POST"])
@@ -58,24 +120,176 @@ def get_sessions():
     if not request.is_json or not type(request.json) is dict:
         raise BadRequest("post data must be json dictionary")
 
-    compiler = request.json.get("compiler", None)
-    target = request.json.get("target", None)
+    try:
+        options = _session_options(request.json)
+    except ValueError as e:
+        return BadRequest(e.args[0])
 
+    session_handle = session_manager.create_session(**options)
+
+    created_location = url_for(session_root.__name__, session_id=session_handle.key)
+    return jsonify(session_handle.public), 201, {"location": created_location}
+
+
+def _session_options(data: Dict) -> Dict:
+    """ Validate the session options posted to create a session, returning them as keyword arguments for the session
+    manager's create_session method. Throws a ValueError if any of them is missing or invalid. """
+    compiler = data.get("compiler", None)
+    target = data.get("target", None)
     if None in (compiler, target):
-        raise BadRequest("both compiler and target must be specified")
+        raise ValueError("both compiler and target must be specified")
+
+    return {
+        "compiler": compiler,
+        "target": target,
+        "convert": validate_conversion_data(data["convert"]) if "convert" in data else None,
+        "format_cache": validate_flag(data.get("format_cache", True), "format_cache"),
+        "fail_fast": validate_flag(data.get("fail_fast", False), "fail_fast"),
+        "limits": validate_limits(data.get("limits", None)),
+        "callback": validate_callback(data.get("callback", None))
+    }
 
-    if "convert" in request.json:
-        try:
-            convert = validate_conversion_data(request.json["convert"])
-        except ValueError as e:
-            return BadRequest(e.args[0])
+
+def _compile_contents(data: Dict) -> Tuple[List[Tuple[str, bytes]], List[Tuple[str, str]], List[Dict]]:
+    """ Validate the files and templates of a single request compilation, returning the (path, content) pairs of files
+    sent inline, the (path, sha256) pairs of files to link from the server's store, and the templates """
+    files = data.get("files", [])
+    if not isinstance(files, list) or not all(isinstance(f, dict) and isinstance(f.get("path"), str) for f in files):
+        raise ValueError("Field 'files' must be a list of dictionaries with a string 'path'")
+
+    inline, linked = [], []
+    for f in files:
+        if isinstance(f.get("content"), str):
+            try:
+                inline.append((f["path"], base64.b64decode(f["content"], validate=True)))
+            except binascii.Error:
+                raise ValueError(f"The content of file {f['path']} is not valid base64")
+        elif isinstance(f.get("sha256"), str):
+            linked.append((f["path"], f["sha256"].lower()))
+        else:
+            raise ValueError(f"File {f['path']} must have either a base64 'content' or a 'sha256' digest")
+
+    templates = data.get("templates", [])
+    if not isinstance(templates, list) or not all(isinstance(t, dict) and isinstance(t.get("target"), str) and
+                                                  isinstance(t.get("text", t.get("template")), str) and
+                                                  isinstance(t.get("data"), dict) for t in templates):
+        raise ValueError("Field 'templates' must be a list of dictionaries with a string 'target', a string 'text' "
+                         "or 'template' and a dictionary 'data'")
+    for t in templates:
+        if "text" not in t:
+            t["entry"] = _library_entry(t["template"])
+
+    return inline, linked, templates
+
+
+def _library_entry(tid: str) -> Dict:
+    """ The entry of a template in the template library which a session refers to. Throws a ValueError if there is
+    no template with the id. """
+    entry = _template_library().entry(tid)
+    if entry is None:
+        raise ValueError(f"template {tid} is not in the template library")
+    return entry
+
+
+def _template_library() -> TemplateLibrary:
+    return TemplateLibrary(redis_client, session_manager.instance_key)
+
+
+def _add_template(handle: Session, template: Dict):
+    """ Add a validated template to a session, either with its text or as a reference to its library entry """
+    if "entry" in template:
+        handle.add_library_template(template["target"], template["entry"]["id"], template["entry"]["digest"],
+                                    template["data"])
     else:
-        convert = None
+        handle.add_template(template["target"], template["text"], template["data"])
 
-    session_handle = session_manager.create_session(compiler, target, convert)
 
-    created_location = url_for(session_root.__name__, session_id=session_handle.key)
-    return jsonify(session_handle.public), 201, {"location": created_location}
+def _wait_seconds(wait) -> float:
+    """ The number of seconds a client asked for a request to be held waiting for a compilation, given as a number or a
+    numeric string, which is cut to the server's limit """
+    if isinstance(wait, str):
+        try:
+            wait = float(wait)
+        except ValueError:
+            pass
+    if isinstance(wait, bool) or not isinstance(wait, (int, float)) or not wait >= 0:
+        raise ValueError("Field 'wait' must be a number of seconds which is zero or more")
+    return min(float(wait), float(app.config["COMPILE_WAIT_SEC"]))
+
+
+@app.route("/api/compile", methods=["POST"])
+def compile_document():
+    # The request is either json, or multipart form data with the json in a field named 'session' and the source files
+    # uploaded as files named by their paths, in the same way as the session files endpoint
+    if request.is_json:
+        data = request.json
+    else:
+        try:
+            data = json.loads(request.form.get("session", "{}"))
+        except ValueError:
+            raise BadRequest("Field 'session' must be a json dictionary")
+    if not isinstance(data, dict):
+        raise BadRequest("post data must be json dictionary")
+
+    try:
+        options = _session_options(data)
+        inline, linked, templates = _compile_contents(data)
+        wait = _wait_seconds(data.get("wait", app.config["COMPILE_WAIT_SEC"]))
+    except ValueError as e:
+        return BadRequest(e.args[0])
+
+    handle = session_manager.create_session(**options)
+    try:
+        missing = handle.link_files(linked)
+        if missing:
+            session_manager.delete_session(handle)
+            return jsonify({"error": "files are not on the server and must be sent with their content",
+                            "missing": [{"path": path, "sha256": digest} for path, digest in missing]}), 400
+
+        handle.add_files((path, io.BytesIO(content)) for path, content in inline)
+        handle.add_files((file_item.filename, file_item.stream) for file_item in request.files.values())
+        for template in templates:
+            _add_template(handle, template)
+    except ValueError as e:
+        session_manager.delete_session(handle)
+        return BadRequest(e.args[0])
+
+    handle.finalize()
+    background_run_compile.delay(handle.key, session_manager.working_directory, session_manager.instance_key)
+
+    created_location = url_for(session_root.__name__, session_id=handle.key)
+    status = session_manager.wait_for_result(handle.key, wait) if wait > 0 else FINALIZED_TEXT
+    if status == SUCCESS_TEXT:
+        handle = session_manager.load_session(handle.key)
+        response = _send_file(handle.product, session_id=handle.key)
+        if not isinstance(response, Gone):
+            response.headers["location"] = created_location
+        return response
+
+    if status == ERROR_TEXT:
+        return jsonify(_session_resource(session_manager.load_session(handle.key))), 422, \
+               {"location": created_location}
+
+    # Still compiling when the time ran out, so the client carries on from the session resource as usual
+    return jsonify(handle.public), 202, {"location": created_location}
+
+
+def _session_resource(handle: Session) -> Dict:
+    """ The public session data, with links to the session's log, product and diagnostics where they exist """
+    return session_resource(handle, url_for(session_root.__name__, session_id=handle.key))
+
+
+def _send_file(path: str, mimetype: str = None, session_id: str = None) -> Response:
+    """ Send a file from the working directory with a strong ETag and support for conditional and range requests, or
+    hand it to the front proxy if the server is configured to. A file from a session's entry in the product store marks
+    the entry as recently used, and one which has been evicted from the store is gone. """
+    if session_id is not None and session_manager.product_store is not None:
+        session_manager.product_store.touch(session_id)
+    try:
+        return send_download(request, path, mimetype, app.config["SENDFILE_MODE"], session_manager.working_directory,
+                             app.config["SENDFILE_PREFIX"])
+    except FileNotFoundError:
+        return Gone("the file has been removed from the product store")
 
 
 @app.route("/api/sessions/<session_id>/product", methods=["GET"])
@@ -87,7 +301,19 @@ def session_product(session_id: str):
     if handle.product is None:
         return NotFound()
 
-    return send_file(handle.product)
+    return _send_file(handle.product, session_id=session_id)
+
+
+@app.route("/api/sessions/<session_id>/outputs/<int:index>", methods=["GET"])
+def session_output(session_id: str, index: int):
+    handle = session_manager.load_session(session_id)
+    if handle is None:
+        return BadRequest(f"session {session_id} could not be found")
+
+    if handle.outputs is None or index >= len(handle.outputs):
+        return NotFound()
+
+    return _send_file(handle.outputs[index], session_id=session_id)
 
 
 @app.route("/api/sessions/<session_id>/log", methods=["GET"])
@@ -99,11 +325,56 @@ def session_log(session_id: str):
     if handle.log is None:
         return NotFound()
 
-    return send_file(handle.log)
+    return _send_file(handle.log, session_id=session_id)
+
+
+@app.route("/api/sessions/<session_id>/diagnostics", methods=["GET"])
+def session_diagnostics(session_id: str):
+    handle = session_manager.load_session(session_id)
+    if handle is None:
+        return BadRequest(f"session {session_id} could not be found")
+
+    if handle.diagnostics is None:
+        return NotFound()
+
+    return jsonify(handle.diagnostics)
+
+
+@app.route("/api/sessions/<session_id>/events", methods=["GET"])
+def session_events(session_id: str):
+    handle = session_manager.load_session(session_id)
+    if handle is None:
+        return BadRequest(f"session {session_id} could not be found")
+
+    # A server-sent event is written for the session's status and then for each change of it, until the session is
+    # compiled or removed. Like a long-polling request, the stream holds a web worker thread only for as long as the
+    # server's wait limit, after which the client reconnects and is sent the current status again.
+    timeout = max(min(handle.expires_at - session_manager.time_service.now, float(app.config["COMPILE_WAIT_SEC"])), 0)
+
+    def stream():
+        previous = None
+        changes = session_manager.status_changes(session_id, timeout, heartbeat=_EVENT_HEARTBEAT_SEC)
+        for count, status in enumerate(changes):
+            # An unchanged status is a heartbeat, written as a comment to keep idle proxies from closing the stream
+            if count and status == previous:
+                yield ": keep-alive\n\n"
+                continue
+            previous = status
+            yield f"event: status\ndata: {json.dumps({'key': session_id, 'status': status})}\n\n"
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.route("/api/sessions/<session_id>", methods=["GET", "POST"])
 def session_root(session_id: str):
+    # A GET request may ask to be held until the session is compiled, rather than the client polling for it
+    if request.method == "GET" and "wait" in request.args:
+        try:
+            session_manager.wait_for_result(session_id, _wait_seconds(request.args["wait"]))
+        except ValueError as e:
+            return BadRequest(e.args[0])
+
     # Retrieve the session information
     handle = session_manager.load_session(session_id)
     if handle is None:
@@ -111,46 +382,9 @@ def session_root(session_id: str):
 
     # On a get request, we simply return the session information as we have it
     if request.method == "GET":
-        # The base response is the public session data
-        response = dict(handle.public)
-
-        # If the session has a log or a product, we include a link to it
-        if handle.product is not None:
-            response['product'] = {"href": url_for(session_product.__name__, session_id=session_id)}
-        if handle.log is not None:
-            response['log'] = {"href": url_for(session_log.__name__, session_id=session_id)}
-
-        form_info = {
-            "add_file": {
-                "href": url_for(session_files.__name__, session_id=session_id),
-                "rel": ["create-form"],
-                "method": "POST",
-                "value": [
-                    {"label": "upload file(s) with multipart/form-data, filename is used to specify path"}
-                ]
-            },
-            "add_templates": {
-                "href": url_for(session_templates.__name__, session_id=session_id),
-                "rel": ["create-form"],
-                "method": "POST",
-                "value": [
-                    {"name": "target", "required": True, "label": "target path/filename to render the template to"},
-                    {"name": "text", "required": True, "label": "latex text to be rendered by jinja2"},
-                    {"name": "data", "required": True, "label": "json dictionary to be rendered into the template"}
-                ]
-            },
-            "finalize": {
-                "href": url_for(session_root.__name__, session_id=session_id),
-                "rel": ["edit-form"],
-                "method": "POST",
-                "value": [
-                    {"name": "finalize", "required": False,
-                     "label": "set true to finalize the session and release it to the compiler"}
-                ]
-            }
-        }
-        response.update(form_info)
-        return jsonify(response)
+        # The public session data, with links to the session's log or product if it has them, and the forms which
+        # can be used to add to it
+        return jsonify(session_document(handle, url_for(session_root.__name__, session_id=session_id)))
 
     # A post request allows additional information to be added to the session
     if request.method == "POST":
@@ -166,11 +400,41 @@ def session_root(session_id: str):
             if "convert" in request.json:
                 try:
                     handle.convert = validate_conversion_data(request.json["convert"])
-                    session_manager.save_session(handle)
+                    if isinstance(handle.convert, list) and handle.row_count:
+                        raise ValueError("a batch session can't have a list of image conversions")
+                    session_manager.save_session(handle, "convert")
                     updated_something = True
                 except ValueError as e:
                     return BadRequest(e.args[0])
 
+            # Check if a callback url has been supplied
+            if "callback" in request.json:
+                try:
+                    handle.callback = validate_callback(request.json["callback"])
+                    session_manager.save_session(handle, "callback")
+                    updated_something = True
+                except ValueError as e:
+                    return BadRequest(e.args[0])
+
+            # Check if compile limits have been supplied
+            if "limits" in request.json:
+                try:
+                    handle.limits = validate_limits(request.json["limits"])
+                    session_manager.save_session(handle, "limits")
+                    updated_something = True
+                except ValueError as e:
+                    return BadRequest(e.args[0])
+
+            # Check if any of the session's on/off options have been supplied
+            for name in ("format_cache", "fail_fast"):
+                if name in request.json:
+                    try:
+                        setattr(handle, name, validate_flag(request.json[name], name))
+                        session_manager.save_session(handle, name)
+                        updated_something = True
+                    except ValueError as e:
+                        return BadRequest(e.args[0])
+
             # Any additional values that should be get set with a POST to this endpoint should
             # be done here, so that the check for session finalization is the very last thing
             # that happens.  After the check for finalization, if anything was changed we can
@@ -208,13 +472,118 @@ def session_files(session_id: str):
     if request.method == "POST":
         if not handle.is_editable:
             return jsonify({"error": "session is not editable"}), 403
-        for name, file_item in request.files.items():
-            with handle.source_files.open(file_item.filename, "wb") as file_handle:
-                file_item.save(file_handle)
+        try:
+            for name, file_item in request.files.items():
+                handle.add_file(file_item.filename, file_item.stream)
+        except ValueError as e:
+            return BadRequest(e.args[0])
 
         return jsonify(handle.public["files"]), 201
 
 
+@app.route("/api/sessions/<session_id>/files/link", methods=["POST"])
+def session_link_files(session_id: str):
+    handle = session_manager.load_session(session_id)
+    if handle is None:
+        return BadRequest(f"session {session_id} could not be found")
+
+    if not handle.is_editable:
+        return jsonify({"error": "session is not editable"}), 403
+
+    files = request.json.get("files", None) if request.is_json and isinstance(request.json, dict) else None
+    if not isinstance(files, list) or not all(isinstance(f, dict) and isinstance(f.get("path"), str) and
+                                              isinstance(f.get("sha256"), str) for f in files):
+        raise BadRequest("Field 'files' must be a list of dictionaries with the string keys 'path' and 'sha256'")
+
+    try:
+        missing = handle.link_files((f["path"], f["sha256"].lower()) for f in files)
+    except ValueError as e:
+        return BadRequest(e.args[0])
+
+    return jsonify({"missing": [{"path": path, "sha256": digest} for path, digest in missing],
+                    "files": handle.public["files"], "file_manifest": handle.public["file_manifest"]})
+
+
+@app.route("/api/sessions/<session_id>/archive", methods=["POST"])
+def session_archive(session_id: str):
+    handle = session_manager.load_session(session_id)
+    if handle is None:
+        return BadRequest(f"session {session_id} could not be found")
+
+    if not handle.is_editable:
+        return jsonify({"error": "session is not editable"}), 403
+
+    # The body is read as a stream and each member is written out as it arrives, so the archive is never held whole
+    members = read_archive(request.stream, int(app.config["ARCHIVE_MAX_FILES"]),
+                           int(app.config["ARCHIVE_MAX_MB"]) * 1024 * 1024)
+    try:
+        handle.add_files(members)
+    except ValueError as e:
+        return BadRequest(e.args[0])
+
+    return jsonify(handle.public["files"]), 201
+
+
+@app.route("/api/sessions/<session_id>/rows", methods=["GET", "POST"])
+def session_rows(session_id: str):
+    handle = session_manager.load_session(session_id)
+    if handle is None:
+        return BadRequest(f"session {session_id} could not be found")
+
+    # On a get request, the result of each row compiled so far is returned along with the counts
+    if request.method == "GET":
+        results = session_manager.load_row_results(session_id)
+        rows = []
+        for index, result in sorted(results.items()):
+            row = {"index": index, "success": result["success"], "passes": result["passes"], "reason": result["reason"]}
+            if result["log"] is not None:
+                row["log"] = {"href": url_for(session_row_log.__name__, session_id=session_id, index=index)}
+            rows.append(row)
+        return jsonify(dict(handle.public["rows"] or {}, results=rows))
+
+    # A post request adds data rows, turning the session into a batch
+    if not request.is_json or not type(request.json) is dict:
+        raise BadRequest("post data must be json dictionary")
+
+    if not handle.is_editable:
+        return jsonify({"error": "session is not editable"}), 403
+
+    if isinstance(handle.convert, list):
+        return BadRequest("a batch session can't have a list of image conversions")
+
+    try:
+        rows = validate_rows(request.json.get("rows", None))
+        if "output" in request.json:
+            handle.batch_output = validate_batch_output(request.json["output"])
+            session_manager.save_session(handle, "batch_output")
+    except ValueError as e:
+        return BadRequest(e.args[0])
+
+    max_rows = int(app.config["BATCH_MAX_ROWS"])
+    if handle.row_count + len(rows) > max_rows:
+        return BadRequest(f"a batch session may have no more than {max_rows} rows")
+
+    handle.add_rows(rows)
+    return jsonify(handle.public["rows"]), 201
+
+
+@app.route("/api/sessions/<session_id>/rows/<int:index>/log", methods=["GET"])
+def session_row_log(session_id: str, index: int):
+    handle = session_manager.load_session(session_id)
+    if handle is None:
+        return BadRequest(f"session {session_id} could not be found")
+
+    result = session_manager.load_row_results(session_id).get(index)
+    if result is None or result["log"] is None:
+        return NotFound()
+
+    # Once the rows have been collected, their logs are kept in the product store along with the session's product
+    if session_manager.product_store is not None and handle.status in (SUCCESS_TEXT, ERROR_TEXT):
+        log_path = os.path.join(session_manager.product_store.entry_path(session_id), result["log"])
+        return _send_file(log_path, mimetype="text/plain", session_id=session_id)
+    return _send_file(os.path.join(handle.rows_path, result["log"]), mimetype="text/plain")
+
+
 @app.route("/api/sessions/<session_id>/templates", methods=["GET", "POST"])
 def session_templates(session_id: str):
     # Retrieve the session information
@@ -235,10 +604,14 @@ def session_templates(session_id: str):
             return jsonify({"error": "session is not editable"}), 403
 
         text = request.json.get("text", None)
+        tid = request.json.get("template", None)
         target = request.json.get("target", None)
         data = request.json.get("data")
 
-        if text is None or type(text) is not str:
+        if tid is not None:
+            if type(tid) is not str:
+                raise BadRequest("Field 'template' must be a valid string")
+        elif text is None or type(text) is not str:
             raise BadRequest("Field 'text' must be supplied and be a valid string")
 
         if target is None or type(target) is not str:
@@ -247,8 +620,83 @@ def session_templates(session_id: str):
         if data is None or type(data) is not dict:
             raise BadRequest("Field 'data' must be supplied and be a valid dictionary")
 
-        md = md5(target.encode())
-        with handle.template_files.open(md.hexdigest(), "w") as file_handle:
-            file_handle.write(json.dumps({"text": text, "target": target, "data": data}))
+        # A template from the library is referred to rather than copied into the session
+        if tid is not None:
+            try:
+                entry = _library_entry(tid)
+            except ValueError as e:
+                return BadRequest(e.args[0])
+            handle.add_library_template(target, tid, entry["digest"], data)
+            body = {"template": tid, "data": data}
+        else:
+            handle.add_template(target, text, data)
+            body = {"text": text, "data": data}
+
+        # The response is the template manifest, with the full body of the template which was just posted
+        templates = dict(handle.templates)
+        templates[target] = dict(templates[target], **body)
+        return jsonify(templates), 201
+
+
+@app.route("/api/sessions/<session_id>/templates/<path:target>", methods=["GET"])
+def session_template(session_id: str, target: str):
+    handle = session_manager.load_session(session_id)
+    if handle is None:
+        return BadRequest(f"session {session_id} could not be found")
+
+    body = handle.template_body(target)
+    if body is None:
+        return NotFound()
 
-        return jsonify(handle.public["templates"]), 201
+    return jsonify(body)
+
+
+@app.route("/api/templates", methods=["GET", "POST"])
+def library_templates():
+    library = _template_library()
+    if request.method == "GET":
+        return jsonify(library.entries())
+
+    if not request.is_json or not type(request.json) is dict:
+        raise BadRequest("post data must be json dictionary")
+
+    text = request.json.get("text", None)
+    if text is None or type(text) is not str:
+        raise BadRequest("Field 'text' must be supplied and be a valid string")
+
+    try:
+        name = validate_template_name(request.json.get("name", None), "name")
+        version = validate_template_name(request.json.get("version", None), "version")
+        precompile_template(redis_client, session_manager.working_directory, session_manager.instance_key, text)
+    except ValueError as e:
+        return BadRequest(e.args[0])
+
+    entry, created = library.register(name, version, text, TimeService().now)
+    location = url_for(library_template.__name__, tid=entry["id"])
+    if created:
+        return jsonify(entry), 201, {"location": location}
+
+    # A version can be registered again with the same text, but never changed
+    if entry["digest"] != hashlib.sha256(text.encode()).hexdigest():
+        return jsonify({"error": f"template {entry['id']} is already registered with different text",
+                        "template": entry}), 409
+    return jsonify(entry), 200, {"location": location}
+
+
+@app.route("/api/templates/<tid>", methods=["GET", "DELETE"])
+def library_template(tid: str):
+    library = _template_library()
+    if request.method == "DELETE":
+        # Sessions which are still to be compiled render the template from the library, so it is kept until they are
+        sessions = session_manager.sessions_using_template(tid)
+        if sessions:
+            return jsonify({"error": f"template {tid} is used by sessions which haven't been compiled yet",
+                            "sessions": sessions}), 409
+        if not library.remove(tid):
+            return NotFound()
+        return "", 204
+
+    body = library.body(tid)
+    if body is None:
+        return NotFound()
+    return jsonify(body)
@@ -11,6 +11,35 @@ class ConfigBase:
     SESSION_TTL_SEC = os.environ.get("SESSION_TTL_SEC") or 60 * 5
     CLEAR_EXPIRED_INTERVAL_SEC = os.environ.get("CLEAR_EXPIRED_INTERVAL_SEC") or 60
     INSTANCE_KEY = os.environ.get("INSTANCE_KEY") or "latex-compile-service"
+    COMPILE_TIMEOUT_SEC = os.environ.get("COMPILE_TIMEOUT_SEC") or 120
+    COMPILE_CPU_SEC = os.environ.get("COMPILE_CPU_SEC") or 120
+    COMPILE_MEMORY_MB = os.environ.get("COMPILE_MEMORY_MB") or 0
+    COMPILE_FILE_SIZE_MB = os.environ.get("COMPILE_FILE_SIZE_MB") or 512
+    COMPILE_WAIT_SEC = os.environ.get("COMPILE_WAIT_SEC") or 30
+    BATCH_MAX_ROWS = os.environ.get("BATCH_MAX_ROWS") or 10000
+    BATCH_CHUNK_ROWS = os.environ.get("BATCH_CHUNK_ROWS") or 20
+    CALLBACK_INTERVAL_SEC = os.environ.get("CALLBACK_INTERVAL_SEC") or 10
+    CALLBACK_TIMEOUT_SEC = os.environ.get("CALLBACK_TIMEOUT_SEC") or 10
+    CALLBACK_RETRY_SEC = os.environ.get("CALLBACK_RETRY_SEC") or 10
+    CALLBACK_MAX_ATTEMPTS = os.environ.get("CALLBACK_MAX_ATTEMPTS") or 8
+    CALLBACK_ALLOWED_HOSTS = os.environ.get("CALLBACK_ALLOWED_HOSTS") or ""
+    EXTERNAL_URL = os.environ.get("EXTERNAL_URL") or ""
+    SCRATCH_DIRECTORY = os.environ.get("SCRATCH_DIRECTORY") or ""
+    SCRATCH_MAX_MB = os.environ.get("SCRATCH_MAX_MB") or 256
+    BLOB_RETENTION_SEC = os.environ.get("BLOB_RETENTION_SEC") or 60 * 60 * 24
+    ARCHIVE_MAX_FILES = os.environ.get("ARCHIVE_MAX_FILES") or 1000
+    ARCHIVE_MAX_MB = os.environ.get("ARCHIVE_MAX_MB") or 256
+    MAX_COMPILE_PASSES = os.environ.get("MAX_COMPILE_PASSES") or 5
+    MAX_DIAGNOSTICS = os.environ.get("MAX_DIAGNOSTICS") or 100
+    RESULT_CACHE_MAX_MB = os.environ.get("RESULT_CACHE_MAX_MB") or 512
+    FORMAT_CACHE_MAX_MB = os.environ.get("FORMAT_CACHE_MAX_MB") or 1024
+    PRODUCT_STORE_MAX_MB = os.environ.get("PRODUCT_STORE_MAX_MB") or 2048
+    TEMPLATE_CACHE_SIZE = os.environ.get("TEMPLATE_CACHE_SIZE") or 256
+    TEMPLATE_BYTECODE_MAX_MB = os.environ.get("TEMPLATE_BYTECODE_MAX_MB") or 64
+    CONVERT_PROCESSES = os.environ.get("CONVERT_PROCESSES") or 0
+    CONVERT_MAX_PAGE_DPI = os.environ.get("CONVERT_MAX_PAGE_DPI") or 60000
+    SENDFILE_MODE = os.environ.get("SENDFILE_MODE") or ""
+    SENDFILE_PREFIX = os.environ.get("SENDFILE_PREFIX") or "/protected"
 
 
 class ProductionConfig(ConfigBase):
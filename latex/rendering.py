@@ -1,21 +1,69 @@
 import os
 import json
+import shutil
+import time
+import signal
+import hashlib
+import resource
+import zipfile
+import tempfile
+import itertools
+import threading
 import subprocess
 from collections import namedtuple
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Set, Tuple
 import jinja2
-from jinja2 import Template
 import redis
 
 from latex.config import ConfigBase
 from latex.services.time_service import TimeService
 from latex.services.file_service import FileService
-from latex.session import Session, SessionManager
+from latex.services.blob_store import unshare_tree
+from latex.services.result_cache import ResultCache, manifest_digest, stats_key
+from latex.services.format_cache import FormatCache, preamble_digest
+from latex.services.scratch_space import ScratchSpace
+from latex.services.template_cache import TemplateCache, TemplateBytecodeCache, TEMPLATE_BYTECODE_DIRECTORY, \
+    template_stats_key
+from latex.services.template_library import TemplateLibrary, TemplateUnavailable
+from latex.session import Session, SessionManager, LIMIT_SETTINGS
+from latex.texlog import scan_log, LogSummary
 
 import logging
 
 COMPILERS = ['xelatex', 'pdflatex', 'lualatex']
-RenderResult = namedtuple('RenderResult', 'success product log')
+RESULT_CACHE_DIRECTORY = ".result_cache"
+FORMAT_CACHE_DIRECTORY = ".format_cache"
+
+# LuaTeX can dump a format, but the Lua side of its state (such as the fonts loaded by luaotfload for fontspec) is not
+# preserved in it, so documents compiled by lualatex are always run from the standard format
+FORMAT_COMPILERS = ['xelatex', 'pdflatex']
+
+# The extensions pdftoppm gives the images of each conversion format
+IMAGE_EXTENSIONS = {"jpeg": "jpg", "png": "png", "tiff": "tif"}
+CompileLimits = namedtuple('CompileLimits', 'timeout cpu memory file_size')
+RenderResult = namedtuple('RenderResult', 'success product log passes reason diagnostics outputs',
+                          defaults=(0, None, None, None))
+
+# The files the compiler writes on one pass and reads back in on the next. Of these, the listings are never mentioned
+# in the log when they change, so they are checked for convergence directly.
+AUXILIARY_EXTENSIONS = (".aux", ".toc", ".lof", ".lot", ".out")
+LISTING_EXTENSIONS = (".toc", ".lof", ".lot")
+
+STOP_CONVERGED = "auxiliary files converged"
+STOP_NO_RERUN = "no rerun requested"
+STOP_PASS_LIMIT = "pass limit reached"
+STOP_FATAL_ERROR = "fatal error"
+STOP_CACHED = "result cache hit"
+STOP_TIMEOUT = "wall time limit exceeded"
+STOP_CPU_LIMIT = "cpu time limit exceeded"
+STOP_MEMORY_LIMIT = "memory limit exceeded"
+STOP_FILE_SIZE_LIMIT = "output file size limit exceeded"
+STOP_CONVERSION_FAILED = "image conversion failed"
+STOP_ROWS_COLLECTED = "batch rows collected"
+STOP_ROWS_FAILED = "batch rows failed"
+STOP_INTERNAL_ERROR = "internal error"
+STOP_TEMPLATE_UNAVAILABLE = "library template unavailable"
 
 _latex_env = jinja2.Environment(
     block_start_string=r'\BLOCK{',
@@ -31,48 +79,471 @@ _latex_env = jinja2.Environment(
     loader=jinja2.FileSystemLoader(os.path.abspath('.'))
 )
 
+# The compiled templates are kept by each worker process, and the bytecode cache in the working directory is given to
+# the environment by the first compilation, since that is when the working directory is known
+_template_cache = TemplateCache(_latex_env, int(ConfigBase.TEMPLATE_CACHE_SIZE))
+
 
 def compile_latex(session_id: str, working_directory: str, instance_key: str):
     logging.debug("Starting compilation on session %s", session_id)
+    _enable_bytecode_cache(working_directory)
     client = redis.from_url(ConfigBase.REDIS_URL)
     manager = SessionManager(client, TimeService(), instance_key, working_directory)
     session = manager.load_session(session_id)
-    result = _render_and_compile(session.key, session.compiler, session.target, session.source_files.root_path,
-                                 session.template_files.root_path)
 
-    # Check that the PDF was rendered as expected, if not return from here
-    if not result.success:
-        session.set_errored(result.log)
-        logging.info("Compilation failed on session %s", session_id)
-        return result
+    # A batch session compiled in a single process works through its chunks of rows one after another, while the
+    # background task spreads the same chunks over the workers
+    if session.row_count:
+        for start, stop in batch_chunks(session.row_count):
+            compile_rows(session_id, working_directory, instance_key, start, stop)
+        return collect_rows(session_id, working_directory, instance_key)
 
-    # If we need to perform an image conversion, we do it now
-    if session.convert is not None:
-        logging.info("An image conversion to %s at %i dpi requested on session %s", session.convert["format"],
-                     session.convert["dpi"], session_id)
-        convert_result = _convert_image(result.product,
-                                        session.convert["format"],
-                                        session.convert["dpi"])
-        if convert_result:
-            result = RenderResult(success=True, product=convert_result, log=result.log)
-        else:
-            result = RenderResult(success=False, product=None, log=result.log + "\nFailed on conversion to image")
+    # Identical inputs produce identical outputs, so a session whose inputs have been compiled before can be completed
+    # directly from the result cache. The digest is taken from the session's manifests of its files and templates.
+    # The cache holds a single product, so sessions with a list of image conversions are always compiled.
+    cache = _result_cache(client, working_directory, instance_key) if not isinstance(session.convert, list) else None
+    digest = None
+    if cache is not None:
+        digest = manifest_digest(session.compiler, session.target, session.convert, session.file_manifest,
+                                 session.template_manifest, session.fail_fast)
+        cached = cache.fetch(digest, session.source_files.root_path, session.key)
+        if cached is not None:
+            logging.info("Result cache hit on session %s", session_id)
+            diagnostics = _diagnostics(scan_log(cached.log, int(ConfigBase.MAX_DIAGNOSTICS)))
+            result = _store_products(manager, session, RenderResult(
+                success=True, product=cached.product, log=cached.log, passes=0, reason=STOP_CACHED,
+                diagnostics=diagnostics))
+            session.set_complete(result.product, result.log, {"passes": 0, "reason": STOP_CACHED}, diagnostics)
+            _release_sources(manager, session)
+            return result
+
+    # A library template which was removed or changed after the session referred to it fails the session, as does
+    # anything else going wrong in the worker, rather than leaving the session finalized until it expires
+    try:
+        result = _compile_in_place(session, working_directory, TemplateLibrary(client, instance_key))
+    except TemplateUnavailable as e:
+        logging.info("Session %s refers to an unavailable template: %s", session_id, e)
+        error = {"file": None, "line": None, "message": str(e)}
+        result = RenderResult(success=False, product=None, log=None, reason=STOP_TEMPLATE_UNAVAILABLE,
+                              diagnostics=_diagnostics(LogSummary(False, [error], [], 1, 0)))
+    except Exception:
+        logging.exception("Compiling session %s failed", session_id)
+        result = RenderResult(success=False, product=None, log=None, reason=STOP_INTERNAL_ERROR)
+
+    _template_cache.flush_stats(client, template_stats_key(instance_key))
+    result = _store_products(manager, session, result)
 
     # Check the overall success or failure and return the result
     if result.success:
         logging.info("Compilation successful on session %s", session_id)
-        session.set_complete(result.product, result.log)
+        session.set_complete(result.product, result.log, _compile_info(result), result.diagnostics, result.outputs)
+        if cache is not None:
+            cache.store(digest, result.product, result.log)
     else:
         logging.info("Compilation failed on session %s", session_id)
-        session.set_errored(result.log)
+        session.set_errored(result.log, _compile_info(result), result.diagnostics)
+
+    _release_sources(manager, session)
+    return result
+
+
+def _compile_in_place(session: Session, working_directory: str, library: TemplateLibrary) -> RenderResult:
+    """ Compile a session which isn't a batch, leaving its product, conversions and log in its source directory """
+    format_cache = _format_cache(working_directory) if session.format_cache else None
+    limits = _compile_limits(session.limits)
+    session_path = session.source_files.root_path
+
+    # Compile in the worker's local scratch directory if the session fits there, so that the compiler's passes don't
+    # go through the shared working directory, then copy just the product and the log back to the session
+    scratch = _scratch_space()
+    staged_path = scratch.stage(session.key, session_path) if scratch is not None else None
+    if staged_path is None:
+        unshare_tree(session_path, _compiler_writes(session.key))
+        result = _compile_session(session, session_path, format_cache, limits, library=library)
+    else:
+        logging.debug("Compiling session %s in scratch directory %s", session.key, staged_path)
+        try:
+            # No single file the compiler writes may be larger than the room reserved for its output
+            room_mb = max(scratch.output_room(staged_path) // (1024 * 1024), 1)
+            scratch_limits = limits._replace(file_size=min(limits.file_size or room_mb, room_mb))
+            result = _compile_session(session, staged_path, format_cache, scratch_limits, library=library)
+            out_of_room = not result.success and scratch.out_of_room(result.log)
+            result = result._replace(product=scratch.retrieve(result.product, session_path),
+                                     log=scratch.retrieve(result.log, session_path),
+                                     outputs=[scratch.retrieve(output, session_path) for output in result.outputs]
+                                     if result.outputs is not None else None)
+        finally:
+            scratch.release(staged_path)
+
+        # Running out of room in the scratch directory isn't the document's fault, so try again on disk
+        outgrew_room = result.reason == STOP_FILE_SIZE_LIMIT and limits.file_size != scratch_limits.file_size
+        if outgrew_room or out_of_room:
+            logging.info("Session %s outgrew the scratch directory, compiling on disk", session.key)
+            unshare_tree(session_path, _compiler_writes(session.key))
+            result = _compile_session(session, session_path, format_cache, limits, library=library)
+    return result
+
+
+def batch_chunks(row_count: int) -> List[Tuple[int, int]]:
+    """ Split the rows of a batch session into the (start, stop) ranges which are compiled together by one task """
+    size = max(int(ConfigBase.BATCH_CHUNK_ROWS), 1)
+    return [(start, min(start + size, row_count)) for start in range(0, row_count, size)]
+
+
+def session_batch_chunks(session_id: str, working_directory: str, instance_key: str) -> List[Tuple[int, int]]:
+    """ The chunks of rows of a batch session, or an empty list if the session is not a batch """
+    client = redis.from_url(ConfigBase.REDIS_URL)
+    manager = SessionManager(client, TimeService(), instance_key, working_directory)
+    fields = manager.load_fields(session_id, "row_count")
+    return batch_chunks(fields["row_count"] or 0) if fields is not None else []
+
+
+def compile_rows(session_id: str, working_directory: str, instance_key: str, start: int, stop: int):
+    """ Compile the rows of a batch session from index start up to stop, keeping the product and log of each in the
+    session's rows directory and recording its result. A failure of one row is recorded and doesn't stop the rest, and
+    if the chunk can't be compiled at all every row of it without a result is recorded as failed, so that the rows can
+    still be collected. """
+    _enable_bytecode_cache(working_directory)
+    client = redis.from_url(ConfigBase.REDIS_URL)
+    manager = SessionManager(client, TimeService(), instance_key, working_directory)
+    session = manager.load_session(session_id)
+    if session is None:
+        return
+
+    next_row = start
+    work_path = None
+    try:
+        format_cache = _format_cache(working_directory) if session.format_cache else None
+        limits = _compile_limits(session.limits)
+        library = TemplateLibrary(client, instance_key)
+        os.makedirs(session.rows_path, exist_ok=True)
+
+        # The chunk is compiled in a private copy of the session's source files. The compiler rewrites any file it opens
+        # for output in place, so the copy keeps it from changing the session's files or the blobs they are linked to,
+        # and everything a row adds to the tree is removed before the next row.
+        work_path = tempfile.mkdtemp(prefix=f".work-{start}-", dir=session.rows_path)
+        source_path = os.path.join(work_path, Session._source_directory)
+        shutil.copytree(session.source_files.root_path, source_path, copy_function=shutil.copyfile)
+        original = _tree_files(source_path)
+        for index, row in enumerate(session.read_rows(start, stop), start):
+            job = f"{session.key}-{index}"
+            try:
+                result = _compile_session(session, source_path, format_cache, limits, job, row, library)
+                product = _keep_row_file(result.product, session.rows_path, index)
+                log = _keep_row_file(result.log, session.rows_path, index)
+                result = result._replace(product=product, log=log)
+            except Exception:
+                logging.exception("Compiling row %i of session %s failed", index, session_id)
+                result = RenderResult(success=False, product=None, log=None, reason=STOP_INTERNAL_ERROR)
+            finally:
+                _remove_new_files(source_path, original)
+
+            manager.record_row_result(session, index, {"success": result.success, "passes": result.passes,
+                                                       "reason": result.reason, "product": result.product,
+                                                       "log": result.log})
+            next_row = index + 1
+    except Exception:
+        logging.exception("Compiling rows %i to %i of session %s failed", next_row, stop - 1, session_id)
+        for index in range(next_row, stop):
+            manager.record_row_result(session, index, {"success": False, "passes": 0, "reason": STOP_INTERNAL_ERROR,
+                                                       "product": None, "log": None})
+    finally:
+        if work_path is not None:
+            shutil.rmtree(work_path, True)
+        _template_cache.flush_stats(client, template_stats_key(instance_key))
+
+
+def collect_rows(session_id: str, working_directory: str, instance_key: str) -> RenderResult:
+    """ Once every row of a batch session has been compiled, collect the row products into the session's product,
+    either a zip of them or a single merged pdf, and complete the session. The session fails if any row did. """
+    client = redis.from_url(ConfigBase.REDIS_URL)
+    manager = SessionManager(client, TimeService(), instance_key, working_directory)
+    session = manager.load_session(session_id)
+    if session is None:
+        return None
+
+    results = manager.load_row_results(session_id)
+    passes = sum(r["passes"] for r in results.values())
+    failed = [i for i in range(session.row_count) if not results.get(i, {}).get("success", False)]
+    if failed:
+        logging.info("%i of the %i rows of session %s failed", len(failed), session.row_count, session_id)
+        compile_info = {"passes": passes, "reason": STOP_ROWS_FAILED, "failed_rows": failed[:100]}
+        _store_row_logs(manager, session, results)
+        session.set_errored(None, compile_info)
+        _release_sources(manager, session)
+        return RenderResult(success=False, product=None, log=None, passes=passes, reason=STOP_ROWS_FAILED)
+
+    products = [results[i]["product"] for i in range(session.row_count)]
+    if session.batch_output == "pdf" and session.convert is None:
+        product = _merge_pdfs(products, session.rows_path, f"{session.key}.pdf")
+    else:
+        product = _zip_products(products, session.rows_path, f"{session.key}.zip")
 
+    if product is None:
+        _store_row_logs(manager, session, results)
+        session.set_errored(None, {"passes": passes, "reason": STOP_ROWS_FAILED})
+        _release_sources(manager, session)
+        return RenderResult(success=False, product=None, log=None, passes=passes, reason=STOP_ROWS_FAILED)
+
+    # The row products are in the collected product now, so only the logs of the rows are kept
+    logging.info("Collected the %i rows of session %s", session.row_count, session_id)
+    result = _store_products(manager, session, RenderResult(success=True, product=product, log=None, passes=passes,
+                                                            reason=STOP_ROWS_COLLECTED))
+    _store_row_logs(manager, session, results)
+    session.set_complete(result.product, None, {"passes": passes, "reason": STOP_ROWS_COLLECTED})
+    _release_sources(manager, session)
     return result
 
 
-def _render_templates(template_path: str, source_path: str):
+def _store_products(manager: SessionManager, session: Session, result: RenderResult) -> RenderResult:
+    """ Move the product, image conversions and log of a compiled session into the product store, returning the result
+    with their new paths, or the result as it was if the product store has been disabled """
+    if manager.product_store is None:
+        return result
+    outputs = result.outputs or []
+    product, log, *outputs = manager.product_store.keep(session.key, [result.product, result.log, *outputs])
+    return result._replace(product=product, log=log, outputs=outputs if result.outputs is not None else None)
+
+
+def _store_row_logs(manager: SessionManager, session: Session, results: Dict[int, Dict]):
+    """ Move the logs of a batch session's rows into the product store, where they count against its budget along with
+    the session's product, and remove the rows directory with anything else left in it, if the product store hasn't
+    been disabled """
+    if manager.product_store is None:
+        return
+    logs = [os.path.join(session.rows_path, r["log"]) for r in results.values() if r["log"] is not None]
+    manager.product_store.keep(session.key, logs)
+    shutil.rmtree(session.rows_path, True)
+
+
+def _release_sources(manager: SessionManager, session: Session):
+    """ Remove a compiled session's source tree, once its outputs have been moved to the product store """
+    if manager.product_store is not None:
+        manager.release_sources(session.key)
+
+
+def _compiler_writes(job: str) -> Callable[[str], bool]:
+    """ Whether the compiler may open a file of the given name for output: the files named after its job, and the
+    auxiliary files and listings, which are also written for each included document """
+    return lambda name: name.startswith(f"{job}.") or name.endswith(AUXILIARY_EXTENSIONS)
+
+
+def _tree_files(root_path: str) -> Set[str]:
+    """ The paths of the files under a directory, relative to it """
+    return {os.path.relpath(os.path.join(root, f), root_path) for root, _, files in os.walk(root_path) for f in files}
+
+
+def _remove_new_files(root_path: str, original: Set[str]):
+    """ Remove the files under a directory which are not among the original ones """
+    for relative_path in _tree_files(root_path) - original:
+        os.remove(os.path.join(root_path, relative_path))
+
+
+def _keep_row_file(path: str, rows_path: str, index: int) -> str:
+    """ Move a file produced for a row of a batch session into the rows directory, named by the row's index, and
+    return its new name there """
+    if path is None or not os.path.exists(path):
+        return None
+    name = f"{index}{os.path.splitext(path)[1]}"
+    os.replace(path, os.path.join(rows_path, name))
+    return name
+
+
+def _zip_products(products: List[str], rows_path: str, name: str) -> str:
+    """ Store the row products in a zip, named so that they sort in the order of the rows. The products are already
+    compressed, so they are stored as they are. """
+    width = len(str(len(products) - 1))
+    destination = os.path.join(rows_path, name)
+    with zipfile.ZipFile(destination, "w", zipfile.ZIP_STORED) as archive:
+        for index, product in enumerate(products):
+            archive.write(os.path.join(rows_path, product), f"{index:0{width}d}{os.path.splitext(product)[1]}")
+    return destination
+
+
+def _merge_pdfs(products: List[str], rows_path: str, name: str) -> str:
+    """ Merge the row products into a single pdf with poppler's pdfunite, returning None if it fails """
+    process = subprocess.run(["pdfunite", *products, name], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             cwd=rows_path)
+    destination = os.path.join(rows_path, name)
+    if process.returncode != 0 or not os.path.exists(destination):
+        logging.info("Merging the rows into %s failed: %s", name, process.stderr.decode(errors="replace"))
+        return None
+    return destination
+
+
+def _compile_session(session: Session, source_path: str, format_cache: FormatCache,
+                     limits: CompileLimits, job: str = None, row: Dict = None,
+                     library: TemplateLibrary = None) -> RenderResult:
+    """ Render and compile a session's source tree, which may be a staged copy of it, and perform any image conversion
+    the session asked for. For a row of a batch session, the job names the compiler's output files and the row's data
+    is rendered into the templates. """
+    # The image conversions are run under the same limits as the compiler, and within what is left of its wall time
+    deadline = time.monotonic() + limits.timeout if limits.timeout > 0 else None
+    result = _render_and_compile(job or session.key, session.compiler, session.target, source_path,
+                                 session.template_files.root_path, format_cache, session.fail_fast, limits, row,
+                                 library)
+    if not result.success or session.convert is None:
+        return result
+
+    # With a list of conversions the pdf stays the product, and the conversions are made from it at the same time
+    if isinstance(session.convert, list):
+        logging.info("%i image conversions requested on session %s", len(session.convert), job or session.key)
+        outputs = _convert_outputs(result.product, session.convert, job or session.key, limits, deadline)
+        if all(outputs):
+            return result._replace(outputs=outputs)
+        return result._replace(success=False, product=None, reason=STOP_CONVERSION_FAILED)
+
+    logging.info("An image conversion to %s at %i dpi requested on session %s", session.convert["format"],
+                 session.convert["dpi"], job or session.key)
+    convert_result = _convert_image(result.product, session.convert["format"], session.convert["dpi"],
+                                    session.convert.get("pages"), limits=limits, deadline=deadline)
+    if convert_result:
+        return result._replace(product=convert_result)
+    return result._replace(success=False, product=None, reason=STOP_CONVERSION_FAILED)
+
+
+def _compile_info(result: RenderResult) -> Dict:
+    """ The record of how a compilation went which is stored with the session """
+    return {"passes": result.passes, "reason": result.reason}
+
+
+def _compile_limits(session_limits: Dict = None) -> CompileLimits:
+    """ Combine the compile limits from the configuration with the lower limits a session may have asked for. A value
+    of zero means that there is no limit. """
+    values = {}
+    for name, setting in LIMIT_SETTINGS.items():
+        value = int(getattr(ConfigBase, setting))
+        requested = (session_limits or {}).get(name)
+        if requested is not None:
+            value = min(value, requested) if value > 0 else requested
+        values[name] = value
+    return CompileLimits(**values)
+
+
+def _resource_limiter(limits: CompileLimits):
+    """ Create the function run in the child process before the compiler starts, which applies the kernel enforced
+    limits on cpu time, address space and the size of any file written """
+    def apply_limits():
+        if limits.cpu > 0:
+            # The soft limit delivers SIGXCPU, the hard limit a second later is the backstop
+            resource.setrlimit(resource.RLIMIT_CPU, (limits.cpu, limits.cpu + 1))
+        if limits.memory > 0:
+            memory_bytes = limits.memory * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+        if limits.file_size > 0:
+            file_bytes = limits.file_size * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_FSIZE, (file_bytes, file_bytes))
+    return apply_limits
+
+
+def _run_limited(command: List[str], cwd: str, limits: CompileLimits, deadline: float) -> Tuple[int, str]:
+    """
+    Run a compiler or pdftoppm subprocess under the given limits, where the deadline is a time.monotonic() value by
+    which it must be finished.  The process is started in a session of its own so that if it has to be stopped,
+    everything it spawned is killed along with it.  Returns the exit code and, if a limit was hit, the reason for stopping.
+    """
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, cwd=cwd, start_new_session=True,
+                               preexec_fn=_resource_limiter(limits))
+    usage = None
+    try:
+        usage = _wait_for_exit(process, deadline)
+    finally:
+        # Kill anything left in the process group, which is everything when the compiler itself is still running
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        process.wait()
+
+    if usage is None:
+        return process.returncode, STOP_TIMEOUT
+
+    reason = None
+    if process.returncode < 0:
+        killed_by = -process.returncode
+        if killed_by == signal.SIGXCPU and limits.cpu > 0:
+            reason = STOP_CPU_LIMIT
+        elif killed_by == signal.SIGKILL:
+            # The hard cpu limit and the kernel's OOM killer both end the process with SIGKILL, and only the first
+            # leaves it having used up its cpu time
+            cpu_used = usage.ru_utime + usage.ru_stime
+            reason = STOP_CPU_LIMIT if 0 < limits.cpu <= cpu_used else STOP_MEMORY_LIMIT
+        elif killed_by == signal.SIGXFSZ:
+            reason = STOP_FILE_SIZE_LIMIT
+        elif killed_by in (signal.SIGSEGV, signal.SIGABRT, signal.SIGBUS) and limits.memory > 0:
+            reason = STOP_MEMORY_LIMIT
+
+    return process.returncode, reason
+
+
+def _wait_for_exit(process: subprocess.Popen, deadline: float):
+    """ Wait for a process to exit, reaping it with wait4 so that the cpu time it used is known. Returns its resource
+    usage, or None if the deadline passed first and the process is still running. """
+    delay = 0.0005
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid == process.pid:
+            process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            return usage
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        # Poll as subprocess does while waiting with a timeout, backing off up to 50 ms between checks
+        delay = min(delay * 2, 0.05)
+        time.sleep(delay if deadline is None else min(delay, max(deadline - time.monotonic(), 0)))
+
+
+def _result_cache(client, working_directory: str, instance_key: str) -> ResultCache:
+    """ Create the result cache shared by the workers of an instance, or return None if it has been disabled """
+    max_bytes = int(ConfigBase.RESULT_CACHE_MAX_MB) * 1024 * 1024
+    if max_bytes <= 0:
+        return None
+    return ResultCache(os.path.join(working_directory, RESULT_CACHE_DIRECTORY), max_bytes, client,
+                       stats_key(instance_key))
+
+
+def _format_cache(working_directory: str) -> FormatCache:
+    """ Create the preamble format store shared by the workers of an instance, or return None if it has been
+    disabled """
+    max_bytes = int(ConfigBase.FORMAT_CACHE_MAX_MB) * 1024 * 1024
+    if max_bytes <= 0:
+        return None
+    return FormatCache(os.path.join(working_directory, FORMAT_CACHE_DIRECTORY), max_bytes)
+
+
+def _scratch_space() -> ScratchSpace:
+    """ Create the worker's local scratch directory for compiling in, or return None if it has not been configured """
+    max_mb = int(ConfigBase.SCRATCH_MAX_MB)
+    if not ConfigBase.SCRATCH_DIRECTORY or max_mb <= 0:
+        return None
+    return ScratchSpace(ConfigBase.SCRATCH_DIRECTORY, max_mb * 1024 * 1024)
+
+
+def _enable_bytecode_cache(working_directory: str):
+    """ Give the template environment a bytecode cache in the working directory, if it doesn't have one yet """
+    if _latex_env.bytecode_cache is None:
+        bytecode_path = os.path.join(working_directory, TEMPLATE_BYTECODE_DIRECTORY)
+        os.makedirs(bytecode_path, exist_ok=True)
+        _latex_env.bytecode_cache = TemplateBytecodeCache(bytecode_path)
+
+
+def precompile_template(client, working_directory: str, instance_key: str, text: str):
+    """ Compile a template registered with the template library, so that its bytecode is already in the working
+    directory for the workers. Throws a ValueError if the template isn't valid. """
+    _enable_bytecode_cache(working_directory)
+    try:
+        _template_cache.get(text)
+    except jinja2.TemplateSyntaxError as e:
+        raise ValueError(f"template is not valid: {e.message} on line {e.lineno}")
+    finally:
+        _template_cache.flush_stats(client, template_stats_key(instance_key))
+
+
+def _render_templates(template_path: str, source_path: str, row: Dict = None, library: TemplateLibrary = None):
     """
     Locate all templates in the template path and render them all to their targets
-    in the source path
+    in the source path, with the values of a batch session's data row laid over the
+    data of each template. Templates which refer to the template library are rendered
+    from the worker's compiled copy, and only fetched from the library if there isn't one.
     """
     template_service = FileService(template_path)
     destination_service = FileService(source_path)
@@ -81,66 +552,322 @@ def _render_templates(template_path: str, source_path: str):
         with template_service.open(template_file, "r") as handle:
             data = json.loads(handle.read())
 
-        template: Template = _latex_env.from_string(data['text'])
-        rendered_text = template.render(**data['data'])
+        values = dict(data['data'], **(row or {}))
+        if 'template' in data:
+            if library is None:
+                raise TemplateUnavailable(f"template {data['template']} can't be rendered without the template "
+                                          "library")
+            rendered_text = _template_cache.render_by_digest(
+                data['digest'], lambda: library.text(data['template'], data['digest']), values)
+        else:
+            rendered_text = _template_cache.render(data['text'], values)
 
+        destination_service.remove(data['target'])
         with destination_service.open(data['target'], "w") as handle:
             handle.write(rendered_text)
 
 
-def _convert_image(target: str, format: str, dpi: int) -> str:
+def _convert_image(target: str, format: str, dpi: int, pages=None, name: str = None, limits: CompileLimits = None,
+                   deadline: float = None, slots: threading.Semaphore = None) -> str:
+    """ Convert pages of a pdf to images in the same directory, returning the image when a single page was converted,
+    or a zip of the images in page order when there were several. Only the first page is converted unless the pages
+    are given as "all" or as a [first, last] range, which is cut to the pages the document has. The files are named
+    after the pdf unless another name is given. Each pdftoppm process runs under the limits and must finish by the
+    deadline, and holds one of the slots while it runs. Returns None if the conversion fails or would render more
+    pages times dpi than the server allows. """
+    limits = limits or _compile_limits()
+    slots = slots or threading.BoundedSemaphore(_convert_processes())
     working_dir, file_name = os.path.split(target)
-    target_base, _ = os.path.splitext(file_name)
-    command = ["pdftoppm", "-singlefile", f"-{format}", "-r", f"{dpi}",
-               file_name, target_base]
+    target_base = name or os.path.splitext(file_name)[0]
+    first, last = (1, 1) if pages is None else (1, None) if pages == "all" else pages
+
+    if pages is not None:
+        page_count = _page_count(target)
+        if page_count is None or first > page_count:
+            return None
+        last = page_count if last is None else min(last, page_count)
 
-    # Determine the files in the directory before running the conversion
-    original_files = os.listdir(working_dir)
+    max_page_dpi = int(ConfigBase.CONVERT_MAX_PAGE_DPI)
+    if 0 < max_page_dpi < (last - first + 1) * dpi:
+        logging.info("Converting %i pages of %s at %i dpi is over the limit of %i pages times dpi", last - first + 1,
+                     file_name, dpi, max_page_dpi)
+        return None
 
-    # Run the conversion command
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=working_dir)
-    stdout, stderr = process.communicate()
+    if first == last:
+        converted = os.path.join(working_dir, f"{target_base}.{IMAGE_EXTENSIONS[format]}")
+        if os.path.exists(converted):
+            os.remove(converted)
+        command = ["pdftoppm", "-singlefile", f"-{format}", "-r", f"{dpi}", "-f", f"{first}", "-l", f"{first}",
+                   file_name, target_base]
+        with slots:
+            return_code, limit_reason = _run_limited(command, working_dir, limits, deadline)
+        if return_code != 0:
+            logging.info("Converting page %i of %s failed with code %i (%s)", first, file_name, return_code,
+                         limit_reason)
+            return None
+        return converted if os.path.exists(converted) else None
 
-    # Find the new file
-    new_files = [f for f in os.listdir(working_dir) if f not in original_files]
-    if len(new_files) != 1:
+    images = _convert_pages(target, format, dpi, first, last, target_base, limits, deadline, slots)
+    if images is None:
         return None
 
-    return os.path.join(working_dir, new_files[0])
+    # Jpeg and png images are already compressed, so they are stored in the zip as they are
+    destination = os.path.join(working_dir, f"{target_base}.zip")
+    compression = zipfile.ZIP_DEFLATED if format == "tiff" else zipfile.ZIP_STORED
+    with zipfile.ZipFile(destination, "w", compression) as archive:
+        for image in images:
+            archive.write(image, os.path.basename(image))
+    return destination
+
+
+def _convert_outputs(target: str, conversions: List[Dict], name: str, limits: CompileLimits = None,
+                     deadline: float = None) -> List[str]:
+    """ Make each of a list of image conversions from one pdf at the same time, naming the files of each one
+    <name>-<index>. Returns the converted files in the order of the conversions, with None for any which failed. """
+    # The conversions share one set of slots, so that together they run no more pdftoppm processes than one would
+    slots = threading.BoundedSemaphore(_convert_processes())
+
+    def convert(index: int) -> str:
+        conversion = conversions[index]
+        return _convert_image(target, conversion["format"], conversion["dpi"], conversion.get("pages"),
+                              f"{name}-{index}", limits, deadline, slots)
+
+    with ThreadPoolExecutor(max_workers=len(conversions)) as pool:
+        return list(pool.map(convert, range(len(conversions))))
+
+
+def _convert_pages(target: str, format: str, dpi: int, first: int, last: int, name: str, limits: CompileLimits,
+                   deadline: float, slots: threading.Semaphore) -> List[str]:
+    """ Convert the pages from first to last of a pdf to images named <name>-<page>, with the page number padded to
+    the same width for every page, returning their paths in page order or None if any page fails. The pages are split
+    into contiguous ranges which are converted at the same time, each by its own pdftoppm process holding one of the
+    slots. """
+    working_dir, file_name = os.path.split(target)
+    target_base = name
+    extension = IMAGE_EXTENSIONS[format]
+    chunks = _page_chunks(first, last, _convert_processes())
+
+    # Each range is written to a directory of its own, where pdftoppm's own names sort in page order, and the images
+    # are renamed from there, so no other files in the working directory are mistaken for them
+    output_path = tempfile.mkdtemp(prefix=f".{target_base}-pages-", dir=working_dir)
+
+    def convert_chunk(chunk: Tuple[int, int]) -> List[str]:
+        chunk_path = os.path.join(output_path, str(chunk[0]))
+        os.makedirs(chunk_path)
+        command = ["pdftoppm", f"-{format}", "-r", f"{dpi}", "-f", f"{chunk[0]}", "-l", f"{chunk[1]}",
+                   os.path.abspath(target), os.path.join(chunk_path, "page")]
+        with slots:
+            return_code, limit_reason = _run_limited(command, working_dir, limits, deadline)
+        written = sorted(os.listdir(chunk_path))
+        if return_code != 0 or len(written) != chunk[1] - chunk[0] + 1:
+            logging.info("Converting pages %i to %i of %s failed with code %i (%s)", chunk[0], chunk[1], file_name,
+                         return_code, limit_reason)
+            return None
+        return [os.path.join(chunk_path, name) for name in written]
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+            converted = list(pool.map(convert_chunk, chunks))
+        if any(c is None for c in converted):
+            return None
+
+        width = len(str(last))
+        images = []
+        for page, image in enumerate(itertools.chain.from_iterable(converted), first):
+            destination = os.path.join(working_dir, f"{target_base}-{page:0{width}d}.{extension}")
+            os.replace(image, destination)
+            images.append(destination)
+        return images
+    finally:
+        shutil.rmtree(output_path, True)
+
+
+def _convert_processes() -> int:
+    """ The most pdftoppm processes the image conversions of one compilation run at the same time """
+    return int(ConfigBase.CONVERT_PROCESSES) or os.cpu_count() or 1
+
+
+def _page_chunks(first: int, last: int, processes: int) -> List[Tuple[int, int]]:
+    """ Split the pages from first to last into at most the given number of contiguous (first, last) ranges of as
+    nearly equal length as they can be """
+    count = max(1, min(processes, last - first + 1))
+    size, extra = divmod(last - first + 1, count)
+    chunks = []
+    start = first
+    for i in range(count):
+        stop = start + size + (1 if i < extra else 0) - 1
+        chunks.append((start, stop))
+        start = stop + 1
+    return chunks
+
+
+def _page_count(target: str) -> int:
+    """ The number of pages in a pdf according to poppler's pdfinfo, or None if it can't be read """
+    process = subprocess.run(["pdfinfo", target], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    for line in process.stdout.decode(errors="replace").splitlines():
+        if line.startswith("Pages:"):
+            return int(line.split(":", 1)[1])
+    return None
+
+
+def _prepare_format(format_cache: FormatCache, format_name: str, compiler: str, target: str,
+                    source_path: str, limits: CompileLimits, deadline: float) -> str:
+    """
+    Place a precompiled format of the target's preamble in the source path under the given name, building it and
+    adding it to the format cache first if it isn't already there.  Returns the digest of the preamble, or None if no
+    format could be prepared and the compiler should be run from its standard format.
+    """
+    digest = preamble_digest(compiler, source_path, target)
+    if digest is None or format_cache.has_failed(digest):
+        return None
+
+    destination = os.path.join(source_path, f"{format_name}.fmt")
+    if format_cache.fetch(digest, destination):
+        return digest
+
+    # Dump the preamble into a new format with mylatexformat, which stops at \begin{document}. The build happens in a
+    # private directory so that concurrent builds of the same preamble can't collide.
+    logging.info("Building %s format for preamble %s", compiler, digest)
+    build_path = tempfile.mkdtemp(prefix=".build-", dir=format_cache.root_path)
+    try:
+        command = [compiler, "-ini", "-interaction=nonstopmode", f"-jobname={digest}",
+                   f"-output-directory={build_path}", f"&{compiler}", "mylatexformat.ltx", target]
+        return_code, limit_reason = _run_limited(command, source_path, limits, deadline)
+        if limit_reason is not None:
+            logging.info("Building a format for preamble %s stopped: %s", digest, limit_reason)
+            return None
+
+        built_format = os.path.join(build_path, f"{digest}.fmt")
+        if return_code != 0 or not os.path.exists(built_format):
+            logging.info("Could not build a format for preamble %s", digest)
+            format_cache.mark_failed(digest)
+            return None
+        format_cache.store(digest, built_format)
+    finally:
+        shutil.rmtree(build_path, True)
+
+    return digest if format_cache.fetch(digest, destination) else None
+
+
+def _auxiliary_digests(source_path: str, session_id: str) -> Dict[str, str]:
+    """ Hash the auxiliary files of a compilation job. The job's own files are named after the job, while each file
+    pulled in with \\include writes an .aux file of its own alongside it. """
+    names = [f"{session_id}{ext}" for ext in AUXILIARY_EXTENSIONS]
+    for root, _, files in os.walk(source_path):
+        for f in files:
+            relative_path = os.path.relpath(os.path.join(root, f), source_path)
+            if f.endswith(".aux") and relative_path not in names:
+                names.append(relative_path)
+
+    digests = {}
+    for name in names:
+        path = os.path.join(source_path, name)
+        if os.path.isfile(path):
+            with open(path, "rb") as handle:
+                digests[name] = hashlib.sha256(handle.read()).hexdigest()
+    return digests
 
 
 def _render_and_compile(session_id: str, compiler: str, target: str, source_path: str,
-                        template_path: str) -> RenderResult:
+                        template_path: str, format_cache: FormatCache = None, fail_fast: bool = False,
+                        limits: CompileLimits = None, row: Dict = None,
+                        library: TemplateLibrary = None) -> RenderResult:
     if compiler not in COMPILERS:
         raise ValueError(f"compiler '{compiler}' not supported")
 
+    # The wall time limit covers the whole compilation, from building a preamble format to the final pass
+    limits = limits or _compile_limits()
+    deadline = time.monotonic() + limits.timeout if limits.timeout > 0 else None
+
     # Render any templates
-    _render_templates(template_path, source_path)
+    _render_templates(template_path, source_path, row, library)
 
     command = [compiler,
                "-interaction=nonstopmode",
+               "-file-line-error",
                f"-jobname={session_id}",
                target]
 
-    # I'm not sure how many times a latex compiler should reasonably have to run in order to handle
-    # a complex case, so I've conservatively set it to time out at 5
-    run_count = 0
-    expected_log = None  # prevent linting ref-before-assignment warning
-    while run_count < 5:
+    # In fail-fast mode the compiler gives up at the first error instead of trying to carry on through the document
+    if fail_fast:
+        command.insert(1, "-halt-on-error")
+
+    # If possible, start every pass from a precompiled format of the preamble rather than loading it each time
+    format_digest = None
+    if format_cache is not None and compiler in FORMAT_COMPILERS:
+        format_name = f"{session_id}-preamble"
+        format_digest = _prepare_format(format_cache, format_name, compiler, target, source_path, limits, deadline)
+        if format_digest is not None:
+            command.insert(1, f"-fmt={format_name}")
+
+    # Run the compiler until the auxiliary files it reads back in on the next pass stop changing, or until nothing in
+    # the log asks for another pass.  Listings such as the table of contents are never announced in the log, so a
+    # change to one of those always calls for another pass.
+    max_passes = int(ConfigBase.MAX_COMPILE_PASSES)
+    max_diagnostics = int(ConfigBase.MAX_DIAGNOSTICS)
+    summary = None
+    expected_log = os.path.join(source_path, f"{session_id}.log")
+    previous = _auxiliary_digests(source_path, session_id)
+    passes = 0
+    while True:
         # Run the compiler
-        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, cwd=source_path)
-        process.wait()
-        run_count += 1
+        return_code, limit_reason = _run_limited(command, source_path, limits, deadline)
+        passes += 1
+
+        # Some packages don't survive being dumped into a format.  If the first pass against the format fails, start
+        # over from the standard format, and if that works then the format is to blame and shouldn't be used again.
+        if format_digest is not None and passes == 1 and return_code != 0 and limit_reason is None:
+            logging.info("First pass with preamble format %s failed, retrying without it", format_digest)
+            command = [c for c in command if not c.startswith("-fmt=")]
+            return_code, limit_reason = _run_limited(command, source_path, limits, deadline)
+            if return_code == 0:
+                format_cache.mark_failed(format_digest)
+            format_digest = None
+
+        if limit_reason is not None:
+            reason = limit_reason
+            break
 
-        # Check the log file to determine if a re-run is necessary
-        expected_log = os.path.join(source_path, f"{session_id}.log")
-        with open(expected_log, "r") as handle:
-            if "Rerun" not in handle.read():
-                break
+        summary = scan_log(expected_log, max_diagnostics) if os.path.exists(expected_log) else None
+        if fail_fast and summary is not None and summary.error_count > 0:
+            reason = STOP_FATAL_ERROR
+            break
+
+        current = _auxiliary_digests(source_path, session_id)
+        if current == previous:
+            reason = STOP_CONVERGED
+            break
+
+        listings_changed = any(current.get(k) != previous.get(k) for k in current.keys() | previous.keys()
+                               if k.endswith(LISTING_EXTENSIONS))
+        if not listings_changed and (summary is None or not summary.rerun):
+            reason = STOP_NO_RERUN
+            break
+
+        if passes >= max_passes:
+            reason = STOP_PASS_LIMIT
+            break
+
+        previous = current
+
+    logging.info("Compiler ran %i time(s) on session %s, stopped because: %s", passes, session_id, reason)
 
     expected_product = os.path.join(source_path, f"{session_id}.pdf")
+    diagnostics = _diagnostics(summary)
 
-    if os.path.exists(expected_product):
-        return RenderResult(success=True, product=expected_product, log=expected_log)
+    if os.path.exists(expected_product) and reason in (STOP_CONVERGED, STOP_NO_RERUN, STOP_PASS_LIMIT):
+        return RenderResult(success=True, product=expected_product, log=expected_log, passes=passes, reason=reason,
+                            diagnostics=diagnostics)
     else:
-        return RenderResult(success=False, product=None, log=expected_log)
+        return RenderResult(success=False, product=None, log=expected_log, passes=passes, reason=reason,
+                            diagnostics=diagnostics)
+
+
+def _diagnostics(summary: LogSummary) -> Dict:
+    """ The structured errors and warnings from the log of the final pass, as they are stored with the session """
+    if summary is None:
+        return None
+    return {"errors": summary.errors,
+            "warnings": summary.warnings,
+            "error_count": summary.error_count,
+            "warning_count": summary.warning_count}
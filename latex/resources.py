@@ -0,0 +1,105 @@
+"""
+    The documents the API describes a session with.  The session resource is the session's public data along with
+    links to its product, image conversions, log, diagnostics, rows and events, and the forms a client fills in to add
+    files, templates and rows to it and to finalize it.  It is returned by GET requests to the session's url, and is
+    also the body POSTed to the session's callback url once it has been compiled, so the links are built from the
+    session's url given by the caller, which is relative for the API and absolute for callbacks, rather than by Flask.
+
+"""
+from typing import Dict
+
+
+def external_session_url(base_url: str, session_id: str) -> str:
+    """ The url of a session under a base url, which may be empty for a url relative to the server's root """
+    return f"{base_url.rstrip('/')}/api/sessions/{session_id}"
+
+
+def session_resource(session, session_url: str) -> Dict:
+    """ The public session data, with links to the session's log, product and diagnostics where they exist """
+    response = dict(session.public)
+    if session.product is not None:
+        response['product'] = {"href": f"{session_url}/product"}
+    if session.outputs is not None:
+        response['outputs'] = [dict(conversion, href=f"{session_url}/outputs/{index}")
+                               for index, conversion in enumerate(session.convert)]
+    if session.log is not None:
+        response['log'] = {"href": f"{session_url}/log"}
+    if session.diagnostics is not None:
+        response['diagnostics'] = {"href": f"{session_url}/diagnostics"}
+    if session.row_count:
+        response['rows'] = dict(response['rows'], href=f"{session_url}/rows")
+    response['events'] = {"href": f"{session_url}/events"}
+    return response
+
+
+def session_forms(session_url: str) -> Dict:
+    """ The forms for adding files, templates and rows to a session and for finalizing it """
+    return {
+        "add_file": {
+            "href": f"{session_url}/files",
+            "rel": ["create-form"],
+            "method": "POST",
+            "value": [
+                {"label": "upload file(s) with multipart/form-data, filename is used to specify path"}
+            ]
+        },
+        "link_files": {
+            "href": f"{session_url}/files/link",
+            "rel": ["create-form"],
+            "method": "POST",
+            "value": [
+                {"name": "files", "required": True,
+                 "label": "list of {'path': path, 'sha256': digest} for files which may already be on the server, "
+                          "the ones which aren't are returned and must be uploaded"}
+            ]
+        },
+        "add_archive": {
+            "href": f"{session_url}/archive",
+            "rel": ["create-form"],
+            "method": "POST",
+            "value": [
+                {"label": "upload a tar, tar.gz, tar.bz2, tar.xz or zip archive as the request body to extract it "
+                          "into the source files"}
+            ]
+        },
+        "add_templates": {
+            "href": f"{session_url}/templates",
+            "rel": ["create-form"],
+            "method": "POST",
+            "value": [
+                {"name": "target", "required": True, "label": "target path/filename to render the template to"},
+                {"name": "text", "required": False, "label": "latex text to be rendered by jinja2"},
+                {"name": "template", "required": False,
+                 "label": "id of a template in the template library, to use in place of 'text'"},
+                {"name": "data", "required": True, "label": "json dictionary to be rendered into the template"}
+            ]
+        },
+        "add_rows": {
+            "href": f"{session_url}/rows",
+            "rel": ["create-form"],
+            "method": "POST",
+            "value": [
+                {"name": "rows", "required": True,
+                 "label": "list of data dictionaries, one document is compiled for each with its values laid over "
+                          "the data of every template"},
+                {"name": "output", "required": False,
+                 "label": "'zip' for a zip of the documents, or 'pdf' to merge them into one, defaults to 'zip'"}
+            ]
+        },
+        "finalize": {
+            "href": session_url,
+            "rel": ["edit-form"],
+            "method": "POST",
+            "value": [
+                {"name": "finalize", "required": False,
+                 "label": "set true to finalize the session and release it to the compiler"}
+            ]
+        }
+    }
+
+
+def session_document(session, session_url: str) -> Dict:
+    """ The document describing a session which is returned for its url: the session resource and its forms """
+    document = session_resource(session, session_url)
+    document.update(session_forms(session_url))
+    return document
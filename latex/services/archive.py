@@ -0,0 +1,132 @@
+"""
+    Reading of uploaded archives of source files, a tar (optionally gzip, bzip2 or xz compressed) or a zip, as a stream
+    of (path, file object) members which can be written into a session one at a time.
+
+    Tar archives are read in tarfile's stream mode, directly from the request body, so that no more than one block of
+    the archive is held in memory at a time.  The zip format keeps its directory at the end of the file, so zip uploads
+    are first spooled to a temporary file, which stays in memory only while it is small.
+
+    Only regular files and directories are accepted, since links and device files in an upload could only be used to
+    reach outside of the session.  Limits on the number of files and on their total uncompressed size are enforced
+    while the archive is read, so an archive which expands far beyond its upload size is stopped as soon as it passes
+    the limit rather than after it has been written out.
+
+"""
+import lzma
+import stat
+import zlib
+import shutil
+import tarfile
+import zipfile
+import tempfile
+from typing import BinaryIO, Iterator, Tuple
+
+_ZIP_MAGIC = b"PK\x03\x04"
+_EMPTY_ZIP_MAGIC = b"PK\x05\x06"
+_SPOOL_MEMORY_BYTES = 8 * 1024 * 1024
+_CHUNK_SIZE = 1024 * 1024
+
+# The errors the decompressors and archive readers raise on a corrupt or truncated upload
+_READ_ERRORS = (tarfile.TarError, zipfile.BadZipFile, EOFError, zlib.error, lzma.LZMAError, OSError)
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+class _PrefixedStream:
+    """ A readable stream which gives back some bytes already read from another stream before the rest of it """
+    def __init__(self, prefix: bytes, stream: BinaryIO):
+        self._prefix = prefix
+        self._stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if not self._prefix:
+            return self._stream.read(size)
+        if size is None or size < 0:
+            data, self._prefix = self._prefix + self._stream.read(), b""
+            return data
+        data, self._prefix = self._prefix[:size], self._prefix[size:]
+        if len(data) < size:
+            data += self._stream.read(size - len(data))
+        return data
+
+
+class _Budget:
+    """ The number of uncompressed bytes an archive may still expand to, shared by all of its members """
+    def __init__(self, max_bytes: int):
+        self.remaining = max_bytes
+        self.max_bytes = max_bytes
+
+    def spend(self, count: int):
+        self.remaining -= count
+        if self.remaining < 0:
+            raise ArchiveError(f"Archive expands to more than the limit of {self.max_bytes} bytes")
+
+
+class _LimitedReader:
+    """ Reads a member of an archive, charging every byte read to the archive's budget """
+    def __init__(self, stream: BinaryIO, budget: _Budget):
+        self._stream = stream
+        self._budget = budget
+
+    def read(self, size: int = -1) -> bytes:
+        try:
+            data = self._stream.read(size)
+        except _READ_ERRORS as e:
+            raise ArchiveError(f"Could not read archive: {e}")
+        self._budget.spend(len(data))
+        return data
+
+
+def read_archive(stream: BinaryIO, max_members: int, max_bytes: int) -> Iterator[Tuple[str, BinaryIO]]:
+    """ Iterate over the regular files in an archive read from a stream, giving the path of each along with a file
+    object for its content, which must be read before moving on to the next member. Throws an ArchiveError if the
+    archive is invalid, holds something other than files and directories, or goes over either limit. """
+    magic = stream.read(4)
+    stream = _PrefixedStream(magic, stream)
+    budget = _Budget(max_bytes)
+    if magic in (_ZIP_MAGIC, _EMPTY_ZIP_MAGIC):
+        members = _read_zip(stream, max_bytes, budget)
+    else:
+        members = _read_tar(stream, budget)
+
+    for count, (path, reader) in enumerate(members, 1):
+        if count > max_members:
+            raise ArchiveError(f"Archive contains more than the limit of {max_members} files")
+        yield path, reader
+
+
+def _read_tar(stream: BinaryIO, budget: _Budget) -> Iterator[Tuple[str, BinaryIO]]:
+    try:
+        with tarfile.open(fileobj=stream, mode="r|*") as archive:
+            for member in archive:
+                if member.isdir():
+                    continue
+                if not member.isfile():
+                    raise ArchiveError(f"Archive member {member.name} is not a regular file or directory")
+                yield member.name, _LimitedReader(archive.extractfile(member), budget)
+    except _READ_ERRORS as e:
+        raise ArchiveError(f"Could not read tar archive: {e}")
+
+
+def _read_zip(stream: BinaryIO, max_bytes: int, budget: _Budget) -> Iterator[Tuple[str, BinaryIO]]:
+    with tempfile.SpooledTemporaryFile(max_size=_SPOOL_MEMORY_BYTES) as spooled:
+        # A zip can't be larger than its content plus its headers, so the upload is held to the same budget
+        upload_budget = _Budget(max_bytes + _SPOOL_MEMORY_BYTES)
+        shutil.copyfileobj(_LimitedReader(stream, upload_budget), spooled, _CHUNK_SIZE)
+        spooled.seek(0)
+
+        try:
+            with zipfile.ZipFile(spooled) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        continue
+                    # Unix attributes are optional in a zip, and many writers leave out the file type bits
+                    file_type = stat.S_IFMT(info.external_attr >> 16)
+                    if file_type and file_type != stat.S_IFREG:
+                        raise ArchiveError(f"Archive member {info.filename} is not a regular file or directory")
+                    with archive.open(info) as member:
+                        yield info.filename, _LimitedReader(member, budget)
+        except (zipfile.LargeZipFile, ) + _READ_ERRORS as e:
+            raise ArchiveError(f"Could not read zip archive: {e}")
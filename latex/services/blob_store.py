@@ -0,0 +1,111 @@
+"""
+    The BlobStore is a content-addressed store of source files shared by every session of an instance.  Every file
+    uploaded to a session is hard linked into the store under its SHA-256 digest, so when a later session needs a file
+    with the same content (the same fonts, logos and bibliographies are sent with many sessions) the client can send
+    just the digest and the stored file is hard linked into the new session's source tree instead of uploaded again.
+
+    Since the store and the sessions share inodes, the link count of a stored file is the reference count: a blob with
+    a link count of one is referenced by no session.  Stored files are made read-only, and anything which writes into a
+    session's source tree must replace files rather than write into them, so that one session can never change the
+    content of a file another session links to.  The read-only mode means nothing to a compiler running as root, and
+    TeX rewrites any file it opens for output in place, such as an uploaded .aux file, so before anything is compiled
+    in a tree the files the compiler may write are unshared with unshare_tree.  Every other file, such as a large font
+    or image, stays linked to its blob.
+
+    When sessions are deleted, the blobs they referenced which are left unreferenced are reported back to the caller,
+    which keeps them for a retention period in case another session asks for them before they are removed.
+
+"""
+import os
+import stat
+import shutil
+from typing import Callable, Iterable, List
+
+
+def _is_digest(digest: str) -> bool:
+    return isinstance(digest, str) and len(digest) == 64 and all(c in "0123456789abcdef" for c in digest)
+
+
+def unshare_tree(root_path: str, writable: Callable[[str], bool]):
+    """ Replace each file under a directory whose name the writable function accepts, and which shares its inode with
+    another path such as a blob linked from the store, with a private copy, so that whatever is written into it can't
+    change the stored blob or the files of other sessions """
+    for root, _, files in os.walk(root_path):
+        for f in files:
+            path = os.path.join(root, f)
+            if not writable(f) or os.lstat(path).st_nlink <= 1:
+                continue
+            temp_path = os.path.join(root, f".{f}.{os.getpid()}.unshare")
+            shutil.copyfile(path, temp_path)
+            os.replace(temp_path, path)
+
+
+class BlobStore:
+    def __init__(self, root_path: str):
+        if not os.path.isdir(root_path):
+            os.makedirs(root_path, exist_ok=True)
+        self.root_path = root_path
+
+    def path(self, digest: str) -> str:
+        if not _is_digest(digest):
+            raise ValueError(f"'{digest}' is not a SHA-256 hex digest")
+        return os.path.join(self.root_path, digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        return _is_digest(digest) and os.path.exists(self.path(digest))
+
+    def add(self, file_path: str, digest: str):
+        """ Hard link a file whose content has the given digest into the store, unless the store already has it.  The
+        file is made read-only, since from here on its inode may be shared with other sessions. """
+        blob_path = self.path(digest)
+        os.chmod(file_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        if os.path.exists(blob_path):
+            return
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        try:
+            os.link(file_path, blob_path)
+        except FileExistsError:
+            # Another session stored the same content in the meantime
+            pass
+
+    def link_into(self, digest: str, destination: str) -> bool:
+        """ Hard link a stored blob to the destination path, replacing anything already there. Returns False if the
+        store doesn't have the blob. """
+        if not self.has(digest):
+            return False
+
+        # Link under a temporary name and rename over the destination, so that an existing file at the destination is
+        # replaced rather than written into
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        temp_path = os.path.join(os.path.dirname(destination), f".{os.path.basename(destination)}.{os.getpid()}.tmp")
+        try:
+            os.link(self.path(digest), temp_path)
+        except FileNotFoundError:
+            # The blob was removed between the check and the link
+            return False
+        except FileExistsError:
+            os.remove(temp_path)
+            os.link(self.path(digest), temp_path)
+        os.replace(temp_path, destination)
+        return True
+
+    def unreferenced(self, digests: Iterable[str]) -> List[str]:
+        """ Find which of the given blobs are no longer linked into any session """
+        found = []
+        for digest in set(digests):
+            try:
+                if os.stat(self.path(digest)).st_nlink <= 1:
+                    found.append(digest)
+            except (OSError, ValueError):
+                pass
+        return found
+
+    def remove_unreferenced(self, digest: str) -> bool:
+        """ Remove a blob if no session links to it, returning whether it was removed """
+        if digest not in self.unreferenced([digest]):
+            return False
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            return False
+        return True
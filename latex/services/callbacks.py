@@ -0,0 +1,206 @@
+"""
+    Delivery of completion callbacks.  A session created with a callback url has its final session document POSTed to
+    that url as json once it has been compiled, whether it succeeded or failed.
+
+    The notifications waiting to be delivered are kept in a Redis sorted set scored by the time each is next due.  They
+    are added in the same transaction which saves the session's final status, so none can be lost between the status
+    change and the delivery.  A delivery task claims the notifications which are due, leasing them so that no other
+    worker sends them at the same time, and sends the ones for the same host one after another over a single kept-alive
+    connection.  A notification which isn't accepted with a 2xx response is put back with a delay which doubles on
+    every attempt, until it has been tried the configured number of times.  A host which can't be reached fails the rest
+    of its batch without each being tried.
+
+    Callback urls are given by clients, so a host is resolved when its batch is delivered and the connection is made to
+    the address which was checked.  Hosts resolving to loopback, private, link-local or other non-public addresses (the
+    cloud metadata service, the Redis server) are refused and their notifications dropped, unless they are among the
+    configured allowed hosts.
+
+    Delivery is at least once: if a worker stops while it holds a lease, the notifications are claimed again once the
+    lease runs out, so a receiver may see the same session document twice.
+
+"""
+import json
+import time
+import uuid
+import socket
+import logging
+import ipaddress
+import http.client
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from typing import Dict, Iterable, List, Tuple
+
+import redis
+
+from latex.config import ConfigBase
+
+# The most notifications claimed together by one delivery pass
+CLAIM_BATCH_SIZE = 50
+
+# Claims the due notifications by moving their scores forward to the end of a lease, so that a second worker doesn't
+# claim them too, and returns them
+_CLAIM_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, member in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[2], member)
+end
+return due
+"""
+
+
+def callbacks_key(instance_key: str) -> str:
+    """ The redis key of the sorted set of an instance's callback notifications, scored by when they are next due """
+    return f"{instance_key}:callbacks"
+
+
+def queue_callback(pipeline, instance_key: str, url: str, document: Dict, due: float):
+    """ Add a notification of a session document to be POSTed to a url, on a redis pipeline or client """
+    notification = {"id": uuid.uuid4().hex, "url": url, "attempts": 0, "document": document}
+    pipeline.zadd(callbacks_key(instance_key), {json.dumps(notification): due})
+
+
+def parse_allowed_hosts(setting: str) -> Tuple[str, ...]:
+    """ The host names in a comma separated setting of the hosts which callbacks may be sent to on a private network """
+    return tuple(host.strip().lower() for host in setting.split(",") if host.strip())
+
+
+def is_public_address(address: str) -> bool:
+    """ Whether an ip address is one on the public internet, rather than a loopback, private, link-local, multicast or
+    reserved one """
+    ip = ipaddress.ip_address(address.split("%")[0])
+    return ip.is_global and not ip.is_multicast
+
+
+def resolve_callback_host(host: str, port: int, allowed_hosts: Iterable[str]) -> str:
+    """ Resolve the host a callback is sent to, returning the address to connect to. Throws a ValueError if any of its
+    addresses isn't a public one and the host isn't one of the allowed hosts, and an OSError if it can't be resolved. """
+    addresses = [info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+    if host.lower() not in allowed_hosts:
+        for address in addresses:
+            if not is_public_address(address):
+                raise ValueError(f"{host} resolves to the non-public address {address}")
+    return addresses[0]
+
+
+class CallbackQueue:
+    def __init__(self, client, instance_key: str, timeout: float, retry_sec: float, max_attempts: int,
+                 allowed_hosts: Iterable[str] = ()):
+        self.client = client
+        self.key = callbacks_key(instance_key)
+        self.timeout = timeout
+        self.retry_sec = retry_sec
+        self.max_attempts = max_attempts
+        self.allowed_hosts = tuple(host.lower() for host in allowed_hosts)
+        self._claim = client.register_script(_CLAIM_SCRIPT)
+
+    def due_count(self, now: float) -> int:
+        return self.client.zcount(self.key, "-inf", now)
+
+    def claim(self, now: float, count: int) -> List[Tuple[bytes, Dict]]:
+        """ Claim up to count of the notifications due at the given time, returning each stored member along with the
+        notification it holds. The claim lasts long enough for every one of them to time out. """
+        lease_end = now + self.timeout * (count + 1)
+        members = self._claim(keys=[self.key], args=[now, lease_end, count])
+        return [(member, json.loads(member)) for member in members]
+
+    def deliver_due(self, now: float, count: int = CLAIM_BATCH_SIZE) -> int:
+        """ Claim and deliver the notifications due at the given time, putting back the ones which fail for a later
+        attempt. Returns the number claimed. """
+        claimed = self.claim(now, count)
+        pipeline = self.client.pipeline()
+
+        # The notifications are grouped by host, keeping the order they were due in
+        by_host = OrderedDict()
+        for member, notification in claimed:
+            try:
+                parts = urlsplit(notification["url"])
+                by_host.setdefault((parts.scheme, parts.hostname, parts.port), []).append((member, notification))
+            except ValueError:
+                logging.warning("Dropping callback to the invalid url %s", notification["url"])
+                pipeline.zrem(self.key, member)
+
+        # Every claimed notification is removed or put back below, whatever happens to its batch, so that none is left
+        # leased to be claimed again without end
+        for (scheme, host, port), batch in by_host.items():
+            try:
+                address = resolve_callback_host(host, port, self.allowed_hosts)
+                results = _post_batch(scheme, host, port, address, [notification for _, notification in batch],
+                                      self.timeout)
+            except ValueError as e:
+                # A host which is refused, or which can't be connected to at all, would fail every retry in the same way
+                logging.warning("Dropping callbacks to %s: %s", host, e)
+                results = [True] * len(batch)
+            except Exception as e:
+                logging.info("Callback delivery to %s failed: %s", host, e)
+                results = [False] * len(batch)
+
+            for (member, notification), delivered in zip(batch, results):
+                pipeline.zrem(self.key, member)
+                if not delivered:
+                    self._retry(pipeline, notification, now)
+        pipeline.execute()
+        return len(claimed)
+
+    def _retry(self, pipeline, notification: Dict, now: float):
+        attempts = notification["attempts"] + 1
+        if attempts >= self.max_attempts:
+            logging.warning("Giving up on callback to %s for session %s after %i attempts", notification["url"],
+                            notification["document"].get("key"), attempts)
+            return
+        retry = dict(notification, attempts=attempts)
+        pipeline.zadd(self.key, {json.dumps(retry): now + self.retry_sec * 2 ** (attempts - 1)})
+
+
+def _post_batch(scheme: str, host: str, port: int, address: str, notifications: List[Dict],
+                timeout: float) -> List[bool]:
+    """ POST each notification's document to its url over one connection to their shared host at the given address,
+    returning whether each was accepted """
+    connection_type = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+    connection = connection_type(host, port, timeout=timeout)
+
+    # The connection is made to the address which was checked rather than resolving the host again, which could give a
+    # different one. The host name is still sent in the Host header and used to verify the server's certificate.
+    def create_connection(target, *args, **kwargs):
+        return socket.create_connection((address, target[1]), *args, **kwargs)
+
+    connection._create_connection = create_connection
+    results = []
+    try:
+        for notification in notifications:
+            parts = urlsplit(notification["url"])
+            path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+            body = json.dumps(notification["document"]).encode()
+            try:
+                connection.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+                response = connection.getresponse()
+                # The response must be read to the end before the connection can be used for the next request
+                response.read()
+            except (OSError, http.client.HTTPException) as e:
+                logging.info("Callback delivery to %s failed: %s", host, e)
+                break
+            results.append(200 <= response.status < 300)
+    finally:
+        connection.close()
+
+    # The notifications which weren't sent because the host couldn't be reached have failed as well
+    return results + [False] * (len(notifications) - len(results))
+
+
+def _queue(instance_key: str, client) -> CallbackQueue:
+    return CallbackQueue(client, instance_key, float(ConfigBase.CALLBACK_TIMEOUT_SEC),
+                         float(ConfigBase.CALLBACK_RETRY_SEC), int(ConfigBase.CALLBACK_MAX_ATTEMPTS),
+                         parse_allowed_hosts(ConfigBase.CALLBACK_ALLOWED_HOSTS))
+
+
+def pending_callbacks(instance_key: str, **kwargs) -> int:
+    """ The number of an instance's callback notifications which are due to be delivered now """
+    client = kwargs.get("redis_client") or redis.from_url(ConfigBase.REDIS_URL)
+    return _queue(instance_key, client).due_count(time.time())
+
+
+def deliver_callbacks(instance_key: str, **kwargs):
+    """ Deliver every callback notification of an instance which is due, for the periodic and post-compile tasks """
+    client = kwargs.get("redis_client") or redis.from_url(ConfigBase.REDIS_URL)
+    queue = _queue(instance_key, client)
+    while queue.deliver_due(time.time()) == CLAIM_BATCH_SIZE:
+        pass
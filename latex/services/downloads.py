@@ -0,0 +1,86 @@
+"""
+    Downloads of products, logs and image conversions are sent with a strong ETag, the SHA-256 digest of the file's
+    content, so that a client which already has a file can revalidate it with If-None-Match and get a 304 back, and a
+    client whose download was interrupted can resume it with a Range request, guarded by If-Range against the file
+    having changed in the meantime.
+
+    The files a worker writes are never changed afterwards, so the digest of each is kept in memory under its path,
+    inode, size and modification time, and a file is only read to compute its digest the first time it is sent.
+
+    Rather than streaming the bytes through the web worker, a download can be handed to a front proxy.  In the
+    "x-sendfile" mode the file's absolute path is given in an X-Sendfile header, as used by Apache's mod_xsendfile and
+    lighttpd.  In the "x-accel-redirect" mode the file's path under the working directory is appended to a url prefix
+    and given in an X-Accel-Redirect header, for an nginx internal location whose alias is the working directory.  The
+    proxy then serves the bytes and any ranges itself, while conditional requests are still answered here, and a 304 or
+    412 answered here is sent without the header so that the proxy passes it on as it is.
+
+"""
+import os
+import hashlib
+import mimetypes
+from functools import lru_cache
+from urllib.parse import quote
+
+from werkzeug.wrappers import Request, Response
+from werkzeug.wsgi import wrap_file
+
+SENDFILE_MODES = ("", "x-sendfile", "x-accel-redirect")
+_SENDFILE_HEADERS = {"x-sendfile": "X-Sendfile", "x-accel-redirect": "X-Accel-Redirect"}
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+@lru_cache(maxsize=4096)
+def _content_digest(path: str, inode: int, size: int, mtime_ns: int) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_etag(path: str) -> str:
+    """ The strong ETag of a file, which is the SHA-256 digest of its content """
+    stat = os.stat(path)
+    return _content_digest(path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def validate_sendfile_mode(mode: str) -> str:
+    """ Validate the mode downloads are sent in, throwing a ValueError if it isn't one of the known modes """
+    if mode not in SENDFILE_MODES:
+        raise ValueError(f"sendfile mode must be one of {', '.join(repr(m) for m in SENDFILE_MODES)}")
+    return mode
+
+
+def send_download(request: Request, path: str, mimetype: str = None, mode: str = "", root_path: str = None,
+                  prefix: str = None) -> Response:
+    """ Build the response which sends a file, answering conditional and range requests. In the x-sendfile and
+    x-accel-redirect modes the body is left to the front proxy, and for x-accel-redirect the file must be under the
+    root path, which the proxy serves under the url prefix. """
+    validate_sendfile_mode(mode)
+
+    stat = os.stat(path)
+    mimetype = mimetype or mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    if mode == "x-sendfile":
+        response = Response(mimetype=mimetype)
+        response.headers["X-Sendfile"] = os.path.abspath(path)
+    elif mode == "x-accel-redirect":
+        relative_path = os.path.relpath(os.path.abspath(path), os.path.abspath(root_path))
+        if relative_path.startswith(os.pardir):
+            raise ValueError(f"{path} is not in the directory served by the proxy")
+        response = Response(mimetype=mimetype)
+        response.headers["X-Accel-Redirect"] = quote(f"{prefix.rstrip('/')}/{relative_path.replace(os.sep, '/')}")
+    else:
+        response = Response(wrap_file(request.environ, open(path, "rb")), mimetype=mimetype, direct_passthrough=True)
+        response.content_length = stat.st_size
+
+    response.set_etag(_content_digest(path, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+    response.last_modified = stat.st_mtime
+
+    if mode:
+        response = response.make_conditional(request)
+        if response.status_code != 200:
+            del response.headers[_SENDFILE_HEADERS[mode]]
+        return response
+    return response.make_conditional(request, accept_ranges=True, complete_length=stat.st_size)
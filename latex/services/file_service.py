@@ -3,11 +3,84 @@
     without allowing access to file system locations that are not contained by the root path. A FileService can also
     spawn a new FileService in one of its child locations.
 
+    On Linux kernels with the openat2 system call (5.6 and later), a FileService holds an O_PATH descriptor for its
+    root directory, and opens, existence checks and child services are resolved relative to that descriptor with
+    RESOLVE_BENEATH, so that the kernel itself refuses any path which would leave the root through ".." or a symlink.
+    This avoids canonicalizing the path with realpath on every operation.  Paths which can't be handled this way, and
+    every operation on systems without openat2, fall back to the realpath based containment check.
+
 """
 
 import os
+import sys
+import stat
+import errno
 import shutil
-from typing import List
+import ctypes
+from typing import List, Optional
+
+# Definitions from linux/openat2.h, the system call number is the same on every architecture
+_SYS_OPENAT2 = 437
+_RESOLVE_NO_MAGICLINKS = 0x02
+_RESOLVE_BENEATH = 0x08
+
+
+class _OpenHow(ctypes.Structure):
+    _fields_ = [("flags", ctypes.c_uint64), ("mode", ctypes.c_uint64), ("resolve", ctypes.c_uint64)]
+
+
+def _load_openat2():
+    """ Find the openat2 system call, returning a function which calls it or None if it isn't available """
+    if not sys.platform.startswith("linux") or not hasattr(os, "O_PATH"):
+        return None
+    try:
+        syscall = ctypes.CDLL(None, use_errno=True).syscall
+    except (OSError, AttributeError):
+        return None
+    syscall.restype = ctypes.c_long
+
+    def openat2(dir_fd: int, path: str, flags: int, mode: int = 0o666) -> int:
+        # Unlike openat, openat2 rejects a mode unless a file may be created
+        mode = mode if flags & (os.O_CREAT | os.O_TMPFILE) else 0
+        how = _OpenHow(flags | os.O_CLOEXEC, mode, _RESOLVE_BENEATH | _RESOLVE_NO_MAGICLINKS)
+        fd = syscall(_SYS_OPENAT2, ctypes.c_int(dir_fd), ctypes.c_char_p(os.fsencode(path)), ctypes.byref(how),
+                     ctypes.c_size_t(ctypes.sizeof(how)))
+        if fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), path)
+        return fd
+
+    # Older kernels, and container runtimes whose seccomp profiles predate openat2, refuse the call outright
+    try:
+        root_fd = os.open("/", os.O_PATH | os.O_DIRECTORY | os.O_CLOEXEC)
+        try:
+            os.close(openat2(root_fd, ".", os.O_PATH))
+        finally:
+            os.close(root_fd)
+    except OSError:
+        return None
+    return openat2
+
+
+_openat2 = _load_openat2()
+
+
+def _open_flags(mode: str) -> int:
+    """ Convert a mode string for open() to the flags for the open system call """
+    if "+" in mode:
+        flags = os.O_RDWR
+    elif "r" in mode:
+        flags = os.O_RDONLY
+    else:
+        flags = os.O_WRONLY
+
+    if "w" in mode:
+        flags |= os.O_CREAT | os.O_TRUNC
+    elif "a" in mode:
+        flags |= os.O_CREAT | os.O_APPEND
+    elif "x" in mode:
+        flags |= os.O_CREAT | os.O_EXCL
+    return flags
 
 
 def check_contains(method):
@@ -32,10 +105,49 @@ def check_contains(method):
 
 
 class FileService:
-    def __init__(self, root_path):
+    def __init__(self, root_path, resolve_beneath: bool = True, _root_fd: int = None):
+        if _root_fd is not None:
+            # Created by create_from, which has already resolved the root through the parent's descriptor
+            self.root_path = root_path
+            self._root_fd = _root_fd
+            return
+
+        self._root_fd = None
         self.root_path = os.path.join(os.path.realpath(root_path), "")
         if not os.path.isdir(root_path):
             raise ValueError(f"The root path {root_path} provided to the file service is not a real directory")
+        if resolve_beneath and _openat2 is not None:
+            self._root_fd = os.open(self.root_path, os.O_PATH | os.O_DIRECTORY | os.O_CLOEXEC)
+
+    def __del__(self):
+        if getattr(self, "_root_fd", None) is not None:
+            os.close(self._root_fd)
+            self._root_fd = None
+
+    def _beneath(self, path: str) -> Optional[str]:
+        """ Convert a path to one relative to the root for resolving through the root descriptor, or return None if it
+        should go through the realpath check instead. Only absolute paths which are lexically inside the root are
+        converted, since the kernel can only check containment of paths relative to the descriptor. """
+        if self._root_fd is None:
+            return None
+        if not os.path.isabs(path):
+            return path
+        path = os.path.normpath(path)
+        if path == self.root_path[:-1]:
+            return "."
+        if path.startswith(self.root_path):
+            return path[len(self.root_path):]
+        return None
+
+    def _open_beneath(self, relative_path: str, flags: int) -> int:
+        """ Open a path relative to the root descriptor, converting an attempt to leave the root into a ValueError """
+        try:
+            return _openat2(self._root_fd, relative_path, flags)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                raise ValueError(f"The specified path {relative_path} is not contained by the root working directory "
+                                 f"{self.root_path}")
+            raise
 
     def contains(self, path: str) -> bool:
         """ Checks to see if the provided path is contained by the root path. Use to prevent ../ and symlinks
@@ -57,6 +169,15 @@ class FileService:
     def rmtree(self, path: str):
         shutil.rmtree(path, True)
 
+    @check_contains
+    def remove(self, path: str):
+        """ Remove a file if it exists. Files are replaced by removing them before writing the new one, since a file
+        may be a hard link shared with other sessions. """
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
     @check_contains
     def get_all_files(self, path: str) -> List[str]:
         all_files = []
@@ -64,18 +185,65 @@ class FileService:
             all_files += [os.path.join(root, f) for f in files]
         return [os.path.relpath(f, path) for f in all_files]
 
-    @check_contains
     def open(self, path: str, mode: str):
+        relative_path = self._beneath(path)
+        if relative_path is None:
+            return self._open_checked(path, mode)
+
+        flags = _open_flags(mode)
+        try:
+            fd = self._open_beneath(relative_path, flags)
+        except FileNotFoundError:
+            if not flags & os.O_CREAT or not os.path.dirname(relative_path):
+                raise
+            self.makedirs(os.path.dirname(relative_path))
+            fd = self._open_beneath(relative_path, flags)
+        try:
+            return os.fdopen(fd, mode)
+        except Exception:
+            os.close(fd)
+            raise
+
+    @check_contains
+    def _open_checked(self, path: str, mode: str):
         if "w" in mode or "+" in mode:
             directory = os.path.dirname(path)
             if not os.path.exists(directory):
                 os.makedirs(directory)
         return open(path, mode)
 
-    @check_contains
     def exists(self, path: str):
-        return os.path.exists(path)
+        relative_path = self._beneath(path)
+        if relative_path is None:
+            return self._exists_checked(path)
+
+        try:
+            os.close(self._open_beneath(relative_path, os.O_PATH))
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        return True
 
     @check_contains
+    def _exists_checked(self, path: str):
+        return os.path.exists(path)
+
     def create_from(self, path):
-        return FileService(path)
+        relative_path = self._beneath(path)
+        if relative_path is None:
+            return self._create_from_checked(path)
+
+        # Some kernels refuse O_DIRECTORY alongside O_PATH, so the type is checked on the descriptor instead
+        try:
+            fd = self._open_beneath(relative_path, os.O_PATH)
+        except (FileNotFoundError, NotADirectoryError):
+            fd = None
+        if fd is None or not stat.S_ISDIR(os.fstat(fd).st_mode):
+            if fd is not None:
+                os.close(fd)
+            raise ValueError(f"The root path {path} provided to the file service is not a real directory")
+        root_path = os.path.join(os.path.normpath(os.path.join(self.root_path, relative_path)), "")
+        return FileService(root_path, _root_fd=fd)
+
+    @check_contains
+    def _create_from_checked(self, path):
+        return FileService(path, resolve_beneath=self._root_fd is not None)
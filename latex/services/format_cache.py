@@ -0,0 +1,145 @@
+"""
+    The FormatCache keeps precompiled LaTeX format files (.fmt) built from document preambles.  Loading a large
+    preamble (fontspec, tikz, siunitx, etc) dominates the time of each compiler pass for most documents, and many
+    documents share the same preamble.  By dumping the state of the compiler at the end of the preamble into a format
+    file with the mylatexformat package, every later pass and every later session with the same preamble can start
+    from that state instead of loading the packages again.
+
+    A preamble is identified by a digest of the compiler, the text of the target file up to \\begin{document}, and the
+    content of any local package, class, or definition files in the source tree, since those are loaded into the
+    dumped state.  If the preamble pulls in other local .tex files through \\input or \\include, those are hashed as
+    well.  Formats which fail to build are remembered with a marker file so that the build is not retried for every
+    session which shares the preamble.
+
+    The store lives in a directory of its own, with one file per digest.  The modification time of each file is
+    refreshed every time it is used, and the least recently used formats are removed once the total size of the store
+    grows beyond its byte budget.
+
+"""
+import os
+import re
+import shutil
+import hashlib
+from typing import Optional
+
+_BEGIN_DOCUMENT = re.compile(r"^[^%]*\\begin\s*\{document\}")
+_LOCAL_INPUT = re.compile(r"^[^%]*\\(input|include|InputIfFileExists)\b")
+_LOCAL_PACKAGE_EXTENSIONS = (".sty", ".cls", ".def", ".cfg", ".clo", ".fd")
+_CHUNK_SIZE = 1024 * 1024
+
+
+def read_preamble(target_path: str) -> Optional[str]:
+    """ Read the text of a LaTeX document up to (but not including) the line with \\begin{document}. Returns None if
+    the file could not be read or has no \\begin{document} at all. """
+    lines = []
+    try:
+        with open(target_path, "r", errors="replace") as handle:
+            for line in handle:
+                if _BEGIN_DOCUMENT.match(line):
+                    return "".join(lines)
+                lines.append(line)
+    except OSError:
+        return None
+    return None
+
+
+def preamble_digest(compiler: str, source_path: str, target: str) -> Optional[str]:
+    """ Compute the digest which identifies the dumped format of the target's preamble, or None if the target does
+    not have a preamble which can be dumped """
+    preamble = read_preamble(os.path.join(source_path, target))
+    if preamble is None:
+        return None
+
+    sha = hashlib.sha256()
+    sha.update(f"{compiler}\0".encode())
+    sha.update(preamble.encode())
+
+    extensions = _LOCAL_PACKAGE_EXTENSIONS
+    if any(_LOCAL_INPUT.match(line) for line in preamble.splitlines()):
+        extensions = extensions + (".tex",)
+
+    target_path = os.path.normpath(os.path.join(source_path, target))
+    local_files = []
+    for root, _, files in os.walk(source_path):
+        for f in files:
+            full_path = os.path.join(root, f)
+            if f.endswith(extensions) and os.path.normpath(full_path) != target_path:
+                local_files.append(os.path.relpath(full_path, source_path))
+
+    for relative_path in sorted(local_files):
+        sha.update(f"\0{relative_path}\0".encode())
+        with open(os.path.join(source_path, relative_path), "rb") as handle:
+            for chunk in iter(lambda: handle.read(_CHUNK_SIZE), b""):
+                sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+class FormatCache:
+    def __init__(self, root_path: str, max_bytes: int):
+        if not os.path.isdir(root_path):
+            os.makedirs(root_path, exist_ok=True)
+        self.root_path = root_path
+        self.max_bytes = max_bytes
+
+    def _format_path(self, digest: str) -> str:
+        return os.path.join(self.root_path, digest + ".fmt")
+
+    def _failed_path(self, digest: str) -> str:
+        return os.path.join(self.root_path, digest + ".failed")
+
+    def has_failed(self, digest: str) -> bool:
+        """ Check if a previous attempt to build or use the format for this digest failed """
+        return os.path.exists(self._failed_path(digest))
+
+    def mark_failed(self, digest: str):
+        """ Record that the format for this digest can't be used, and discard the format if one had been stored """
+        with open(self._failed_path(digest), "w"):
+            pass
+        if os.path.exists(self._format_path(digest)):
+            os.remove(self._format_path(digest))
+
+    def fetch(self, digest: str, destination: str) -> bool:
+        """ Place the stored format for a digest at the destination path.  Returns False if it is not in the store. """
+        format_path = self._format_path(digest)
+        try:
+            if os.path.exists(destination):
+                os.remove(destination)
+            try:
+                os.link(format_path, destination)
+            except OSError:
+                shutil.copy2(format_path, destination)
+            os.utime(format_path)
+        except OSError:
+            # Either the format was never built or it was evicted by another worker in the meantime
+            return False
+        return True
+
+    def store(self, digest: str, built_format: str):
+        """ Move a freshly built format file into the store, then evict old formats if the budget was exceeded """
+        os.replace(built_format, self._format_path(digest))
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used formats until the total size of the store fits in the byte budget """
+        entries = []
+        total = 0
+        for name in os.listdir(self.root_path):
+            if not name.endswith(".fmt"):
+                continue
+            path = os.path.join(self.root_path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
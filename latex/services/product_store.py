@@ -0,0 +1,118 @@
+"""
+    The ProductStore keeps the products, image conversions and logs of compiled sessions apart from their working
+    trees.  Once a session has been compiled, its output files are moved into a directory of the store named by the
+    session key, and the session's source tree, along with every intermediate file the compiler wrote next to the
+    product, can be removed straight away instead of when the session expires.
+
+    The store has a byte budget.  An index in Redis holds the size of each entry, the total size of the store, and a
+    sorted set of the entries scored by when they were last used, which is refreshed whenever one of their files is
+    sent.  When the total grows beyond the budget the least recently used entries are taken from the index by a script,
+    so that two workers never evict the same entry, and only then removed from disk.  Neither keeping nor evicting an
+    entry reads the directory of the store, so the cost doesn't grow with the number of entries.  Every file is counted
+    at its full size, even one which is also hard linked from the result cache, as the cache may let go of its link at
+    any time and leave the entry holding the file alone.  An entry is also removed along with its session.
+
+"""
+import os
+import time
+import shutil
+from typing import Callable, List, Optional
+
+# Takes the least recently used entries, other than the one to keep, out of the index until the total size fits in
+# the budget, and returns them to be removed from disk
+_EVICT_SCRIPT = """
+local total = tonumber(redis.call('GET', KEYS[3]) or '0')
+local evicted = {}
+local offset = 0
+while total > tonumber(ARGV[1]) do
+    local oldest = redis.call('ZRANGE', KEYS[1], offset, offset)
+    if #oldest == 0 then
+        break
+    end
+    if oldest[1] == ARGV[2] then
+        offset = offset + 1
+    else
+        total = total - tonumber(redis.call('HGET', KEYS[2], oldest[1]) or '0')
+        redis.call('ZREM', KEYS[1], oldest[1])
+        redis.call('HDEL', KEYS[2], oldest[1])
+        evicted[#evicted + 1] = oldest[1]
+    end
+end
+redis.call('SET', KEYS[3], total)
+return evicted
+"""
+
+# Takes one entry out of the index, subtracting its size from the total
+_REMOVE_SCRIPT = """
+local size = redis.call('HGET', KEYS[2], ARGV[1])
+if size then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('DECRBY', KEYS[3], size)
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+"""
+
+
+def product_store_keys(instance_key: str) -> List[str]:
+    """ The redis keys of an instance's product store index: the sorted set of entries by last use, the hash of their
+    sizes, and the total size """
+    return [f"{instance_key}:product_store", f"{instance_key}:product_store:sizes",
+            f"{instance_key}:product_store:bytes"]
+
+
+class ProductStore:
+    def __init__(self, root_path: str, max_bytes: int, redis_client, instance_key: str,
+                 clock: Callable[[], float] = time.time):
+        if not os.path.isdir(root_path):
+            os.makedirs(root_path, exist_ok=True)
+        self.root_path = root_path
+        self.max_bytes = max_bytes
+        self.redis = redis_client
+        self.keys = product_store_keys(instance_key)
+        self.clock = clock
+        self._evict = redis_client.register_script(_EVICT_SCRIPT)
+        self._remove = redis_client.register_script(_REMOVE_SCRIPT)
+
+    def entry_path(self, session_id: str) -> str:
+        return os.path.join(self.root_path, session_id)
+
+    def keep(self, session_id: str, paths: List[Optional[str]]) -> List[Optional[str]]:
+        """ Move files into a session's entry, keeping their names, and return their new paths in the same order. A
+        path which is None, or whose file doesn't exist, is returned as None. Older entries are evicted afterwards if
+        the store has grown beyond its budget. """
+        entry_path = self.entry_path(session_id)
+        os.makedirs(entry_path, exist_ok=True)
+        kept = []
+        size = 0
+        for path in paths:
+            if path is None or not os.path.exists(path):
+                kept.append(None)
+                continue
+            size += os.path.getsize(path)
+            destination = os.path.join(entry_path, os.path.basename(path))
+            shutil.move(path, destination)
+            kept.append(destination)
+
+        zset_key, sizes_key, total_key = self.keys
+        pipeline = self.redis.pipeline()
+        pipeline.zadd(zset_key, {session_id: self.clock()})
+        pipeline.hincrby(sizes_key, session_id, size)
+        pipeline.incrby(total_key, size)
+        pipeline.execute()
+
+        self.evict(keep=session_id)
+        return kept
+
+    def touch(self, session_id: str):
+        """ Mark a session's entry as recently used """
+        self.redis.zadd(self.keys[0], {session_id: self.clock()}, xx=True)
+
+    def remove(self, session_id: str):
+        self._remove(keys=self.keys, args=[session_id])
+        shutil.rmtree(self.entry_path(session_id), True)
+
+    def evict(self, keep: str = None):
+        """ Remove the least recently used entries, other than the one named by keep, until the total size of the store
+        fits in the byte budget """
+        for name in self._evict(keys=self.keys, args=[self.max_bytes, keep or ""]):
+            shutil.rmtree(self.entry_path(name.decode()), True)
@@ -0,0 +1,150 @@
+"""
+    The ResultCache stores the products and logs of completed compilations on disk, addressed by a digest of every
+    input which can influence the output of the compiler: the source files, the template files, the compiler, the
+    target, the fail-fast mode and the image conversion settings.  When a session is finalized with inputs identical to
+    an earlier one, the cached product can be handed back without invoking the compiler at all.  Sessions have the
+    digests of their files in their manifests already, so the cache key of a session is computed from those rather
+    than by reading the files.
+
+    Each entry is a directory named by its digest containing a copy of the product and the log.  The modification time
+    of the entry directory is refreshed every time it is read, and the least recently used entries are removed whenever
+    the total size of the cache grows beyond its byte budget.  Hit and miss counters are kept in Redis so that they are
+    shared by every worker.
+
+"""
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from collections import namedtuple
+from typing import Dict, Optional
+
+CachedResult = namedtuple('CachedResult', 'product log')
+
+_PRODUCT_NAME = "product"
+_LOG_NAME = "log"
+
+
+def manifest_digest(compiler: str, target: str, convert: Optional[Dict], file_manifest: Dict[str, Dict],
+                    template_manifest: Dict[str, Dict], fail_fast: bool = False) -> str:
+    """ Compute the digest which identifies a compilation from the manifests a session keeps of its source files and
+    templates, which already hold the digest of each file's content, so that no files need to be read. A document with
+    errors can still produce a product without fail-fast mode but not with it, so the mode is part of the digest. """
+    sha = hashlib.sha256()
+    sha.update(json.dumps({"compiler": compiler, "target": target, "convert": convert, "fail_fast": fail_fast},
+                          sort_keys=True).encode())
+
+    for label, manifest in (("source", file_manifest), ("templates", template_manifest)):
+        for name in sorted(manifest.keys()):
+            sha.update(f"\0{label}\0{name}\0{manifest[name]['digest']}".encode())
+
+    return sha.hexdigest()
+
+
+def stats_key(instance_key: str) -> str:
+    """ The redis key under which the hit and miss counters for an instance's result cache are kept """
+    return f"{instance_key}:result_cache"
+
+
+def read_counters(redis_client, key: str) -> Dict[str, int]:
+    """ Read the hit and miss counters for a result cache from Redis """
+    data = redis_client.hgetall(key)
+    return {"hits": int(data.get(b"hits", 0)), "misses": int(data.get(b"misses", 0))}
+
+
+def _link_or_copy(source: str, destination: str):
+    """ Hard link a file into place when the source and destination share a filesystem, otherwise copy it """
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class ResultCache:
+    def __init__(self, root_path: str, max_bytes: int, redis_client=None, counter_key: str = None):
+        if not os.path.isdir(root_path):
+            os.makedirs(root_path, exist_ok=True)
+        self.root_path = root_path
+        self.max_bytes = max_bytes
+        self.redis = redis_client
+        self.counter_key = counter_key
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """ The hit and miss counts recorded in Redis """
+        if self.redis is None or self.counter_key is None:
+            return {"hits": 0, "misses": 0}
+        return read_counters(self.redis, self.counter_key)
+
+    def _count(self, field: str):
+        if self.redis is not None and self.counter_key is not None:
+            self.redis.hincrby(self.counter_key, field, 1)
+
+    def _entry_path(self, digest: str) -> str:
+        return os.path.join(self.root_path, digest)
+
+    def fetch(self, digest: str, destination_path: str, base_name: str) -> Optional[CachedResult]:
+        """ Look up a digest in the cache and, if it is present, place the cached product and log into the
+        destination directory under the given base name.  Returns None on a miss. """
+        entry_path = self._entry_path(digest)
+        try:
+            with open(os.path.join(entry_path, "meta.json"), "r") as handle:
+                meta = json.loads(handle.read())
+            product = os.path.join(destination_path, base_name + meta["extension"])
+            log = os.path.join(destination_path, base_name + ".log")
+            _link_or_copy(os.path.join(entry_path, _PRODUCT_NAME), product)
+            _link_or_copy(os.path.join(entry_path, _LOG_NAME), log)
+            os.utime(entry_path)
+        except (OSError, ValueError, KeyError):
+            # A missing entry, or one that was evicted by another worker while being read, is simply a miss
+            self._count("misses")
+            return None
+
+        self._count("hits")
+        return CachedResult(product=product, log=log)
+
+    def store(self, digest: str, product: str, log: str):
+        """ Add a completed product and its log to the cache, then evict old entries if the budget was exceeded """
+        entry_path = self._entry_path(digest)
+        if os.path.exists(entry_path):
+            os.utime(entry_path)
+            return
+
+        # Assemble the entry in a temporary directory and rename it into place so that readers never see a partially
+        # written entry, and so that two workers storing the same digest at once don't interfere with each other
+        temp_path = tempfile.mkdtemp(prefix=".tmp-", dir=self.root_path)
+        try:
+            shutil.copy2(product, os.path.join(temp_path, _PRODUCT_NAME))
+            shutil.copy2(log, os.path.join(temp_path, _LOG_NAME))
+            with open(os.path.join(temp_path, "meta.json"), "w") as handle:
+                handle.write(json.dumps({"extension": os.path.splitext(product)[1]}))
+            os.rename(temp_path, entry_path)
+        except OSError:
+            shutil.rmtree(temp_path, True)
+            return
+
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until the total size of the cache fits in the byte budget """
+        entries = []
+        total = 0
+        for name in os.listdir(self.root_path):
+            if name.startswith("."):
+                continue
+            entry_path = self._entry_path(name)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_path, f)) for f in os.listdir(entry_path))
+                entries.append((os.path.getmtime(entry_path), size, entry_path))
+            except OSError:
+                continue
+            total += size
+
+        for _, size, entry_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_path, True)
+            total -= size
@@ -0,0 +1,132 @@
+"""
+    The ScratchSpace stages a session's source tree into a local directory, normally on a RAM-backed tmpfs such as
+    /dev/shm, so that the compiler's passes read and write their .aux, .log and .pdf files there instead of on the
+    shared working directory.  Only the final product and log are copied back to the session once the compiler is done.
+
+    The scratch directory has a size ceiling shared by every compilation running on the worker.  A session is only
+    staged if its source tree, with room for what the compiler will write, fits under the ceiling and in the free space
+    of the scratch filesystem.  Otherwise the caller compiles in the session directory as before.
+
+    The space a staged session needs is reserved before its tree is copied, in a file beside the staged tree, while
+    holding an exclusive lock on the scratch directory.  Every worker process checks the sum of the reservations under
+    the same lock, so concurrent stages can't overcommit the filesystem between them.  The room reserved for the
+    compiler's output is also the most any single file it writes may grow to, and a compilation which still runs out of
+    room on the filesystem can be told apart from one which failed on its own.
+
+"""
+import os
+import json
+import errno
+import fcntl
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import Optional
+
+# Room left for the compiler's output on top of the size of the staged source tree, as a multiple of the tree size
+_OUTPUT_ALLOWANCE = 1.0
+_MIN_OUTPUT_BYTES = 16 * 1024 * 1024
+
+# The file beside each staged tree which records the space reserved for it
+_RESERVATION_NAME = "reserved.json"
+
+# A compilation which leaves less than this free on the scratch filesystem is taken to have run out of room
+_FULL_BYTES = 1024 * 1024
+
+
+def tree_size(root_path: str) -> int:
+    """ The total size in bytes of the files under a directory """
+    total = 0
+    for root, _, files in os.walk(root_path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class ScratchSpace:
+    def __init__(self, root_path: str, max_bytes: int):
+        self.root_path = root_path
+        self.max_bytes = max_bytes
+
+    @contextmanager
+    def _locked(self):
+        """ Hold an exclusive lock on the scratch directory, which is shared by every worker process on the machine """
+        descriptor = os.open(self.root_path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(descriptor)
+
+    def _reserved(self) -> int:
+        """ The total bytes reserved by the trees staged in the scratch directory """
+        total = 0
+        for name in os.listdir(self.root_path):
+            try:
+                with open(os.path.join(self.root_path, name, _RESERVATION_NAME), "r") as handle:
+                    total += json.loads(handle.read())["bytes"]
+            except (OSError, ValueError, KeyError):
+                # A tree which is being released no longer holds its reservation
+                pass
+        return total
+
+    def stage(self, session_id: str, source_path: str) -> Optional[str]:
+        """ Reserve room for a session's source tree and the compiler's output, then copy the tree into a new scratch
+        directory and return its path, or return None if the tree does not fit or the scratch directory can't be used,
+        in which case nothing is left behind """
+        try:
+            os.makedirs(self.root_path, exist_ok=True)
+            size = tree_size(source_path)
+            needed = size + max(int(size * _OUTPUT_ALLOWANCE), _MIN_OUTPUT_BYTES)
+            with self._locked():
+                usage = shutil.disk_usage(self.root_path)
+                if self._reserved() + needed > min(self.max_bytes, usage.total) or usage.free < needed:
+                    return None
+                scratch_path = tempfile.mkdtemp(prefix=f"{session_id}-", dir=self.root_path)
+                with open(os.path.join(scratch_path, _RESERVATION_NAME), "w") as handle:
+                    handle.write(json.dumps({"bytes": needed, "output_bytes": needed - size}))
+        except OSError:
+            return None
+
+        staged_path = os.path.join(scratch_path, "source")
+        try:
+            shutil.copytree(source_path, staged_path, symlinks=True)
+        except (OSError, shutil.Error):
+            shutil.rmtree(scratch_path, ignore_errors=True)
+            return None
+        return staged_path
+
+    def output_room(self, staged_path: str) -> int:
+        """ The bytes reserved for what the compiler writes into a staged tree """
+        with open(os.path.join(os.path.dirname(staged_path), _RESERVATION_NAME), "r") as handle:
+            return json.loads(handle.read())["output_bytes"]
+
+    def out_of_room(self, log_path: Optional[str]) -> bool:
+        """ Whether a compilation in the scratch directory failed for want of space, either because the filesystem is
+        full or because the compiler's log reports that a write failed with ENOSPC """
+        try:
+            if shutil.disk_usage(self.root_path).free < _FULL_BYTES:
+                return True
+        except OSError:
+            return True
+
+        if log_path is None or not os.path.exists(log_path):
+            return False
+        message = os.strerror(errno.ENOSPC)
+        with open(log_path, "r", errors="replace") as handle:
+            return any(message in line for line in handle)
+
+    def retrieve(self, staged_file: str, destination_path: str) -> Optional[str]:
+        """ Copy a file written in the scratch directory back into a destination directory, returning its new path """
+        if staged_file is None or not os.path.exists(staged_file):
+            return None
+        destination = os.path.join(destination_path, os.path.basename(staged_file))
+        shutil.copy2(staged_file, destination)
+        return destination
+
+    def release(self, staged_path: str):
+        """ Remove a staged tree and the scratch directory which holds it, along with its reservation """
+        shutil.rmtree(os.path.dirname(staged_path), ignore_errors=True)
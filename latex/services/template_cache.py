@@ -0,0 +1,170 @@
+"""
+    The TemplateCache keeps the Jinja2 templates a worker has compiled, so that template text which has been rendered
+    before isn't parsed and compiled to Python again.  Templates are keyed by the SHA-256 digest of their text and the
+    least recently used are dropped once the cache holds its maximum number of entries.
+
+    Templates can also be looked up by digest alone, with a function to load the text which is only called when the
+    template has to be compiled, so that templates kept elsewhere (such as in the template library) aren't fetched
+    while they are in memory.
+
+    A template which isn't in memory is compiled through the environment's bytecode cache when it has one, so that
+    after a worker restarts, or in another worker process, only the cheap step of loading the compiled code is repeated.
+    The bytecode is kept in a directory of the working directory by a TemplateBytecodeCache, which marks each file as
+    used when it is loaded, so that sweep_template_bytecode can remove the least recently used files once the directory
+    outgrows its byte budget.
+
+    The cache counts its hits, its misses, how many of the misses were found in the bytecode cache, and the number and
+    total duration of the renders.  The counts are kept in the process and added to Redis by flush_stats, once per
+    compilation rather than once per template, so that they are shared by every worker.
+
+"""
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict
+
+from jinja2 import Environment, FileSystemBytecodeCache, Template
+
+# The directory of the working directory which holds the compiled template bytecode shared by the workers
+TEMPLATE_BYTECODE_DIRECTORY = ".template_bytecode"
+
+_COUNTERS = ("hits", "misses", "bytecode_hits", "renders", "render_us")
+
+
+def template_stats_key(instance_key: str) -> str:
+    """ The redis key under which the counters of an instance's template caches are kept """
+    return f"{instance_key}:template_cache"
+
+
+def read_template_stats(redis_client, key: str) -> Dict:
+    """ Read the counters of the template caches from Redis, along with the mean duration of a render """
+    data = redis_client.hgetall(key)
+    stats = {name: int(data.get(name.encode(), 0)) for name in _COUNTERS}
+    render_us = stats.pop("render_us")
+    stats["mean_render_ms"] = round(render_us / stats["renders"] / 1000, 3) if stats["renders"] else None
+    return stats
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """ A bytecode cache in a directory, which updates the modification time of a file each time it is loaded so that
+    the files are swept least recently used first """
+    def load_bytecode(self, bucket):
+        super().load_bytecode(bucket)
+        if bucket.code is not None:
+            try:
+                os.utime(self._get_cache_filename(bucket))
+            except OSError:
+                pass
+
+
+def sweep_template_bytecode(root_path: str, max_bytes: int):
+    """ Remove the least recently used files of a bytecode cache directory until their total size fits in the byte
+    budget """
+    entries = []
+    total = 0
+    try:
+        names = os.listdir(root_path)
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(root_path, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+class TemplateCache:
+    def __init__(self, environment: Environment, max_entries: int):
+        self.environment = environment
+        self.max_entries = max_entries
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(_COUNTERS, 0)
+
+    def get(self, text: str) -> Template:
+        """ Get the compiled template for a template text, compiling it only if it isn't already cached """
+        return self.get_by_digest(hashlib.sha256(text.encode()).hexdigest(), lambda: text)
+
+    def get_by_digest(self, digest: str, load_text: Callable[[], str]) -> Template:
+        """ Get the compiled template for the template text with the given SHA-256 digest, calling load_text for the
+        text only if the template isn't already cached """
+        with self._lock:
+            template = self._templates.get(digest)
+            if template is not None:
+                self._templates.move_to_end(digest)
+                self._counts["hits"] += 1
+                return template
+            self._counts["misses"] += 1
+
+        template = self._compile(digest, load_text())
+        with self._lock:
+            self._templates[digest] = template
+            while len(self._templates) > self.max_entries:
+                self._templates.popitem(last=False)
+        return template
+
+    def _compile(self, digest: str, text: str) -> Template:
+        bytecode_cache = self.environment.bytecode_cache
+        bucket = None
+        code = None
+        if bytecode_cache is not None:
+            bucket = bytecode_cache.get_bucket(self.environment, digest, None, text)
+            code = bucket.code
+
+        if code is None:
+            code = self.environment.compile(text)
+            if bucket is not None:
+                bucket.code = code
+                try:
+                    bytecode_cache.set_bucket(bucket)
+                except OSError as e:
+                    logging.warning("Could not write template bytecode: %s", e)
+        else:
+            with self._lock:
+                self._counts["bytecode_hits"] += 1
+
+        return self.environment.template_class.from_code(self.environment, code,
+                                                         self.environment.make_globals(None))
+
+    def render(self, text: str, data: Dict) -> str:
+        """ Render a template text with the given data, timing the render """
+        return self._render(self.get(text), data)
+
+    def render_by_digest(self, digest: str, load_text: Callable[[], str], data: Dict) -> str:
+        """ Render the template text with the given digest with the given data, timing the render """
+        return self._render(self.get_by_digest(digest, load_text), data)
+
+    def _render(self, template: Template, data: Dict) -> str:
+        start = time.perf_counter()
+        rendered = template.render(**data)
+        elapsed_us = int((time.perf_counter() - start) * 1e6)
+        with self._lock:
+            self._counts["renders"] += 1
+            self._counts["render_us"] += elapsed_us
+        return rendered
+
+    def flush_stats(self, redis_client, key: str):
+        """ Add the counts gathered since the last flush to the shared counters in Redis """
+        with self._lock:
+            counts = {name: value for name, value in self._counts.items() if value}
+            self._counts = dict.fromkeys(_COUNTERS, 0)
+        if counts:
+            pipeline = redis_client.pipeline()
+            for name, value in counts.items():
+                pipeline.hincrby(key, name, value)
+            pipeline.execute()
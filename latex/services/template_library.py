@@ -0,0 +1,99 @@
+"""
+    The TemplateLibrary holds the templates registered with an instance by name and version.  A session can use a
+    registered template by its id, "<name>@<version>", sending only the target to render it to and the data to render
+    into it, rather than uploading the full template text with every session.
+
+    The library is kept in a Redis hash with one field per template id.  Each entry holds the template's text along
+    with its SHA-256 digest, its size and when it was registered.  A version can't be changed once it has been
+    registered: registering the same text again is accepted and changes nothing, while different text under an existing
+    id is refused, so that a session which refers to a template always renders the template it was given.  The digest
+    is recorded with the session, and the workers keep their compiled templates under it, so a template in a worker's
+    cache is rendered without its text being fetched again.  A template can't be removed while a session which hasn't
+    been compiled yet refers to it, but one removed in between is reported as a failure of the session's compilation.
+
+"""
+import re
+import json
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+# Names and versions are kept to characters which can appear in a url path segment without being escaped
+_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_.\-]{1,100}$")
+
+
+def library_key(instance_key: str) -> str:
+    """ The redis key of the hash of an instance's registered templates, keyed by template id """
+    return f"{instance_key}:template_library"
+
+
+def template_id(name: str, version: str) -> str:
+    return f"{name}@{version}"
+
+
+def validate_template_name(value, field: str) -> str:
+    """ Validate the name or version of a library template. Throws a ValueError if it isn't a string of up to 100
+    letters, digits, underscores, dots and dashes. """
+    if not isinstance(value, str) or not _NAME_PATTERN.match(value):
+        raise ValueError(f"Field '{field}' must be a string of up to 100 letters, digits, '_', '.' and '-'")
+    return value
+
+
+class TemplateUnavailable(ValueError):
+    pass
+
+
+class TemplateLibrary:
+    def __init__(self, redis_client, instance_key: str):
+        self.redis = redis_client
+        self.key = library_key(instance_key)
+
+    def register(self, name: str, version: str, text: str, now: float) -> Tuple[Dict, bool]:
+        """ Register a template text under a name and version, unless a template is already registered with the same
+        id. Returns the entry now registered under the id, which is the earlier one if there was one, and whether it
+        was added. """
+        digest = hashlib.sha256(text.encode()).hexdigest()
+        entry = {"id": template_id(name, version), "name": name, "version": version, "digest": digest,
+                 "size": len(text.encode()), "created": now}
+        if self.redis.hsetnx(self.key, entry["id"], json.dumps(dict(entry, text=text))):
+            return entry, True
+        return self.entry(entry["id"]), False
+
+    def _load(self, tid: str) -> Optional[Dict]:
+        raw = self.redis.hget(self.key, tid)
+        return json.loads(raw) if raw is not None else None
+
+    def entry(self, tid: str) -> Optional[Dict]:
+        """ The entry of a registered template without its text, or None if there is no template with the id """
+        stored = self._load(tid)
+        if stored is None:
+            return None
+        stored.pop("text")
+        return stored
+
+    def body(self, tid: str) -> Optional[Dict]:
+        """ The entry of a registered template along with its text, or None if there is no template with the id """
+        return self._load(tid)
+
+    def text(self, tid: str, digest: str) -> str:
+        """ The text of a registered template, which must still have the digest it had when the session referring to
+        it was made. Throws a TemplateUnavailable if it doesn't, or if the template is no longer registered. """
+        stored = self._load(tid)
+        if stored is None:
+            raise TemplateUnavailable(f"template {tid} is not in the template library")
+        if stored["digest"] != digest:
+            raise TemplateUnavailable(f"template {tid} has changed since it was added to the session")
+        return stored["text"]
+
+    def entries(self) -> List[Dict]:
+        """ The entries of every registered template without their texts, ordered by id """
+        entries = []
+        for tid, raw in sorted(self.redis.hgetall(self.key).items()):
+            stored = json.loads(raw)
+            stored.pop("text")
+            entries.append(stored)
+        return entries
+
+    def remove(self, tid: str) -> bool:
+        """ Remove a template from the library, returning whether it was registered. Sessions which already refer to
+        it will fail to render it unless a worker still has it compiled, so the caller checks that there are none. """
+        return self.redis.hdel(self.key, tid) > 0
@@ -64,15 +64,76 @@
     The SessionManager is an object available globally to the app.  It requires access to a Redis client for the
     storing of the Session metadata, and a FileService object for persistence of source files and template data.
 
+    Each session is stored in Redis as a hash with one field per attribute in STORED_FIELDS, each holding a json
+    encoded value.  Saving a session with the names of the fields which changed writes only those fields, so a status
+    transition doesn't rewrite the rest of the record, and callers which only need a few attributes of a session can
+    read them with load_fields instead of loading the whole session.  The lists of files and templates are never
+    stored, they are read from the session's directories when asked for.
+
+    Every session hash carries a Redis TTL matching the session's expiration, so a record can never outlive its session
+    even if the periodic cleanup stops running.  Alongside it, the SessionManager keeps a sorted set of session keys
+    scored by their expiration time, which lets the cleanup task pull only the sessions which have expired and remove
+    their directories and records in batches, without looking at the sessions which are still alive.
+
+    Each session's key is also kept in one sorted set per status, scored by the time the session entered that status.
+    The record and the status sets are updated in a single transaction whenever the status is saved, so the number of
+    sessions in each status is always available with ZCARD, and the finalized set gives the age of the oldest session
+    waiting for a worker, without loading any sessions.
+
+    Sessions also keep a manifest of their templates in the same hash, with one field per template prefixed by
+    TEMPLATE_PREFIX.  Each entry holds the template's target, the size and digest of its stored file and the keys of its
+    data, and is written when the template is uploaded, so listing a session's templates never opens the template
+    files themselves.  The full text and data of a template are only read when they are asked for.
+
+    A template may also be a reference to a template in the instance's template library, in which case only its id,
+    the digest of its text and its data are stored with the session, and its manifest entry holds the template id.
+
+    In the same way the source files are listed in a manifest of fields prefixed by FILE_PREFIX, with the path, size,
+    SHA-256 digest and modification time of each file.  The digest is computed as the upload is written to disk, and
+    each upload only writes its own entry, so listing the files or hashing them for the result cache costs the same no
+    matter how large the source tree is.
+
+    Files uploaded to sessions are also added to the instance's BlobStore, a content-addressed store of hard links in
+    the working directory.  A client can send the paths and SHA-256 digests of the files it is about to upload, and any
+    the store already has are linked into the session's source tree instead.  Each session keeps a list of the blobs
+    it uses in a "blobs" file in its directory, so that when the session is deleted the blobs it leaves unreferenced
+    can be found without scanning the store.  These are kept for BLOB_RETENTION_SEC before they are removed, in case
+    another session asks for them.
+
+    A session can also be a batch, for documents such as certificates which share their files and templates and
+    differ only in the data rendered into them.  Data rows are added to the session and stored in a "rows.jsonl" file
+    in its directory, and each row's values are laid over the data of every template to render one copy of the
+    document.  The rows are compiled in chunks spread across the workers, and the result of each row is recorded in a
+    separate "session:{key}:rows" hash while the counts of rows which succeeded and failed are kept in the session's
+    own hash, so progress can be followed without loading the results of every row.  The row products are collected
+    into a single zip or merged pdf as the session's product once every row is done.
+
+    A session's image conversion settings may also be a list of conversions, which are all made from the one compiled
+    pdf.  The pdf is then kept as the session's product, and the files of the conversions are kept in order in its
+    "outputs" field.
+
+    Once a session has been compiled, its product, image conversions and log, or the logs of a batch session's rows,
+    are moved into the instance's ProductStore, which keeps them within a byte budget, and the session's source tree is
+    removed along with all of the compiler's intermediate files.  The manifests of the files and templates are kept,
+    so the session can still be described in full, but the files themselves are gone.
+
     Of one last note is the instance_key, which is a string which is uniquely generated during app startup. The
     SessionManager keeps a set of session keys stored in Redis under the instance key, in order to allow multiple
     instances of the application to store a single Redis server, if desired.  When the instance is disposed, all
     session keys linked to it could theoretically be removed.
 
 """
+import os
 import json
+import math
+import time
 import uuid
+import hashlib
+import itertools
+from hashlib import md5
 from datetime import timedelta
+from functools import partial
+from urllib.parse import urlsplit
 
 import redis
 from flask_redis import FlaskRedis
@@ -81,8 +142,13 @@ from flask import Flask
 from latex.config import ConfigBase
 from latex.services.time_service import TimeService
 from latex.services.file_service import FileService
+from latex.services.blob_store import BlobStore
+from latex.services.product_store import ProductStore
+from latex.services.template_cache import sweep_template_bytecode, TEMPLATE_BYTECODE_DIRECTORY
+from latex.services.callbacks import queue_callback, parse_allowed_hosts, is_public_address
+from latex.resources import session_document, external_session_url
 
-from typing import Callable, List, Set, Dict
+from typing import Any, Callable, Iterable, Iterator, List, Set, Dict, Tuple
 import logging
 
 
@@ -90,6 +156,38 @@ EDITABLE_TEXT = "editable"
 FINALIZED_TEXT = "finalized"
 SUCCESS_TEXT = "success"
 ERROR_TEXT = "error"
+ALL_STATUSES = (EDITABLE_TEXT, FINALIZED_TEXT, SUCCESS_TEXT, ERROR_TEXT)
+
+
+# The session attributes persisted in each session's Redis hash
+STORED_FIELDS = ("key", "created", "expires_at", "compiler", "target", "status", "convert", "format_cache", "fail_fast",
+                 "limits", "callback", "row_count", "batch_output", "compile_info", "product", "outputs", "log",
+                 "diagnostics")
+
+# The counters of a batch session's finished rows, which are kept in the session's hash but are only ever incremented
+# by the workers, never written by a save
+ROW_COUNTERS = {True: "rows_succeeded", False: "rows_failed"}
+BATCH_OUTPUTS = ("zip", "pdf")
+
+# The most image conversions which can be made from one compiled pdf
+MAX_CONVERT_OUTPUTS = 8
+
+
+# The prefix of the fields in a session's Redis hash which hold its template manifest, one entry per template target
+TEMPLATE_PREFIX = "template:"
+FILE_PREFIX = "file:"
+_MANIFESTS = {TEMPLATE_PREFIX: "template_manifest", FILE_PREFIX: "file_manifest"}
+_CHUNK_SIZE = 1024 * 1024
+
+BLOB_STORE_DIRECTORY = ".blob_store"
+PRODUCT_STORE_DIRECTORY = ".product_store"
+
+# The number of expired sessions removed together in a single Redis pipeline
+EXPIRY_BATCH_SIZE = 100
+
+# Status changes are published as they are saved, so a session being waited on is only read again from its record as a
+# fallback this often, such as for a record which expired without its session being deleted
+_STATUS_RECHECK_SEC = 5.0
 
 
 def make_id():
@@ -101,14 +199,47 @@ def to_key(session_id: str) -> str:
     return f"session:{session_id}"
 
 
-def validate_conversion_data(convert_data: Dict) -> Dict:
+def expiry_key(instance_key: str) -> str:
+    """ The redis key of the sorted set which indexes an instance's sessions by their expiration time """
+    return f"{instance_key}:expires"
+
+
+def blobs_key(instance_key: str) -> str:
+    """ The redis key of the sorted set of blobs no session uses any more, scored by when they were left unused """
+    return f"{instance_key}:blobs:unreferenced"
+
+
+def status_channel(instance_key: str, session_id: str) -> str:
+    """ The redis pub/sub channel on which the changes of a session's status are published """
+    return f"{instance_key}:status-changes:{session_id}"
+
+
+def rows_key(session_id: str) -> str:
+    """ The redis key of the hash holding the result of each row of a batch session """
+    return f"{to_key(session_id)}:rows"
+
+
+def status_key(instance_key: str, status: str) -> str:
+    """ The redis key of the sorted set of an instance's sessions which are in the given status """
+    return f"{instance_key}:status:{status}"
+
+
+def validate_conversion_data(convert_data):
     """ Validate information for image conversion by checking that it is in the expected format and that the values
     are in the expected range.  If the input data is None, it will return None, as this is a valid option and indicates
-    that no conversion is to take place.  If the input data is invalid, it throws a ValueError. Otherwise it
-    returns a cleaned version of the data."""
+    that no conversion is to take place.  The data may also be a list of conversions, each of which is made from the
+    same compiled pdf.  If the input data is invalid, it throws a ValueError. Otherwise it returns a cleaned version of
+    the data."""
     if convert_data is None:
         return None
 
+    if isinstance(convert_data, list):
+        if not 1 <= len(convert_data) <= MAX_CONVERT_OUTPUTS:
+            raise ValueError(f"A list of image conversions must have between 1 and {MAX_CONVERT_OUTPUTS} entries")
+        if not all(isinstance(c, dict) for c in convert_data):
+            raise ValueError("Each image conversion in a list must be a dictionary with the keys 'format' and 'dpi'")
+        return [validate_conversion_data(c) for c in convert_data]
+
     if not isinstance(convert_data, dict) or "format" not in convert_data or "dpi" not in convert_data:
         raise ValueError("Image conversion data must be a dictionary with the keys 'format' and 'dpi'")
 
@@ -121,12 +252,106 @@ def validate_conversion_data(convert_data: Dict) -> Dict:
     if not isinstance(convert_dpi, int) or convert_dpi > 10000 or convert_dpi < 10:
         raise ValueError('Image conversion dpi must be an integer between 10 and 10000')
 
-    return {"format": convert_format, "dpi": convert_dpi}
+    cleaned = {"format": convert_format, "dpi": convert_dpi}
+
+    # Only the first page is converted unless the pages are given, either as "all" or as a [first, last] range
+    if convert_data.get("pages") is not None:
+        pages = convert_data["pages"]
+        if pages != "all" and not (isinstance(pages, list) and len(pages) == 2 and
+                                   all(isinstance(p, int) and not isinstance(p, bool) and p >= 1 for p in pages) and
+                                   pages[0] <= pages[1]):
+            raise ValueError('Conversion pages must be "all" or a [first, last] list of page numbers starting at 1')
+        cleaned["pages"] = pages
+
+    return cleaned
+
+
+# The per-session compile limits and the configuration values which set the ceiling for each of them
+LIMIT_SETTINGS = {
+    "timeout": "COMPILE_TIMEOUT_SEC",
+    "cpu": "COMPILE_CPU_SEC",
+    "memory": "COMPILE_MEMORY_MB",
+    "file_size": "COMPILE_FILE_SIZE_MB"
+}
+
+
+def validate_limits(limits_data: Dict) -> Dict:
+    """ Validate the compile limits requested for a session.  Sessions may only lower the limits set in the server
+    configuration, not raise them.  None is a valid option which leaves the server limits in place. If the input data
+    is invalid, it throws a ValueError, otherwise it returns a cleaned version of the data. """
+    if limits_data is None:
+        return None
+
+    if not isinstance(limits_data, dict) or not set(limits_data.keys()) <= set(LIMIT_SETTINGS.keys()):
+        raise ValueError(f"Compile limits must be a dictionary with any of the keys {', '.join(LIMIT_SETTINGS)}")
+
+    cleaned = {}
+    for name, value in limits_data.items():
+        ceiling = int(getattr(ConfigBase, LIMIT_SETTINGS[name]))
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            raise ValueError(f"Compile limit '{name}' must be a positive integer")
+        if 0 < ceiling < value:
+            raise ValueError(f"Compile limit '{name}' may not be greater than the server limit of {ceiling}")
+        cleaned[name] = value
+
+    return cleaned
+
+
+def validate_callback(url: str) -> str:
+    """ Validate the url a session's document is POSTed to once it has been compiled, throwing a ValueError if it isn't
+    an absolute http or https url, or if its host is an address which isn't a public one and isn't one of the server's
+    allowed hosts. Host names are checked again once they are resolved when the callback is sent. None is a valid option
+    which sends no callback. """
+    if url is None:
+        return None
+
+    parts = urlsplit(url) if isinstance(url, str) else None
+    if parts is None or parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("Field 'callback' must be an absolute http or https url")
+    try:
+        parts.port
+    except ValueError:
+        raise ValueError("Field 'callback' has an invalid port")
+
+    if parts.hostname not in parse_allowed_hosts(ConfigBase.CALLBACK_ALLOWED_HOSTS):
+        try:
+            public = is_public_address(parts.hostname)
+        except ValueError:
+            # A host name rather than an address
+            public = True
+        if not public:
+            raise ValueError("Field 'callback' must be a url on a public host")
+    return url
+
+
+def validate_rows(rows: List[Dict]) -> List[Dict]:
+    """ Validate the data rows added to a batch session, each of which is a dictionary of values laid over the data of
+    the session's templates. Throws a ValueError if they are not a list of dictionaries. """
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise ValueError("Field 'rows' must be a list of dictionaries")
+    return rows
+
+
+def validate_batch_output(output: str) -> str:
+    """ Validate the form a batch session's row products are collected in, a zip or a single merged pdf """
+    if output not in BATCH_OUTPUTS:
+        raise ValueError(f"Field 'output' must be one of {', '.join(BATCH_OUTPUTS)}")
+    return output
+
+
+def validate_flag(value, name: str) -> bool:
+    """ Validate a boolean session option, throwing a ValueError if the value is not a boolean """
+    if not isinstance(value, bool):
+        raise ValueError(f"Field '{name}' must be true or false")
+    return value
 
 
 class Session:
     _source_directory = "source"
     _template_directory = "templates"
+    _blob_list = "blobs"
+    _rows_file = "rows.jsonl"
+    _rows_directory = "rows"
 
     def __init__(self, **kwargs):
         self.key: str = kwargs["key"]
@@ -135,19 +360,49 @@ class Session:
         self.created: float = kwargs["created"]
         self.expires_at: float = kwargs["expires_at"]
         self.status: str = kwargs["status"]
-        self._file_service: FileService = kwargs["file_service"]
+        self._file_service_factory: Callable[[], FileService] = kwargs["file_service_factory"]
         self._save_callback: Callable = kwargs["save_callback"]
         self.product: str = kwargs.get("product", None)
+        self.outputs: List[str] = kwargs.get("outputs", None)
         self.log: str = kwargs.get("log", None)
         self.convert = kwargs.get("convert", None)
+        self.format_cache: bool = kwargs.get("format_cache", True)
+        self.fail_fast: bool = kwargs.get("fail_fast", False)
+        self.limits: Dict = kwargs.get("limits", None)
+        self.callback: str = kwargs.get("callback", None)
+        self.row_count: int = kwargs.get("row_count", 0)
+        self.batch_output: str = kwargs.get("batch_output", "zip")
+        self.rows_succeeded: int = kwargs.get(ROW_COUNTERS[True], 0)
+        self.rows_failed: int = kwargs.get(ROW_COUNTERS[False], 0)
+        self.compile_info: Dict = kwargs.get("compile_info", None)
+        self.diagnostics: Dict = kwargs.get("diagnostics", None)
+        self.template_manifest: Dict[str, Dict] = kwargs.get("template_manifest", {})
+        self.file_manifest: Dict[str, Dict] = kwargs.get("file_manifest", {})
+        self._blob_store: BlobStore = kwargs.get("blob_store", None)
+
+        # The file services are only created when something needs the session's files, since most requests which load
+        # a session only look at its metadata
+        self._root_files: FileService = None
+        self._source_files: FileService = None
+        self._template_files: FileService = None
 
-        if not self._file_service.exists(Session._source_directory):
-            self._file_service.makedirs(Session._source_directory)
-        if not self._file_service.exists(Session._template_directory):
-            self._file_service.makedirs(Session._template_directory)
+    @property
+    def _file_service(self) -> FileService:
+        if self._root_files is None:
+            self._root_files = self._file_service_factory()
+        return self._root_files
 
-        self.source_files = self._file_service.create_from(Session._source_directory)
-        self.template_files = self._file_service.create_from(Session._template_directory)
+    @property
+    def source_files(self) -> FileService:
+        if self._source_files is None:
+            self._source_files = self._file_service.create_from(Session._source_directory)
+        return self._source_files
+
+    @property
+    def template_files(self) -> FileService:
+        if self._template_files is None:
+            self._template_files = self._file_service.create_from(Session._template_directory)
+        return self._template_files
 
     @property
     def _redis_key(self):
@@ -159,19 +414,145 @@ class Session:
         return self.status == EDITABLE_TEXT
 
     @property
-    def files(self):
-        return self.source_files.get_all_files(".")
+    def files(self) -> List[str]:
+        """ The paths of the session's source files """
+        return sorted(self.file_manifest.keys())
+
+    def add_file(self, path: str, stream, save: bool = True) -> Dict:
+        """ Write the content of a binary stream to a path in the source directory, hashing it as it is written, and
+        record the file in the file manifest. Returns the manifest entry. If the stream fails part of the way through,
+        such as an archive member over the size limit, the partly written file is removed. Throws a ValueError if the
+        path is a directory. """
+        path = os.path.normpath(path)
+        if os.path.isdir(os.path.join(self.source_files.root_path, path)):
+            raise ValueError(f"The path {path} is a directory in the session's source directory")
+        sha = hashlib.sha256()
+        size = 0
+        self.source_files.remove(path)
+        try:
+            with self.source_files.open(path, "wb") as handle:
+                for chunk in iter(lambda: stream.read(_CHUNK_SIZE), b""):
+                    sha.update(chunk)
+                    handle.write(chunk)
+                    size += len(chunk)
+                handle.flush()
+                mtime = os.fstat(handle.fileno()).st_mtime
+        except Exception:
+            self.source_files.remove(path)
+            raise
+
+        entry = {"path": path, "size": size, "digest": sha.hexdigest(), "mtime": mtime}
+        if self._blob_store is not None:
+            self._blob_store.add(os.path.join(self.source_files.root_path, path), entry["digest"])
+            self._record_blobs([entry["digest"]])
+
+        self.file_manifest[path] = entry
+        if save:
+            self._save_callback(self, FILE_PREFIX + path)
+        return entry
+
+    def link_files(self, files: Iterable[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """ Link the blobs with the given digests from the blob store into the source directory at the given paths,
+        recording them in the file manifest. Returns the (path, digest) pairs which the store doesn't have, and which
+        will have to be uploaded. """
+        missing, linked = [], []
+        for path, digest in files:
+            path = os.path.normpath(path)
+            destination = os.path.join(self.source_files.root_path, path)
+            if not self.source_files.contains(destination):
+                raise ValueError(f"The path {path} is not contained by the session's source directory")
+
+            if self._blob_store is None or not self._blob_store.link_into(digest, destination):
+                missing.append((path, digest))
+                continue
+
+            stat_result = os.stat(destination)
+            self.file_manifest[path] = {"path": path, "size": stat_result.st_size, "digest": digest,
+                                        "mtime": stat_result.st_mtime}
+            linked.append(path)
+
+        if linked:
+            self._record_blobs([self.file_manifest[path]["digest"] for path in linked])
+            self._save_callback(self, *[FILE_PREFIX + path for path in linked])
+        return missing
+
+    def _record_blobs(self, digests: List[str]):
+        with self._file_service.open(Session._blob_list, "a") as handle:
+            handle.write("".join(f"{digest}\n" for digest in digests))
+
+    def add_files(self, files: Iterable[Tuple[str, Any]]) -> List[Dict]:
+        """ Write a sequence of (path, binary stream) pairs to the source directory, such as the members of an archive
+        as it is read, and record them in the file manifest with a single save. Files written before an error are
+        still recorded. """
+        entries = []
+        try:
+            for path, stream in files:
+                entries.append(self.add_file(path, stream, save=False))
+        finally:
+            if entries:
+                self._save_callback(self, *[FILE_PREFIX + entry["path"] for entry in entries])
+        return entries
 
     @property
     def templates(self):
-        files = self.template_files.get_all_files(".")
-        template_data = {}
-        for f in files:
-            with self.template_files.open(f, "r") as handle:
-                data = json.loads(handle.read())
-                if "target" in data.keys():
-                    template_data[data["target"]] = data
-        return template_data
+        return self.template_manifest
+
+    @staticmethod
+    def _template_file_name(target: str) -> str:
+        return md5(target.encode()).hexdigest()
+
+    def add_template(self, target: str, text: str, data: Dict) -> Dict:
+        """ Store a template and its render data, replacing any earlier template with the same target, and record it in
+        the template manifest. Returns the manifest entry. """
+        return self._store_template({"text": text, "target": target, "data": data}, {})
+
+    def add_library_template(self, target: str, template_id: str, digest: str, data: Dict) -> Dict:
+        """ Store a reference to a template in the instance's template library along with the data to render into it,
+        in the same way as add_template. The digest of the template's text is kept to check that the same text is
+        rendered. Returns the manifest entry. """
+        return self._store_template({"template": template_id, "digest": digest, "target": target, "data": data},
+                                    {"template": template_id})
+
+    def _store_template(self, body: Dict, manifest_fields: Dict) -> Dict:
+        target = body["target"]
+        content = json.dumps(body).encode()
+        with self.template_files.open(Session._template_file_name(target), "wb") as handle:
+            handle.write(content)
+
+        entry = {"target": target,
+                 "size": len(content),
+                 "digest": hashlib.sha256(content).hexdigest(),
+                 "data_keys": sorted(body["data"].keys()),
+                 **manifest_fields}
+        self.template_manifest[target] = entry
+        self._save_callback(self, TEMPLATE_PREFIX + target)
+        return entry
+
+    def template_body(self, target: str) -> Dict:
+        """ Read the full text and data of one template, returning None if the session has no template for the
+        target """
+        if target not in self.template_manifest:
+            return None
+        with self.template_files.open(Session._template_file_name(target), "r") as handle:
+            return json.loads(handle.read())
+
+    def add_rows(self, rows: List[Dict]) -> int:
+        """ Append data rows to a batch session, returning the number of rows it now has """
+        with self._file_service.open(Session._rows_file, "a") as handle:
+            handle.write("".join(json.dumps(row) + "\n" for row in rows))
+        self.row_count += len(rows)
+        self._save_callback(self, "row_count")
+        return self.row_count
+
+    def read_rows(self, start: int, stop: int) -> List[Dict]:
+        """ Read the data rows of a batch session from index start up to but not including stop """
+        with self._file_service.open(Session._rows_file, "r") as handle:
+            return [json.loads(line) for line in itertools.islice(handle, start, stop)]
+
+    @property
+    def rows_path(self) -> str:
+        """ The directory the products and logs of a batch session's rows are written to """
+        return os.path.join(self._file_service.root_path, Session._rows_directory)
 
     @property
     def public(self):
@@ -181,16 +562,24 @@ class Session:
                 "compiler": self.compiler,
                 "target": self.target,
                 "files": self.files,
+                "file_manifest": self.file_manifest,
                 "templates": self.templates,
                 "convert": self.convert,
+                "format_cache": self.format_cache,
+                "fail_fast": self.fail_fast,
+                "limits": self.limits,
+                "callback": self.callback,
+                "rows": {"total": self.row_count, "success": self.rows_succeeded, "error": self.rows_failed,
+                         "output": self.batch_output} if self.row_count else None,
+                "compile_info": self.compile_info,
                 "status": self.status
                 }
 
     @property
-    def all_data(self):
-        data = self.public
-        data["product"] = self.product
-        data["log"] = self.log
+    def stored_data(self):
+        data = {name: getattr(self, name) for name in STORED_FIELDS}
+        data.update({TEMPLATE_PREFIX + target: entry for target, entry in self.template_manifest.items()})
+        data.update({FILE_PREFIX + path: entry for path, entry in self.file_manifest.items()})
         return data
 
     def finalize(self):
@@ -198,24 +587,29 @@ class Session:
             raise ValueError("Session is no longer editable and so cannot be finalized")
 
         self.status = FINALIZED_TEXT
-        self._save_callback(self)
+        self._save_callback(self, "status")
 
-    def set_complete(self, product, log):
+    def set_complete(self, product, log, compile_info=None, diagnostics=None, outputs=None):
         if self.status != FINALIZED_TEXT:
             raise ValueError("Session must be finalized in order to be set to complete")
 
         self.product = product
+        self.outputs = outputs
         self.log = log
+        self.compile_info = compile_info
+        self.diagnostics = diagnostics
         self.status = SUCCESS_TEXT
-        self._save_callback(self)
+        self._save_callback(self, "product", "outputs", "log", "compile_info", "diagnostics", "status")
 
-    def set_errored(self, log):
+    def set_errored(self, log, compile_info=None, diagnostics=None):
         if self.status != FINALIZED_TEXT:
             raise ValueError("Session must be finalized in order to be set to error")
 
         self.log = log
+        self.compile_info = compile_info
+        self.diagnostics = diagnostics
         self.status = ERROR_TEXT
-        self._save_callback(self)
+        self._save_callback(self, "log", "compile_info", "diagnostics", "status")
 
 
 class SessionManager:
@@ -225,23 +619,35 @@ class SessionManager:
         self.working_directory = working_directory
         self.instance_key = instance_key
         self.session_ttl = int(ConfigBase.SESSION_TTL_SEC)
+        self.external_url = ConfigBase.EXTERNAL_URL
+        self.blob_store: BlobStore = None
+        self.product_store: ProductStore = None
         self._init_file_service()
 
     def _init_file_service(self):
         if self.working_directory is not None:
             self.root_file_service = FileService(self.working_directory)
+            self.blob_store = BlobStore(os.path.join(self.working_directory, BLOB_STORE_DIRECTORY))
+            max_bytes = int(ConfigBase.PRODUCT_STORE_MAX_MB) * 1024 * 1024
+            if max_bytes > 0:
+                self.product_store = ProductStore(os.path.join(self.working_directory, PRODUCT_STORE_DIRECTORY),
+                                                  max_bytes, self.redis, self.instance_key)
 
     def init_app(self, app: Flask, instance_id: str):
         self.working_directory = app.config["WORKING_DIRECTORY"]
         self.session_ttl = int(app.config["SESSION_TTL_SEC"])
-        self._init_file_service()
         self.instance_key = instance_id
+        self._init_file_service()
 
-    def create_session(self, compiler: str, target: str, convert=None) -> Session:
+    def create_session(self, compiler: str, target: str, convert=None, format_cache: bool = True,
+                       fail_fast: bool = False, limits: Dict = None, callback: str = None) -> Session:
         key = make_id()
 
-        # Create the working directory
+        # Create the working directory, along with the directories for the source files and templates. This is the only
+        # place they are created, loading a session later never touches the file system.
         self.root_file_service.makedirs(key)
+        for directory in (Session._source_directory, Session._template_directory):
+            self.root_file_service.makedirs(os.path.join(key, directory))
 
         # Create the session
         kwargs = {
@@ -252,13 +658,19 @@ class SessionManager:
             "target": target,
             "status": EDITABLE_TEXT,
             "convert": convert,
-            "file_service": self.root_file_service.create_from(key),
-            "save_callback": self.save_session
+            "format_cache": format_cache,
+            "fail_fast": fail_fast,
+            "limits": limits,
+            "callback": callback,
+            "file_service_factory": partial(self.root_file_service.create_from, key),
+            "save_callback": self.save_session,
+            "blob_store": self.blob_store
         }
         session = Session(**kwargs)
 
-        # Store to the redis collection of sessions for this instance
+        # Store to the redis collection of sessions for this instance, and index it by its expiration time
         self.redis.sadd(self.instance_key, session.key)
+        self.redis.zadd(expiry_key(self.instance_key), {session.key: session.expires_at})
 
         # Also save the session to redis
         self.save_session(session)
@@ -266,22 +678,228 @@ class SessionManager:
         return session
 
     def delete_session(self, session: Session):
-        # Remove from disk and from redis
-        self.root_file_service.rmtree(session.key)
-        self.redis.delete(session._redis_key)
-        self.redis.srem(self.instance_key, session.key)
-
-    def save_session(self, session: Session) -> None:
-        self.redis.set(session._redis_key, json.dumps(session.all_data))
+        self.delete_sessions([session.key])
+
+    def delete_sessions(self, session_ids: List[str]):
+        """ Remove a batch of sessions from disk, and their records and index entries from redis in a single round trip.
+        The sessions don't need to be loaded, and any which are already partially removed are cleaned up. """
+        digests = []
+        for session_id in session_ids:
+            digests += self._read_blob_list(session_id)
+            self.root_file_service.rmtree(session_id)
+            if self.product_store is not None:
+                self.product_store.remove(session_id)
+
+        # The blobs the deleted sessions were the last to use are kept for a while before they are removed
+        unreferenced = self.blob_store.unreferenced(digests)
+
+        pipeline = self.redis.pipeline()
+        pipeline.delete(*[to_key(session_id) for session_id in session_ids])
+        pipeline.delete(*[rows_key(session_id) for session_id in session_ids])
+        pipeline.srem(self.instance_key, *session_ids)
+        pipeline.zrem(expiry_key(self.instance_key), *session_ids)
+        for status in ALL_STATUSES:
+            pipeline.zrem(status_key(self.instance_key, status), *session_ids)
+        if unreferenced:
+            pipeline.zadd(blobs_key(self.instance_key), {digest: self.time_service.now for digest in unreferenced})
+        for session_id in session_ids:
+            pipeline.publish(status_channel(self.instance_key, session_id), json.dumps(None))
+        pipeline.execute()
+
+    def release_sources(self, session_id: str):
+        """ Remove the source tree of a session which has been compiled, once its outputs are in the product store.
+        The blobs it was the last to use are kept for a while before they are removed, as they are when a session is
+        deleted. """
+        digests = self._read_blob_list(session_id)
+        self.root_file_service.rmtree(os.path.join(session_id, Session._source_directory))
+        unreferenced = self.blob_store.unreferenced(digests)
+        if unreferenced:
+            self.redis.zadd(blobs_key(self.instance_key), {digest: self.time_service.now for digest in unreferenced})
+
+    def _read_blob_list(self, session_id: str) -> List[str]:
+        path = os.path.join(session_id, Session._blob_list)
+        try:
+            with self.root_file_service.open(path, "r") as handle:
+                return [line.strip() for line in handle if line.strip()]
+        except (OSError, ValueError):
+            return []
+
+    def sweep_blobs(self, unreferenced_before: float):
+        """ Remove the blobs which were left unreferenced before the given time and haven't been used since """
+        key = blobs_key(self.instance_key)
+        digests = [d.decode() for d in self.redis.zrangebyscore(key, "-inf", unreferenced_before)]
+        for digest in digests:
+            if self.blob_store.remove_unreferenced(digest):
+                logging.info("Removing unreferenced blob %s", digest)
+        if digests:
+            self.redis.zrem(key, *digests)
+
+    def save_session(self, session: Session, *fields: str) -> None:
+        """ Write a session to its Redis hash. If the names of the fields which changed are given only those fields are
+        written, otherwise the whole record is. The hash's TTL is set on every write so that a record written after
+        its session expired is still removed.
+
+        Nothing is written for a session which has been deleted, or whose record has expired, such as one a worker
+        finishes after it was removed. The record is watched while this is checked, so a deletion in between makes
+        the transaction fail and the check is made again. """
+        data = session.stored_data
+        if fields:
+            data = {name: data[name] for name in fields}
+        ttl = max(int(math.ceil(session.expires_at - self.time_service.now)), 1)
+
+        with self.redis.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(session._redis_key)
+                    if not self._is_live(pipeline, session, partial=bool(fields)):
+                        logging.info("Not saving session %s, which no longer exists", session.key)
+                        return
+                    pipeline.multi()
+                    self._queue_save(pipeline, session, data, ttl)
+                    pipeline.execute()
+                    return
+                except redis.WatchError:
+                    continue
+
+    def _is_live(self, pipeline, session: Session, partial: bool) -> bool:
+        """ Whether a session is still in the expiration index, and for a partial save whether its record still exists,
+        read on a pipeline which is watching the record """
+        if pipeline.zscore(expiry_key(self.instance_key), session.key) is None:
+            return False
+        return not partial or pipeline.exists(session._redis_key) > 0
+
+    def _queue_save(self, pipeline, session: Session, data: Dict, ttl: int):
+        pipeline.hset(session._redis_key, mapping={name: json.dumps(value) for name, value in data.items()})
+        pipeline.expire(session._redis_key, ttl)
+        if "status" in data:
+            # Move the session into the set for its new status in the same transaction as the record is written
+            for status in ALL_STATUSES:
+                if status != session.status:
+                    pipeline.zrem(status_key(self.instance_key, status), session.key)
+            pipeline.zadd(status_key(self.instance_key, session.status), {session.key: self.time_service.now},
+                          nx=True)
+            pipeline.publish(status_channel(self.instance_key, session.key), json.dumps(session.status))
+
+            # The notification of a finished session is queued with its final status, so it can't be lost in between
+            if session.callback is not None and session.status in (SUCCESS_TEXT, ERROR_TEXT):
+                document = session_document(session, external_session_url(self.external_url, session.key))
+                queue_callback(pipeline, self.instance_key, session.callback, document, self.time_service.now)
+
+    def record_row_result(self, session: Session, index: int, result: Dict):
+        """ Record the result of one row of a batch session, and count it as succeeded or failed in the session's hash.
+        Both keys get the session's TTL, so a result recorded after the session has expired doesn't outlive it. """
+        ttl = max(int(math.ceil(session.expires_at - self.time_service.now)), 1)
+        pipeline = self.redis.pipeline()
+        pipeline.hset(rows_key(session.key), str(index), json.dumps(result))
+        pipeline.hincrby(session._redis_key, ROW_COUNTERS[result["success"]], 1)
+        pipeline.expire(rows_key(session.key), ttl)
+        pipeline.expire(session._redis_key, ttl)
+        pipeline.execute()
+
+    def load_row_results(self, session_id: str) -> Dict[int, Dict]:
+        """ Read the results recorded so far for the rows of a batch session, keyed by row index """
+        return {int(index): json.loads(value) for index, value in self.redis.hgetall(rows_key(session_id)).items()}
+
+    def status_counts(self) -> Dict[str, int]:
+        """ Count the sessions in each status """
+        pipeline = self.redis.pipeline(transaction=False)
+        for status in ALL_STATUSES:
+            pipeline.zcard(status_key(self.instance_key, status))
+        return dict(zip(ALL_STATUSES, pipeline.execute()))
+
+    def sessions_using_template(self, template_id: str) -> List[str]:
+        """ The sessions which haven't been compiled yet and refer to a template in the template library. The
+        templates of every such session are read, so this is meant for the rare removal of a template. """
+        found = []
+        for status in (EDITABLE_TEXT, FINALIZED_TEXT):
+            for key in self.redis.zrange(status_key(self.instance_key, status), 0, -1):
+                session_id = key.decode()
+                entries = self.redis.hscan_iter(to_key(session_id), match=f"{TEMPLATE_PREFIX}*")
+                if any(json.loads(value).get("template") == template_id for _, value in entries):
+                    found.append(session_id)
+        return found
+
+    def oldest_in_status(self, status: str) -> float:
+        """ The time at which the session which has been in the given status the longest entered it, or None if there
+        are no sessions in that status """
+        oldest = self.redis.zrange(status_key(self.instance_key, status), 0, 0, withscores=True)
+        return oldest[0][1] if oldest else None
+
+    def get_expired_session_ids(self, now: float, count: int) -> List[str]:
+        """ Get up to count of the sessions which expired at or before the given time, oldest first """
+        data = self.redis.zrangebyscore(expiry_key(self.instance_key), "-inf", now, start=0, num=count)
+        return [d.decode() for d in data]
+
+    def load_fields(self, session_id: str, *fields: str) -> Dict:
+        """ Read only the given fields of a stored session, returning None if the session doesn't exist """
+        values = self.redis.hmget(to_key(session_id), fields)
+        if all(v is None for v in values):
+            return None
+        return {name: json.loads(v) if v is not None else None for name, v in zip(fields, values)}
+
+    def wait_for_result(self, session_id: str, timeout: float) -> str:
+        """ Wait up to timeout seconds for a session to be compiled, returning the session's status when it completes or
+        the time runs out, or None if the session no longer exists """
+        status = None
+        for status in self.status_changes(session_id, timeout):
+            pass
+        return status
+
+    def status_changes(self, session_id: str, timeout: float, heartbeat: float = None) -> Iterator[str]:
+        """ Yield the status of a session, then its new status each time it changes, until the session is compiled or
+        removed (yielding None) or the timeout passes. If a heartbeat interval is given, the unchanged status is also
+        yielded again whenever that long has passed without a change, so a caller holding a connection open can write
+        to it. """
+        deadline = time.monotonic() + timeout
+        recheck = min(heartbeat, _STATUS_RECHECK_SEC) if heartbeat is not None else _STATUS_RECHECK_SEC
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            # Subscribe before reading the status, so that a change made in between can't be missed
+            pubsub.subscribe(status_channel(self.instance_key, session_id))
+            status = self._load_status(session_id)
+            yield status
+            last_yield = time.monotonic()
+
+            while status in (EDITABLE_TEXT, FINALIZED_TEXT):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                message = pubsub.get_message(timeout=min(remaining, recheck))
+                if message is not None and message["type"] == "message":
+                    changed = json.loads(message["data"])
+                else:
+                    changed = self._load_status(session_id)
+
+                if changed != status:
+                    status = changed
+                    yield status
+                    last_yield = time.monotonic()
+                elif heartbeat is not None and time.monotonic() - last_yield >= heartbeat:
+                    yield status
+                    last_yield = time.monotonic()
+        finally:
+            pubsub.close()
+
+    def _load_status(self, session_id: str) -> str:
+        fields = self.load_fields(session_id, "status")
+        return fields["status"] if fields is not None else None
 
     def load_session(self, session_id: str) -> Session:
-        data: bytes = self.redis.get(to_key(session_id))
-        if data is None:
+        data: Dict[bytes, bytes] = self.redis.hgetall(to_key(session_id))
+        if b"key" not in data:
             return None
 
-        kwargs = json.loads(data.decode())
-        kwargs["file_service"] = self.root_file_service.create_from(session_id)
+        kwargs = {manifest: {} for manifest in _MANIFESTS.values()}
+        for name, value in data.items():
+            name = name.decode()
+            prefix = name[:name.find(":") + 1]
+            if prefix in _MANIFESTS:
+                kwargs[_MANIFESTS[prefix]][name[len(prefix):]] = json.loads(value)
+            else:
+                kwargs[name] = json.loads(value)
+        kwargs["file_service_factory"] = partial(self.root_file_service.create_from, session_id)
         kwargs["save_callback"] = self.save_session
+        kwargs["blob_store"] = self.blob_store
         return Session(**kwargs)
 
     def get_all_session_ids(self) -> Set[str]:
@@ -291,7 +909,8 @@ class SessionManager:
 
 def clear_expired_sessions(working_directory: str, instance_key: str, **kwargs):
     """
-    Go through and clear the data for any expired sessions
+    Go through and clear the data for any expired sessions, taking them from the expiration index in batches so that
+    the cost depends only on how many sessions have expired
     :param working_directory:
     :param instance_key:
     :return:
@@ -302,9 +921,16 @@ def clear_expired_sessions(working_directory: str, instance_key: str, **kwargs):
     redis_client = redis.from_url(ConfigBase.REDIS_URL)
     manager = SessionManager(redis_client, time_service, instance_key, working_directory)
 
-    for session_id in manager.get_all_session_ids():
-        session = manager.load_session(session_id)
-        if time_service.now >= session.expires_at:
-            logging.info("Removing session %s", session.key)
-            manager.delete_session(session)
+    now = time_service.now
+    while True:
+        expired = manager.get_expired_session_ids(now, EXPIRY_BATCH_SIZE)
+        if not expired:
+            break
+        logging.info("Removing sessions %s", ", ".join(expired))
+        manager.delete_sessions(expired)
+
+    manager.sweep_blobs(now - int(ConfigBase.BLOB_RETENTION_SEC))
 
+    # Every distinct template text adds a file of bytecode, so the directory is kept to its budget here as well
+    sweep_template_bytecode(os.path.join(working_directory, TEMPLATE_BYTECODE_DIRECTORY),
+                            int(ConfigBase.TEMPLATE_BYTECODE_MAX_MB) * 1024 * 1024)
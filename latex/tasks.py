@@ -1,12 +1,49 @@
+from celery import chord
+
 from latex import celery
-from latex.rendering import compile_latex
+from latex.rendering import compile_latex, compile_rows, collect_rows, session_batch_chunks
 from latex.session import clear_expired_sessions
+from latex.services.callbacks import deliver_callbacks, pending_callbacks
 
 import logging
 
 @celery.task
 def background_run_compile(session_id: str, working_directory: str, instance_key: str):
+    # The rows of a batch session are compiled in chunks spread over the workers, and collected once they all finish
+    chunks = session_batch_chunks(session_id, working_directory, instance_key)
+    if chunks:
+        rows = [background_compile_rows.si(session_id, working_directory, instance_key, start, stop)
+                for start, stop in chunks]
+        # The chord's callback isn't run if a chunk's task fails outright, or its worker process is lost, so its errback
+        # collects the rows instead, which fails the session for the rows left without a result
+        collect = background_collect_rows.si(session_id, working_directory, instance_key)
+        chord(rows)(collect.on_error(background_collect_rows.si(session_id, working_directory, instance_key)))
+        return
+
     compile_latex(session_id, working_directory, instance_key)
+    _send_callbacks(instance_key)
+
+
+@celery.task
+def background_compile_rows(session_id: str, working_directory: str, instance_key: str, start: int, stop: int):
+    compile_rows(session_id, working_directory, instance_key, start, stop)
+
+
+@celery.task
+def background_collect_rows(session_id: str, working_directory: str, instance_key: str):
+    collect_rows(session_id, working_directory, instance_key)
+    _send_callbacks(instance_key)
+
+
+def _send_callbacks(instance_key: str):
+    # Send the session's completion callback right away, rather than at the next periodic delivery
+    if pending_callbacks(instance_key):
+        background_deliver_callbacks.delay(instance_key)
+
+
+@celery.task
+def background_deliver_callbacks(instance_key: str):
+    deliver_callbacks(instance_key)
 
 
 @celery.task
@@ -0,0 +1,149 @@
+"""
+    Helpers for reading the log files written by the LaTeX compilers.  Logs of large documents can run to many
+    megabytes, so they are always read as a stream of lines rather than loaded into memory all at once.
+
+    TeX hard wraps the lines it writes to the log at max_print_line characters (79 by default), which can split a
+    message across two physical lines.  The line iterator here rejoins wrapped lines before they are matched.
+
+    Besides looking for the messages which ask for another compiler pass, a log can be turned into structured errors
+    and warnings.  Each diagnostic is a dictionary with the file, the line in that file (either may be None when the
+    log doesn't say), and the message.  Errors are recognized both in the "file:line: message" form written when the
+    compiler is run with -file-line-error and in TeX's classic "! message" form, in which case the line is taken from
+    the "l.<number>" context line which follows.  The file for warnings and classic errors is worked out by tracking
+    the parentheses TeX writes to the log as it opens and closes input files.
+
+"""
+import re
+from collections import namedtuple
+from typing import Iterator, List, Optional
+
+MAX_PRINT_LINE = 79
+
+# Messages written by the LaTeX kernel and common packages (hyperref, rerunfilecheck, natbib, longtable, etc) when the
+# document needs to be compiled again for its cross-references, citations, outlines or table widths to settle
+_RERUN_MARKERS = re.compile(r"Rerun to get|Please rerun|Rerun LaTeX|Label\(s\) may have changed|"
+                            r"Citation\(s\) may have changed")
+
+_FILE_LINE_ERROR = re.compile(r"^(?P<file>[^:\s()][^:()]*):(?P<line>\d+): (?P<message>.+)$")
+_CLASSIC_ERROR = re.compile(r"^! (?P<message>.+)$")
+_CONTEXT_LINE = re.compile(r"^l\.(?P<line>\d+)")
+_WARNING = re.compile(r"^(?:LaTeX|(?:Package|Class) (?P<package>\S+)) Warning: (?P<message>.+)$")
+_INPUT_LINE = re.compile(r"on input line (\d+)")
+_PARENTHESIS = re.compile(r"\((?P<file>[^\s()]*)|\)")
+
+# The number of lines after a classic error in which to look for the context line giving its line number
+_CONTEXT_SEARCH_LINES = 10
+
+LogSummary = namedtuple('LogSummary', 'rerun errors warnings error_count warning_count')
+
+
+def iter_log_lines(log_path: str) -> Iterator[str]:
+    """ Iterate over the logical lines of a TeX log, rejoining lines which TeX wrapped at max_print_line """
+    pending = ""
+    with open(log_path, "r", errors="replace") as handle:
+        for line in handle:
+            line = line.rstrip("\r\n")
+            if len(line) == MAX_PRINT_LINE:
+                pending += line
+                continue
+            yield pending + line
+            pending = ""
+    if pending:
+        yield pending
+
+
+def _diagnostic(file: Optional[str], line: Optional[int], message: str):
+    return {"file": file, "line": line, "message": message.strip()}
+
+
+class _FileStack:
+    """ Follows the input files TeX has open by matching the parentheses it writes around them in the log. Every
+    opening parenthesis is pushed so that parentheses in ordinary messages stay balanced, but only the ones followed by
+    something which looks like a path count as files. """
+    def __init__(self):
+        self._stack: List[Optional[str]] = []
+
+    @property
+    def current(self) -> Optional[str]:
+        for item in reversed(self._stack):
+            if item is not None:
+                return item
+        return None
+
+    def update(self, line: str):
+        for match in _PARENTHESIS.finditer(line):
+            if match.group(0) == ")":
+                if self._stack:
+                    self._stack.pop()
+            else:
+                name = match.group("file")
+                self._stack.append(name if "." in name or "/" in name else None)
+
+
+def scan_log(log_path: str, max_items: int = 100) -> LogSummary:
+    """ Read through a TeX log once, collecting whether it asks for another pass along with the errors and warnings
+    it contains. At most max_items of each are kept, but all of them are counted. """
+    rerun = False
+    errors, warnings = [], []
+    error_count, warning_count = 0, 0
+    files = _FileStack()
+
+    # A classic error waiting for its context line, and the warning whose continuation lines are being collected
+    open_error, open_error_age = None, 0
+    open_warning, open_warning_package = None, None
+
+    for line in iter_log_lines(log_path):
+        if not rerun and _RERUN_MARKERS.search(line):
+            rerun = True
+
+        if open_error is not None:
+            context = _CONTEXT_LINE.match(line)
+            open_error_age += 1
+            if context:
+                open_error["line"] = int(context.group("line"))
+            if context or open_error_age > _CONTEXT_SEARCH_LINES:
+                open_error = None
+            continue
+
+        if open_warning is not None:
+            if open_warning_package and line.startswith(f"({open_warning_package})"):
+                open_warning["message"] += " " + line[len(open_warning_package) + 2:].strip()
+                continue
+            input_line = _INPUT_LINE.search(open_warning["message"])
+            if input_line:
+                open_warning["line"] = int(input_line.group(1))
+            open_warning = None
+
+        match = _FILE_LINE_ERROR.match(line)
+        if match:
+            error_count += 1
+            if len(errors) < max_items:
+                errors.append(_diagnostic(match.group("file"), int(match.group("line")), match.group("message")))
+            continue
+
+        match = _CLASSIC_ERROR.match(line)
+        if match:
+            error_count += 1
+            if len(errors) < max_items:
+                open_error, open_error_age = _diagnostic(files.current, None, match.group("message")), 0
+                errors.append(open_error)
+            continue
+
+        match = _WARNING.match(line)
+        if match:
+            warning_count += 1
+            if len(warnings) < max_items:
+                open_warning = _diagnostic(files.current, None, match.group("message"))
+                open_warning_package = match.group("package")
+                warnings.append(open_warning)
+            continue
+
+        files.update(line)
+
+    if open_warning is not None:
+        input_line = _INPUT_LINE.search(open_warning["message"])
+        if input_line:
+            open_warning["line"] = int(input_line.group(1))
+
+    return LogSummary(rerun=rerun, errors=errors, warnings=warnings, error_count=error_count,
+                      warning_count=warning_count)
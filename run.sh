@@ -6,7 +6,9 @@ if [[ "$COMPONENT" == "web" ]]; then
 
   if [[ "$FLASK_ENV" == "production" ]]; then
     echo "Setting this container to run the web service using gunicorn"
-    exec gunicorn --bind 0.0.0.0:5000 "latex:create_app()"
+    # Requests waiting on a compilation are held open by a thread rather than a whole worker process
+    exec gunicorn --bind 0.0.0.0:5000 --worker-class gthread --workers "${WEB_WORKERS:-2}" --threads "${WEB_THREADS:-32}" \
+      "latex:create_app()"
 
   else
     echo "Setting this container to run the development web service using wsgi"
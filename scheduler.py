@@ -18,3 +18,8 @@ def setup_periodic_tasks(sender: Celery, **kwargs):
                                                                     ConfigBase.INSTANCE_KEY),
                              name="Clear Expired Sessions")
 
+    # Completion callbacks are sent as soon as their sessions are compiled, this delivers the retries of failed ones
+    sender.add_periodic_task(int(ConfigBase.CALLBACK_INTERVAL_SEC),
+                             latex.tasks.background_deliver_callbacks.s(ConfigBase.INSTANCE_KEY),
+                             name="Deliver Callbacks")
+
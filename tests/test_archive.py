@@ -0,0 +1,70 @@
+import io
+import tarfile
+import zipfile
+import pytest
+
+from latex.services.archive import read_archive, ArchiveError
+
+
+def make_tar(files, mode="w:gz") -> io.BytesIO:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as archive:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    buffer.seek(0)
+    return buffer
+
+
+def make_zip(files) -> io.BytesIO:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    buffer.seek(0)
+    return buffer
+
+
+def read_all(stream, max_members=100, max_bytes=1024 * 1024):
+    return {path: reader.read() for path, reader in read_archive(stream, max_members, max_bytes)}
+
+
+_files = {"main.tex": b"document", "chapters/one.tex": b"chapter one"}
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz", "w:bz2", "w:xz"])
+def test_reads_tar(mode):
+    assert read_all(make_tar(_files, mode)) == _files
+
+
+def test_reads_zip():
+    assert read_all(make_zip(_files)) == _files
+
+
+def test_member_limit():
+    with pytest.raises(ArchiveError):
+        read_all(make_tar(_files), max_members=1)
+
+
+def test_size_limit():
+    with pytest.raises(ArchiveError):
+        read_all(make_zip({"big.tex": b"x" * 10000}), max_bytes=1000)
+
+
+def test_rejects_symlink():
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as archive:
+        info = tarfile.TarInfo("link.tex")
+        info.type = tarfile.SYMTYPE
+        info.linkname = "/etc/passwd"
+        archive.addfile(info)
+    buffer.seek(0)
+
+    with pytest.raises(ArchiveError):
+        read_all(buffer)
+
+
+def test_rejects_garbage():
+    with pytest.raises(ArchiveError):
+        read_all(io.BytesIO(b"this is not an archive" * 100))
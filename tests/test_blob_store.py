@@ -0,0 +1,93 @@
+import os
+import hashlib
+import pytest
+import tempfile
+
+from latex.services.blob_store import BlobStore, unshare_tree
+
+
+class BlobFixture:
+    def __init__(self, temp_path):
+        self.store_dir = os.path.join(temp_path, "blobs")
+        self.session_dir = os.path.join(temp_path, "session")
+        os.makedirs(self.session_dir)
+        self.store = BlobStore(self.store_dir)
+
+    def write(self, name: str, content: bytes) -> str:
+        path = os.path.join(self.session_dir, name)
+        with open(path, "wb") as handle:
+            handle.write(content)
+        return path
+
+
+@pytest.fixture(scope="function")
+def blob_fixture() -> BlobFixture:
+    with tempfile.TemporaryDirectory() as temp_path:
+        yield BlobFixture(temp_path)
+
+
+def digest_of(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def test_add_then_link(blob_fixture: BlobFixture):
+    path = blob_fixture.write("font.otf", b"font data")
+    blob_fixture.store.add(path, digest_of(b"font data"))
+
+    destination = os.path.join(blob_fixture.session_dir, "other", "font.otf")
+    assert blob_fixture.store.link_into(digest_of(b"font data"), destination)
+    with open(destination, "rb") as handle:
+        assert handle.read() == b"font data"
+    assert os.stat(destination).st_ino == os.stat(path).st_ino
+
+
+def test_link_missing_is_false(blob_fixture: BlobFixture):
+    destination = os.path.join(blob_fixture.session_dir, "font.otf")
+    assert not blob_fixture.store.link_into(digest_of(b"font data"), destination)
+    assert not blob_fixture.store.link_into("not a digest", destination)
+    assert not os.path.exists(destination)
+
+
+def test_link_replaces_existing_file(blob_fixture: BlobFixture):
+    path = blob_fixture.write("logo.png", b"logo")
+    blob_fixture.store.add(path, digest_of(b"logo"))
+    existing = blob_fixture.write("old.png", b"old content")
+
+    assert blob_fixture.store.link_into(digest_of(b"logo"), existing)
+    with open(path, "rb") as handle:
+        assert handle.read() == b"logo"
+    with open(existing, "rb") as handle:
+        assert handle.read() == b"logo"
+
+
+def test_unreferenced_after_session_files_removed(blob_fixture: BlobFixture):
+    path = blob_fixture.write("refs.bib", b"bibliography")
+    digest = digest_of(b"bibliography")
+    blob_fixture.store.add(path, digest)
+    assert blob_fixture.store.unreferenced([digest]) == []
+    assert not blob_fixture.store.remove_unreferenced(digest)
+
+    os.remove(path)
+
+    assert blob_fixture.store.unreferenced([digest]) == [digest]
+    assert blob_fixture.store.remove_unreferenced(digest)
+    assert not blob_fixture.store.has(digest)
+
+
+def test_unshare_tree_protects_blob(blob_fixture: BlobFixture):
+    path = blob_fixture.write("chapter.aux", b"stored")
+    blob_fixture.store.add(path, digest_of(b"stored"))
+    blob_fixture.write("unshared.tex", b"own")
+    font = blob_fixture.write("body.otf", b"font")
+    blob_fixture.store.add(font, digest_of(b"font"))
+
+    unshare_tree(blob_fixture.session_dir, lambda name: name.endswith(".aux"))
+    assert os.stat(path).st_nlink == 1
+    # A file the compiler doesn't write stays linked to its blob rather than being copied
+    assert os.stat(font).st_nlink == 2
+    with open(path, "wb") as handle:
+        handle.write(b"rewritten by the compiler")
+
+    with open(blob_fixture.store.path(digest_of(b"stored")), "rb") as handle:
+        assert handle.read() == b"stored"
+    assert sorted(os.listdir(blob_fixture.session_dir)) == ["body.otf", "chapter.aux", "unshared.tex"]
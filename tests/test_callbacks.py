@@ -0,0 +1,165 @@
+import json
+import uuid
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import redis
+
+from latex.config import TestConfig
+from latex.services.callbacks import CallbackQueue, queue_callback, callbacks_key
+
+
+class Receiver:
+    """ A stand-in for a client's HTTP server receiving callbacks, which answers with the status in response_code """
+    def __init__(self):
+        self.received = []
+        self.connections = set()
+        self.response_code = 200
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                receiver.received.append((self.path, json.loads(body)))
+                receiver.connections.add(self.client_address)
+                self.send_response(receiver.response_code)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class CallbackFixture:
+    def __init__(self, client):
+        self.client = client
+        self.instance = str(uuid.uuid4()).replace("-", "")[:10]
+        self.queue = CallbackQueue(client, self.instance, timeout=2, retry_sec=10, max_attempts=3,
+                                   allowed_hosts=["127.0.0.1"])
+
+    def add(self, url: str, key: str, due: float = 100):
+        queue_callback(self.client, self.instance, url, {"key": key, "status": "success"}, due)
+
+    def pending(self):
+        return [(json.loads(member), score) for member, score in
+                self.client.zrange(callbacks_key(self.instance), 0, -1, withscores=True)]
+
+
+@pytest.fixture(scope="function")
+def fixture() -> CallbackFixture:
+    client = redis.from_url(TestConfig.REDIS_URL)
+    test_fixture = CallbackFixture(client)
+    yield test_fixture
+    client.delete(callbacks_key(test_fixture.instance))
+
+
+@pytest.fixture(scope="function")
+def receiver() -> Receiver:
+    stand_in = Receiver()
+    yield stand_in
+    stand_in.close()
+
+
+def unused_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_due_callback_delivered(fixture: CallbackFixture, receiver: Receiver):
+    fixture.add(f"{receiver.url}/hooks/latex?team=docs", "session1")
+
+    assert fixture.queue.deliver_due(100) == 1
+    assert receiver.received == [("/hooks/latex?team=docs", {"key": "session1", "status": "success"})]
+    assert fixture.pending() == []
+
+
+def test_callback_not_delivered_before_due(fixture: CallbackFixture, receiver: Receiver):
+    fixture.add(receiver.url, "session1", due=200)
+
+    assert fixture.queue.deliver_due(100) == 0
+    assert receiver.received == []
+    assert fixture.queue.due_count(200) == 1
+
+
+def test_callbacks_to_one_host_share_a_connection(fixture: CallbackFixture, receiver: Receiver):
+    for i in range(5):
+        fixture.add(f"{receiver.url}/hook", f"session{i}", due=100 + i)
+
+    assert fixture.queue.deliver_due(104) == 5
+    assert [document["key"] for _, document in receiver.received] == [f"session{i}" for i in range(5)]
+    assert len(receiver.connections) == 1
+
+
+def test_rejected_callback_retried_with_backoff(fixture: CallbackFixture, receiver: Receiver):
+    receiver.response_code = 500
+    fixture.add(receiver.url, "session1")
+
+    fixture.queue.deliver_due(100)
+    [(notification, due)] = fixture.pending()
+    assert notification["attempts"] == 1
+    assert due == 110
+
+    fixture.queue.deliver_due(110)
+    [(notification, due)] = fixture.pending()
+    assert notification["attempts"] == 2
+    assert due == 130
+
+    # The third failure reaches the most attempts allowed
+    fixture.queue.deliver_due(130)
+    assert fixture.pending() == []
+    assert len(receiver.received) == 3
+
+
+def test_unreachable_host_fails_its_batch(fixture: CallbackFixture, receiver: Receiver):
+    down = f"http://127.0.0.1:{unused_port()}/hook"
+    fixture.add(down, "session1")
+    fixture.add(down, "session2")
+    fixture.add(receiver.url, "session3")
+
+    assert fixture.queue.deliver_due(100) == 3
+    assert [document["key"] for _, document in receiver.received] == ["session3"]
+    assert sorted(n["document"]["key"] for n, _ in fixture.pending()) == ["session1", "session2"]
+    assert all(n["attempts"] == 1 for n, _ in fixture.pending())
+
+
+def test_callback_to_private_address_refused(fixture: CallbackFixture, receiver: Receiver):
+    fixture.queue.allowed_hosts = ()
+    fixture.add(receiver.url, "session1")
+    fixture.add(f"http://localhost:{receiver.server.server_port}/hook", "session2")
+
+    assert fixture.queue.deliver_due(100) == 2
+    assert receiver.received == []
+    assert fixture.pending() == []
+
+
+def test_invalid_callback_url_not_left_leased(fixture: CallbackFixture):
+    fixture.add("http://127.0.0.1:99999/hook", "session1")
+    fixture.add("http://127.0.0.1:port/hook", "session2")
+
+    assert fixture.queue.deliver_due(100) == 2
+    assert fixture.pending() == []
+
+
+def test_claimed_callbacks_leased(fixture: CallbackFixture):
+    fixture.add("http://127.0.0.1/hook", "session1")
+
+    assert len(fixture.queue.claim(100, 10)) == 1
+    assert fixture.queue.claim(100, 10) == []
+
+    # A worker which stopped without delivering leaves the notification to be claimed again after its lease
+    [(_, lease_end)] = fixture.pending()
+    assert len(fixture.queue.claim(lease_end, 10)) == 1
@@ -237,3 +237,38 @@ def test_create_from_subdirectory(simple_temp_paths):
     assert created.root_path == os.path.join(service.root_path, "test", "")
 
 
+@pytest.mark.parametrize("resolve_beneath", [True, False])
+def test_open_relative_up_tokens_fail(simple_temp_paths, resolve_beneath):
+    service, temp0, temp1, parent = simple_temp_paths
+    service = FileService(temp0, resolve_beneath=resolve_beneath)
+
+    with pytest.raises(ValueError):
+        service.open(os.path.join("..", "temp1", "test.txt"), "w")
+    assert not os.path.exists(os.path.join(temp1, "test.txt"))
+
+
+@pytest.mark.parametrize("resolve_beneath", [True, False])
+def test_open_symlink_escape_fails(simple_temp_paths, resolve_beneath):
+    service, temp0, temp1, parent = simple_temp_paths
+    service = FileService(temp0, resolve_beneath=resolve_beneath)
+    make_test_files(os.path.join(temp1, "sub"))
+    os.symlink(os.path.join(temp1, "sub"), os.path.join(temp0, "link"))
+
+    with pytest.raises(ValueError):
+        service.open(os.path.join("link", "test0.txt"), "r")
+    with pytest.raises(ValueError):
+        service.exists(os.path.join(temp0, "link", "test0.txt"))
+    with pytest.raises(ValueError):
+        service.create_from("link")
+
+
+@pytest.mark.parametrize("resolve_beneath", [True, False])
+def test_open_for_write_creates_directories(simple_temp_paths, resolve_beneath):
+    service, temp0, temp1, parent = simple_temp_paths
+    service = FileService(temp0, resolve_beneath=resolve_beneath)
+
+    with service.open(os.path.join("sub0", "sub1", "test.txt"), "wb") as handle:
+        handle.write(b"test data 0")
+
+    with open(os.path.join(temp0, "sub0", "sub1", "test.txt"), "r") as handle:
+        assert handle.read() == "test data 0"
@@ -0,0 +1,131 @@
+import os
+import time
+import pytest
+import tempfile
+
+from latex.services.format_cache import FormatCache, read_preamble, preamble_digest
+
+
+class FormatFixture:
+    def __init__(self, temp_path):
+        self.store_dir = os.path.join(temp_path, "formats")
+        self.source_dir = os.path.join(temp_path, "source")
+        os.makedirs(self.source_dir)
+
+
+@pytest.fixture(scope="function")
+def format_fixture() -> FormatFixture:
+    with tempfile.TemporaryDirectory() as temp_path:
+        yield FormatFixture(temp_path)
+
+
+def write_file(path: str, content: str):
+    with open(path, "w") as handle:
+        handle.write(content)
+
+
+def write_document(folder: str, preamble: str, body: str, name="doc.tex"):
+    write_file(os.path.join(folder, name), preamble + "\\begin{document}\n" + body + "\\end{document}\n")
+
+
+def test_read_preamble_stops_at_begin_document(format_fixture: FormatFixture):
+    write_document(format_fixture.source_dir, "\\documentclass{article}\n\\usepackage{tikz}\n", "Body text\n")
+    preamble = read_preamble(os.path.join(format_fixture.source_dir, "doc.tex"))
+    assert preamble == "\\documentclass{article}\n\\usepackage{tikz}\n"
+
+
+def test_read_preamble_ignores_commented_begin_document(format_fixture: FormatFixture):
+    write_document(format_fixture.source_dir, "\\documentclass{article}\n% \\begin{document}\n", "Body text\n")
+    preamble = read_preamble(os.path.join(format_fixture.source_dir, "doc.tex"))
+    assert preamble == "\\documentclass{article}\n% \\begin{document}\n"
+
+
+def test_read_preamble_without_document_is_none(format_fixture: FormatFixture):
+    write_file(os.path.join(format_fixture.source_dir, "part.tex"), "\\section{Only a fragment}\n")
+    assert read_preamble(os.path.join(format_fixture.source_dir, "part.tex")) is None
+
+
+def test_digest_ignores_body(format_fixture: FormatFixture):
+    write_document(format_fixture.source_dir, "\\documentclass{article}\n", "First body\n")
+    first = preamble_digest("pdflatex", format_fixture.source_dir, "doc.tex")
+    write_document(format_fixture.source_dir, "\\documentclass{article}\n", "Second body\n")
+    assert preamble_digest("pdflatex", format_fixture.source_dir, "doc.tex") == first
+
+
+def test_digest_depends_on_compiler_and_preamble(format_fixture: FormatFixture):
+    write_document(format_fixture.source_dir, "\\documentclass{article}\n", "Body\n")
+    first = preamble_digest("pdflatex", format_fixture.source_dir, "doc.tex")
+    assert preamble_digest("xelatex", format_fixture.source_dir, "doc.tex") != first
+
+    write_document(format_fixture.source_dir, "\\documentclass{article}\n\\usepackage{tikz}\n", "Body\n")
+    assert preamble_digest("pdflatex", format_fixture.source_dir, "doc.tex") != first
+
+
+def test_digest_depends_on_local_packages(format_fixture: FormatFixture):
+    write_document(format_fixture.source_dir, "\\documentclass{article}\n\\usepackage{mystyle}\n", "Body\n")
+    write_file(os.path.join(format_fixture.source_dir, "mystyle.sty"), "\\newcommand{\\a}{A}\n")
+    first = preamble_digest("pdflatex", format_fixture.source_dir, "doc.tex")
+    write_file(os.path.join(format_fixture.source_dir, "mystyle.sty"), "\\newcommand{\\a}{B}\n")
+    assert preamble_digest("pdflatex", format_fixture.source_dir, "doc.tex") != first
+
+
+def test_digest_depends_on_inputs_only_when_preamble_inputs(format_fixture: FormatFixture):
+    chapter = os.path.join(format_fixture.source_dir, "chapter.tex")
+    write_document(format_fixture.source_dir, "\\documentclass{article}\n", "\\input{chapter}\n")
+    write_file(chapter, "One\n")
+    first = preamble_digest("pdflatex", format_fixture.source_dir, "doc.tex")
+    write_file(chapter, "Two\n")
+    assert preamble_digest("pdflatex", format_fixture.source_dir, "doc.tex") == first
+
+    write_document(format_fixture.source_dir, "\\documentclass{article}\n\\input{chapter}\n", "Body\n")
+    second = preamble_digest("pdflatex", format_fixture.source_dir, "doc.tex")
+    write_file(chapter, "Three\n")
+    assert preamble_digest("pdflatex", format_fixture.source_dir, "doc.tex") != second
+
+
+def test_store_then_fetch(format_fixture: FormatFixture):
+    cache = FormatCache(format_fixture.store_dir, 1024 * 1024)
+    built = os.path.join(format_fixture.source_dir, "built.fmt")
+    write_file(built, "format data")
+    cache.store("a" * 64, built)
+
+    destination = os.path.join(format_fixture.source_dir, "session-preamble.fmt")
+    assert cache.fetch("a" * 64, destination)
+    with open(destination, "r") as handle:
+        assert handle.read() == "format data"
+
+
+def test_fetch_missing_is_false(format_fixture: FormatFixture):
+    cache = FormatCache(format_fixture.store_dir, 1024 * 1024)
+    assert not cache.fetch("a" * 64, os.path.join(format_fixture.source_dir, "session-preamble.fmt"))
+
+
+def test_mark_failed_discards_format(format_fixture: FormatFixture):
+    cache = FormatCache(format_fixture.store_dir, 1024 * 1024)
+    built = os.path.join(format_fixture.source_dir, "built.fmt")
+    write_file(built, "format data")
+    cache.store("a" * 64, built)
+
+    cache.mark_failed("a" * 64)
+
+    assert cache.has_failed("a" * 64)
+    assert not cache.fetch("a" * 64, os.path.join(format_fixture.source_dir, "session-preamble.fmt"))
+
+
+def test_eviction_removes_least_recently_used(format_fixture: FormatFixture):
+    cache = FormatCache(format_fixture.store_dir, 2500)
+    for i, digest in enumerate(("a" * 64, "b" * 64, "c" * 64)):
+        built = os.path.join(format_fixture.source_dir, "built.fmt")
+        write_file(built, "x" * 1000)
+        if i == 2:
+            # Using the oldest format makes the second one the least recently used
+            assert cache.fetch("a" * 64, os.path.join(format_fixture.source_dir, "used.fmt"))
+        cache.store(digest, built)
+        if i < 2:
+            stored = os.path.join(format_fixture.store_dir, digest + ".fmt")
+            os.utime(stored, (time.time() - 100 + i, time.time() - 100 + i))
+
+    destination = os.path.join(format_fixture.source_dir, "check.fmt")
+    assert cache.fetch("a" * 64, destination)
+    assert not cache.fetch("b" * 64, destination)
+    assert cache.fetch("c" * 64, destination)
@@ -1,5 +1,11 @@
 import os
 import io
+import errno
+import json
+import zipfile
+import threading
+import base64
+import hashlib
 import shutil
 import pytest
 import tempfile
@@ -7,10 +13,18 @@ from flask import Response, Request, Flask
 from flask.testing import FlaskClient
 from latex import create_app, time_service, session_manager, redis_client
 
-from latex.config import TestConfig
-from latex.session import Session, FINALIZED_TEXT, SUCCESS_TEXT, ERROR_TEXT, EDITABLE_TEXT
-from latex.rendering import compile_latex, RenderResult
+from latex.config import TestConfig, ConfigBase
+from latex.session import Session, expiry_key, status_key, blobs_key, ALL_STATUSES, FINALIZED_TEXT, SUCCESS_TEXT, ERROR_TEXT, EDITABLE_TEXT
+from latex import rendering
+from latex.rendering import compile_latex, RenderResult, STOP_TEMPLATE_UNAVAILABLE
+from latex.tasks import background_run_compile
+from latex.services.result_cache import stats_key
+from latex.services.template_cache import template_stats_key, TemplateCache
+from latex.services.template_library import TemplateLibrary, library_key
+from latex.services.callbacks import callbacks_key
+from latex.services.product_store import product_store_keys
 from tests.test_sessions import find_test_asset_folder, hash_file
+from tests.test_archive import make_tar, make_zip
 
 
 def file_byte_stream(file_path):
@@ -50,6 +64,15 @@ def fixture():
 
         element_key = f"session:{element.decode()}"
         redis_client.delete(element_key)
+    redis_client.delete(stats_key(session_manager.instance_key))
+    redis_client.delete(template_stats_key(session_manager.instance_key))
+    redis_client.delete(library_key(session_manager.instance_key))
+    redis_client.delete(expiry_key(session_manager.instance_key))
+    redis_client.delete(blobs_key(session_manager.instance_key))
+    redis_client.delete(callbacks_key(session_manager.instance_key))
+    redis_client.delete(*product_store_keys(session_manager.instance_key))
+    for status in ALL_STATUSES:
+        redis_client.delete(status_key(session_manager.instance_key, status))
 
 
 def finalize_session(fixture: TestFixture, session: Session):
@@ -134,6 +157,29 @@ def test_post_session_fails_if_convert_is_wrong_dpi(fixture: TestFixture):
     assert response.status_code == 400
 
 
+def test_post_session_fails_if_convert_pages_are_wrong(fixture: TestFixture):
+    for pages in ("some", [2], [0, 3], [3, 2], [1, "2"], {"first": 1}):
+        data = {"compiler": "pdflatex", "target": "test.tex", "convert": {"format": "png", "dpi": 200, "pages": pages}}
+        response: Response = fixture.client.post("/api/sessions", json=data, follow_redirects=True)
+        assert response.status_code == 400
+
+
+def test_post_session_creates_with_convert_pages(fixture: TestFixture):
+    for pages in ("all", [2, 5]):
+        data = {"compiler": "pdflatex", "target": "test.tex", "convert": {"format": "png", "dpi": 200, "pages": pages}}
+        response: Response = fixture.client.post("/api/sessions", json=data, follow_redirects=True)
+        assert response.status_code == 201
+        assert response.json["convert"]["pages"] == pages
+
+
+def test_post_session_fails_if_convert_list_is_wrong(fixture: TestFixture):
+    for convert in ([], [{"format": "png", "dpi": 72}] * 9, [{"format": "png", "dpi": 72}, "jpeg"],
+                    [{"format": "png", "dpi": 72}, {"format": "gif", "dpi": 72}]):
+        data = {"compiler": "pdflatex", "target": "test.tex", "convert": convert}
+        response: Response = fixture.client.post("/api/sessions", json=data, follow_redirects=True)
+        assert response.status_code == 400
+
+
 def test_post_session_creates_new_session(fixture: TestFixture):
     data = {"compiler": "pdflatex", "target": "test.tex"}
     response: Response = fixture.client.post("/api/sessions", json=data, follow_redirects=True)
@@ -154,6 +200,62 @@ def test_post_session_creates_with_convert(fixture: TestFixture):
     assert response.status_code == 201
 
 
+def test_post_session_fails_if_format_cache_not_bool(fixture: TestFixture):
+    data = {"compiler": "pdflatex", "target": "test.tex", "format_cache": "no"}
+    response: Response = fixture.client.post("/api/sessions", json=data, follow_redirects=True)
+    assert response.status_code == 400
+
+
+def test_post_session_disables_format_cache(fixture: TestFixture):
+    data = {"compiler": "pdflatex", "target": "test.tex", "format_cache": False}
+    response: Response = fixture.client.post("/api/sessions", json=data, follow_redirects=True)
+    assert response.status_code == 201
+    assert response.json["format_cache"] is False
+    assert session_manager.load_session(response.json["key"]).format_cache is False
+
+
+def test_post_session_fails_if_fail_fast_not_bool(fixture: TestFixture):
+    data = {"compiler": "pdflatex", "target": "test.tex", "fail_fast": 1}
+    response: Response = fixture.client.post("/api/sessions", json=data, follow_redirects=True)
+    assert response.status_code == 400
+
+
+def test_set_session_fail_fast(fixture: TestFixture):
+    data = {"compiler": "pdflatex", "target": "test.tex"}
+    response: Response = fixture.client.post("/api/sessions", json=data, follow_redirects=True)
+    assert response.json["fail_fast"] is False
+
+    session_url = f"/api/sessions/{response.json['key']}"
+    post_response: Response = fixture.client.post(session_url, json={"fail_fast": True}, follow_redirects=True)
+    assert post_response.status_code == 200
+    assert post_response.json["fail_fast"] is True
+
+
+def test_post_session_fails_if_limits_invalid(fixture: TestFixture):
+    for limits in ({"timeout": 0}, {"timeout": "10"}, {"walltime": 10}, [10]):
+        data = {"compiler": "pdflatex", "target": "test.tex", "limits": limits}
+        response: Response = fixture.client.post("/api/sessions", json=data, follow_redirects=True)
+        assert response.status_code == 400
+
+
+def test_post_session_fails_if_limits_above_server(fixture: TestFixture):
+    data = {"compiler": "pdflatex", "target": "test.tex", "limits": {"timeout": 1000000}}
+    response: Response = fixture.client.post("/api/sessions", json=data, follow_redirects=True)
+    assert response.status_code == 400
+
+
+def test_set_session_limits(fixture: TestFixture):
+    data = {"compiler": "pdflatex", "target": "test.tex"}
+    response: Response = fixture.client.post("/api/sessions", json=data, follow_redirects=True)
+    assert response.json["limits"] is None
+
+    session_url = f"/api/sessions/{response.json['key']}"
+    limits = {"timeout": 30, "cpu": 20}
+    post_response: Response = fixture.client.post(session_url, json={"limits": limits}, follow_redirects=True)
+    assert post_response.status_code == 200
+    assert post_response.json["limits"] == limits
+
+
 def test_get_session_information(fixture: TestFixture):
     data = {"compiler": "pdflatex", "target": "test5.tex"}
     time_service.test.set_time(24601)
@@ -188,6 +290,94 @@ def test_add_file_to_session(fixture: TestFixture):
     assert hash_file(source_path) == hash_file(expected_path)
 
 
+def test_upload_over_directory_fails(fixture: TestFixture):
+    session = create_session_add_file(fixture, "sample1.tex", prefix="test")
+    files = {"file0": (io.BytesIO(b"not a directory"), "test")}
+    response: Response = fixture.client.post(f"/api/sessions/{session.key}/files", data=files,
+                                              content_type="multipart/form-data")
+    assert response.status_code == 400
+    assert os.path.isdir(os.path.join(session.source_files.root_path, "test"))
+
+
+def test_file_manifest(fixture: TestFixture):
+    target_file = "sample1.tex"
+    session = create_session_add_file(fixture, target_file, prefix="test")
+    source_path = os.path.join(find_test_asset_folder(), target_file)
+    with open(source_path, "rb") as handle:
+        content = handle.read()
+
+    response: Response = fixture.client.get(f"/api/sessions/{session.key}/files", follow_redirects=True)
+    assert response.json == [os.path.join("test", target_file)]
+
+    response = fixture.client.get(f"/api/sessions/{session.key}")
+    entry = response.json["file_manifest"][os.path.join("test", target_file)]
+    assert entry["size"] == len(content)
+    assert entry["digest"] == hashlib.sha256(content).hexdigest()
+    assert entry["mtime"] > 0
+
+
+def test_upload_archive(fixture: TestFixture):
+    session = create_session_add_file(fixture, "sample1.tex")
+    archive = make_tar({"thesis/main.tex": b"document", "thesis/images/figure.png": b"image"})
+
+    response: Response = fixture.client.post(f"/api/sessions/{session.key}/archive", data=archive.read(),
+                                             content_type="application/gzip")
+
+    assert response.status_code == 201
+    assert response.json == ["sample1.tex", "thesis/images/figure.png", "thesis/main.tex"]
+    with open(os.path.join(session.source_files.root_path, "thesis", "main.tex"), "rb") as handle:
+        assert handle.read() == b"document"
+
+
+def test_upload_zip_archive(fixture: TestFixture):
+    session = create_session_add_file(fixture, "sample1.tex")
+    archive = make_zip({"main.tex": b"document"})
+
+    response: Response = fixture.client.post(f"/api/sessions/{session.key}/archive", data=archive.read(),
+                                             content_type="application/zip")
+
+    assert response.status_code == 201
+    assert response.json == ["main.tex", "sample1.tex"]
+    assert session_manager.load_session(session.key).file_manifest["main.tex"]["size"] == len(b"document")
+
+
+def test_upload_archive_escaping_session_fails(fixture: TestFixture):
+    session = create_session_add_file(fixture, "sample1.tex")
+    archive = make_tar({"../escaped.tex": b"document"})
+
+    response: Response = fixture.client.post(f"/api/sessions/{session.key}/archive", data=archive.read(),
+                                             content_type="application/gzip")
+
+    assert response.status_code == 400
+    assert not os.path.exists(os.path.join(session.source_files.root_path, "..", "escaped.tex"))
+
+
+def test_link_known_files(fixture: TestFixture):
+    create_session_add_file(fixture, "sample1.tex")
+    source_path = os.path.join(find_test_asset_folder(), "sample1.tex")
+    with open(source_path, "rb") as handle:
+        digest = hashlib.sha256(handle.read()).hexdigest()
+
+    second = create_session_add_file(fixture, "small_doc.tex")
+    files = [{"path": "copy/sample1.tex", "sha256": digest}, {"path": "new.sty", "sha256": "0" * 64}]
+    response: Response = fixture.client.post(f"/api/sessions/{second.key}/files/link", json={"files": files})
+
+    assert response.status_code == 200
+    assert response.json["missing"] == [{"path": "new.sty", "sha256": "0" * 64}]
+    assert "copy/sample1.tex" in response.json["files"]
+    assert response.json["file_manifest"]["copy/sample1.tex"]["digest"] == digest
+    assert hash_file(os.path.join(second.source_files.root_path, "copy", "sample1.tex")) == hash_file(source_path)
+
+
+def test_link_files_fails_on_bad_request(fixture: TestFixture):
+    session = create_session_add_file(fixture, "sample1.tex")
+    url = f"/api/sessions/{session.key}/files/link"
+    for data in ({"files": "sample1.tex"}, {"files": [{"path": "a.tex"}]},
+                 {"files": [{"path": "../a.tex", "sha256": "0" * 64}]}):
+        response: Response = fixture.client.post(url, json=data)
+        assert response.status_code == 400
+
+
 def test_get_template_form_url(fixture: TestFixture):
     data = {"compiler": "xelatex", "target": "test.tex"}
     post_response: Response = fixture.client.post("/api/sessions", json=data, follow_redirects=True)
@@ -222,6 +412,39 @@ def test_add_template(fixture: TestFixture):
     assert template_post_response.json["test.tex"]["data"] == data2["data"]
 
 
+def test_template_manifest(fixture: TestFixture):
+    data = {"compiler": "xelatex", "target": "test.tex"}
+    post_response: Response = fixture.client.post("/api/sessions", json=data, follow_redirects=True)
+    session_key = post_response.json["key"]
+
+    data2 = {"target": "test.tex", "text": "this is the template text\n", "data": {"b": 1, "a": 2}}
+    fixture.client.post(f"/api/sessions/{session_key}/templates", json=data2, follow_redirects=True)
+
+    get_response: Response = fixture.client.get(f"/api/sessions/{session_key}", follow_redirects=True)
+    entry = get_response.json["templates"]["test.tex"]
+    assert entry["target"] == "test.tex"
+    assert entry["data_keys"] == ["a", "b"]
+    assert entry["size"] > len(data2["text"])
+    assert len(entry["digest"]) == 64
+    assert "text" not in entry
+
+
+def test_get_template_body(fixture: TestFixture):
+    data = {"compiler": "xelatex", "target": "test.tex"}
+    post_response: Response = fixture.client.post("/api/sessions", json=data, follow_redirects=True)
+    session_key = post_response.json["key"]
+
+    data2 = {"target": "sub/test.tex", "text": "this is the template text\n", "data": {"test": "hello"}}
+    fixture.client.post(f"/api/sessions/{session_key}/templates", json=data2, follow_redirects=True)
+
+    response: Response = fixture.client.get(f"/api/sessions/{session_key}/templates/sub/test.tex")
+    assert response.status_code == 200
+    assert response.json == data2
+
+    missing: Response = fixture.client.get(f"/api/sessions/{session_key}/templates/other.tex")
+    assert missing.status_code == 404
+
+
 def test_set_session_finalized(fixture: TestFixture):
     session = create_session_add_file(fixture, "sample1.tex")
     finalize_session(fixture, session)
@@ -306,6 +529,19 @@ def test_simple_rendering_sets_complete(fixture: TestFixture):
     assert os.path.exists(reloaded_session.log)
 
 
+def test_rendering_in_scratch_directory(fixture: TestFixture, monkeypatch):
+    with tempfile.TemporaryDirectory() as scratch_path:
+        monkeypatch.setattr(ConfigBase, "SCRATCH_DIRECTORY", scratch_path)
+        session = create_session_add_file(fixture, "sample1.tex")
+        result: RenderResult = compile_latex(*finalize_session(fixture, session))
+
+        assert result.success
+        assert os.path.dirname(result.product) == session_manager.product_store.entry_path(session.key)
+        assert os.path.exists(result.log)
+        assert os.listdir(scratch_path) == []
+        assert sorted(os.listdir(os.path.dirname(result.product))) == [f"{session.key}.log", f"{session.key}.pdf"]
+
+
 def test_successful_session_retrieve_product(fixture: TestFixture):
     session = create_session_add_file(fixture, "sample1.tex")
     queue_data = finalize_session(fixture, session)
@@ -320,6 +556,21 @@ def test_successful_session_retrieve_product(fixture: TestFixture):
     assert len(product_fetch.data) > 2000
 
 
+def test_repeat_rendering_uses_result_cache(fixture: TestFixture):
+    first = create_session_add_file(fixture, "small_doc.tex")
+    compile_latex(*finalize_session(fixture, first))
+    second = create_session_add_file(fixture, "small_doc.tex")
+    result: RenderResult = compile_latex(*finalize_session(fixture, second))
+
+    reloaded_session = session_manager.load_session(second.key)
+    assert reloaded_session.status == SUCCESS_TEXT
+    assert os.path.dirname(result.product) == session_manager.product_store.entry_path(second.key)
+    assert hash_file(result.product) == hash_file(session_manager.load_session(first.key).product)
+
+    response: Response = fixture.client.get("/api/status", follow_redirects=True)
+    assert response.json["result_cache"]["hits"] >= 1
+
+
 def test_failed_session_retrieve_logs(fixture: TestFixture):
     session = create_session_add_file(fixture, "bad_sample1.tex")
     queue_data = finalize_session(fixture, session)
@@ -336,7 +587,33 @@ def test_failed_session_retrieve_logs(fixture: TestFixture):
     assert "LaTeX Error: File `notarealarticle.cls' not found." in log_fetch.data.decode()
 
 
+def test_failed_session_retrieve_diagnostics(fixture: TestFixture):
+    session = create_session_add_file(fixture, "bad_sample1.tex")
+    queue_data = finalize_session(fixture, session)
+    compile_latex(*queue_data)
+
+    session_url = f"/api/sessions/{session.key}"
+    response: Response = fixture.client.get(session_url, follow_redirects=True)
+
+    diagnostics_url = response.json['diagnostics']['href']
+    diagnostics_fetch: Response = fixture.client.get(diagnostics_url, follow_redirects=True)
+
+    assert diagnostics_fetch.json["error_count"] >= 1
+    messages = [e["message"] for e in diagnostics_fetch.json["errors"]]
+    assert any("notarealarticle.cls" in m for m in messages)
+
+
+def test_diagnostics_not_found_before_rendering(fixture: TestFixture):
+    session = create_session_add_file(fixture, "sample1.tex")
+    finalize_session(fixture, session)
+
+    diagnostics_url = f"/api/sessions/{session.key}/diagnostics"
+    response: Response = fixture.client.get(diagnostics_url, follow_redirects=True)
+    assert response.status_code == 404
+
+
 def test_status_endpoint(fixture: TestFixture):
+    before = fixture.client.get("/api/status", follow_redirects=True).json["sessions"]
     for n, finalize in ((3, False), (2, True)):
         for i in range(n):
             session = create_session_add_file(fixture, "sample1.tex")
@@ -349,6 +626,11 @@ def test_status_endpoint(fixture: TestFixture):
     assert response.is_json
     assert "sessions" in response.json.keys()
     assert "time" in response.json.keys()
+    assert response.json["sessions"][EDITABLE_TEXT] == before.get(EDITABLE_TEXT, 0) + 3
+    assert response.json["sessions"][FINALIZED_TEXT] == before.get(FINALIZED_TEXT, 0) + 2
+    assert response.json["oldest_finalized_age"] >= 0
+    assert isinstance(response.json["queue_depth"], int)
+    assert set(response.json["template_cache"]) == {"hits", "misses", "bytecode_hits", "renders", "mean_render_ms"}
 
 
 def test_set_image_conversion(fixture: TestFixture):
@@ -382,3 +664,518 @@ def test_unset_image_conversion(fixture: TestFixture):
     get_response: Response = fixture.client.get(session_url, follow_redirects=True)
     assert get_response.is_json
     assert response.json["convert"] is None
+
+
+def compile_in_request(monkeypatch):
+    """ Run the compiler in place of queueing it for a worker, so the compile endpoint finds the session complete """
+    monkeypatch.setattr(background_run_compile, "delay", compile_latex)
+
+
+def encoded_test_file(file_name: str) -> dict:
+    with open(os.path.join(find_test_asset_folder(), file_name), "rb") as handle:
+        return {"path": file_name, "content": base64.b64encode(handle.read()).decode()}
+
+
+def test_compile_returns_product(fixture: TestFixture, monkeypatch):
+    compile_in_request(monkeypatch)
+    data = {"compiler": "xelatex", "target": "sample1.tex", "files": [encoded_test_file("sample1.tex")]}
+    response: Response = fixture.client.post("/api/compile", json=data)
+
+    assert response.status_code == 200
+    assert len(response.data) > 2000
+    session = session_manager.load_session(response.headers["location"].rstrip("/").split("/")[-1])
+    assert session.status == SUCCESS_TEXT
+    assert hash_file(session.product) == hashlib.sha1(response.data).hexdigest()
+
+
+def test_compile_with_multipart_and_templates(fixture: TestFixture, monkeypatch):
+    compile_in_request(monkeypatch)
+    with open(os.path.join(find_test_asset_folder(), "sample_template1.tex"), "r") as handle:
+        template = {"target": "sample1.tex", "text": handle.read(), "data": {"name_1": "Name", "data2": {
+            "name": "Header", "items": ["One", "Two"]}}}
+    data = {"session": json.dumps({"compiler": "xelatex", "target": "sample1.tex", "templates": [template]}),
+            "file0": (file_byte_stream(os.path.join(find_test_asset_folder(), "cat.jpg")), "images/cat.jpg")}
+    response: Response = fixture.client.post("/api/compile", data=data, content_type="multipart/form-data")
+
+    assert response.status_code == 200
+    session = session_manager.load_session(response.headers["location"].rstrip("/").split("/")[-1])
+    assert "images/cat.jpg" in session.files
+    assert "sample1.tex" in session.templates
+
+
+def test_compile_returns_session_after_wait(fixture: TestFixture, monkeypatch):
+    monkeypatch.setattr(background_run_compile, "delay", lambda *args: None)
+    data = {"compiler": "xelatex", "target": "sample1.tex", "files": [encoded_test_file("sample1.tex")], "wait": 0}
+    response: Response = fixture.client.post("/api/compile", json=data)
+
+    assert response.status_code == 202
+    assert response.json["status"] == FINALIZED_TEXT
+    assert response.headers["location"].rstrip("/").endswith(response.json["key"])
+
+
+def test_compile_error_returns_session(fixture: TestFixture, monkeypatch):
+    compile_in_request(monkeypatch)
+    data = {"compiler": "xelatex", "target": "bad_sample1.tex", "files": [encoded_test_file("bad_sample1.tex")]}
+    response: Response = fixture.client.post("/api/compile", json=data)
+
+    assert response.status_code == 422
+    assert response.json["status"] == ERROR_TEXT
+    assert "log" in response.json
+
+
+def test_compile_reports_missing_linked_files(fixture: TestFixture, monkeypatch):
+    compile_in_request(monkeypatch)
+    data = {"compiler": "xelatex", "target": "sample1.tex", "files": [{"path": "sample1.tex", "sha256": "1" * 64}]}
+    response: Response = fixture.client.post("/api/compile", json=data)
+
+    assert response.status_code == 400
+    assert response.json["missing"] == [{"path": "sample1.tex", "sha256": "1" * 64}]
+
+
+def test_compile_fails_on_bad_request(fixture: TestFixture, monkeypatch):
+    compile_in_request(monkeypatch)
+    bad_data = [
+        {"target": "sample1.tex"},
+        {"compiler": "xelatex", "target": "sample1.tex", "files": [{"path": "sample1.tex"}]},
+        {"compiler": "xelatex", "target": "sample1.tex", "files": [{"path": "a.tex", "content": "not base64!"}]},
+        {"compiler": "xelatex", "target": "sample1.tex", "templates": [{"target": "a.tex"}]},
+        {"compiler": "xelatex", "target": "sample1.tex", "wait": "soon"},
+        {"compiler": "xelatex", "target": "sample1.tex", "files": [{"path": "../a.tex", "content": ""}]},
+    ]
+    for data in bad_data:
+        response: Response = fixture.client.post("/api/compile", json=data)
+        assert response.status_code == 400
+
+
+def test_session_long_poll_returns_on_completion(fixture: TestFixture):
+    session = create_session_add_file(fixture, "sample1.tex")
+    queue_data = finalize_session(fixture, session)
+    threading.Timer(0.2, compile_latex, queue_data).start()
+
+    response: Response = fixture.client.get(f"/api/sessions/{session.key}?wait=30")
+    assert response.status_code == 200
+    assert response.json["status"] == SUCCESS_TEXT
+    assert "product" in response.json
+
+
+def test_session_long_poll_times_out(fixture: TestFixture):
+    session = create_session_add_file(fixture, "sample1.tex")
+    finalize_session(fixture, session)
+
+    response: Response = fixture.client.get(f"/api/sessions/{session.key}?wait=0.1")
+    assert response.json["status"] == FINALIZED_TEXT
+
+    response = fixture.client.get(f"/api/sessions/{session.key}?wait=later")
+    assert response.status_code == 400
+
+
+def read_events(response: Response) -> list:
+    events = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        lines = block.splitlines()
+        if lines and lines[0] == "event: status":
+            events.append(json.loads(lines[1][len("data: "):])["status"])
+    return events
+
+
+def test_session_events_stream_status_changes(fixture: TestFixture):
+    session = create_session_add_file(fixture, "sample1.tex")
+    queue_data = finalize_session(fixture, session)
+    threading.Timer(0.2, compile_latex, queue_data).start()
+
+    response: Response = fixture.client.get(f"/api/sessions/{session.key}/events")
+    assert response.mimetype == "text/event-stream"
+    assert read_events(response) == [FINALIZED_TEXT, SUCCESS_TEXT]
+
+
+def test_session_events_end_for_compiled_session(fixture: TestFixture):
+    session = create_session_add_file(fixture, "bad_sample1.tex")
+    compile_latex(*finalize_session(fixture, session))
+
+    events_url = fixture.client.get(f"/api/sessions/{session.key}").json["events"]["href"]
+    response: Response = fixture.client.get(events_url)
+    assert read_events(response) == [ERROR_TEXT]
+
+
+def test_session_events_end_at_wait_limit(fixture: TestFixture):
+    session = create_session_add_file(fixture, "sample1.tex")
+    finalize_session(fixture, session)
+
+    fixture.app.config["COMPILE_WAIT_SEC"] = 0.1
+    try:
+        response: Response = fixture.client.get(f"/api/sessions/{session.key}/events")
+        assert read_events(response) == [FINALIZED_TEXT]
+    finally:
+        fixture.app.config["COMPILE_WAIT_SEC"] = ConfigBase.COMPILE_WAIT_SEC
+
+
+def test_create_session_with_callback(fixture: TestFixture):
+    data = {"compiler": "xelatex", "target": "sample1.tex", "callback": "https://example.com/hooks/latex"}
+    response: Response = fixture.client.post("/api/sessions", json=data)
+    assert response.status_code == 201
+    assert response.json["callback"] == "https://example.com/hooks/latex"
+
+
+def test_create_session_with_invalid_callback(fixture: TestFixture):
+    for callback in ("example.com/hook", "ftp://example.com/hook", "http://", "http://example.com:port", 12,
+                     "http://169.254.169.254/latest/meta-data", "http://10.0.0.2/hook", "http://[::1]:6379/"):
+        data = {"compiler": "xelatex", "target": "sample1.tex", "callback": callback}
+        response: Response = fixture.client.post("/api/sessions", json=data)
+        assert response.status_code == 400
+
+
+def create_batch_session(fixture: TestFixture, names: list, output: str = None) -> Session:
+    response: Response = fixture.client.post("/api/sessions", json={"compiler": "xelatex", "target": "cert.tex"})
+    session_url = f"/api/sessions/{response.json['key']}"
+    with open(os.path.join(find_test_asset_folder(), "sample_template1.tex"), "r") as handle:
+        template = {"target": "cert.tex", "text": handle.read(), "data": {"name_1": "Nobody", "data2": {
+            "name": "Awards", "items": ["Gold"]}}}
+    fixture.client.post(f"{session_url}/templates", json=template)
+
+    data = {"rows": [{"name_1": name} for name in names]}
+    if output is not None:
+        data["output"] = output
+    response = fixture.client.post(f"{session_url}/rows", json=data)
+    assert response.status_code == 201
+    return session_manager.load_session(response.request.path.split("/")[3])
+
+
+def test_batch_session_compiles_rows_to_zip(fixture: TestFixture, monkeypatch):
+    monkeypatch.setattr(ConfigBase, "BATCH_CHUNK_ROWS", 2)
+    session = create_batch_session(fixture, ["Ada", "Grace", "Edsger"])
+    result: RenderResult = compile_latex(*finalize_session(fixture, session))
+
+    assert result.success
+    response: Response = fixture.client.get(f"/api/sessions/{session.key}")
+    assert response.json["status"] == SUCCESS_TEXT
+    assert response.json["rows"]["total"] == 3
+    assert response.json["rows"]["success"] == 3
+
+    with zipfile.ZipFile(session_manager.load_session(session.key).product) as archive:
+        assert archive.namelist() == ["0.pdf", "1.pdf", "2.pdf"]
+        for member, name in zip(archive.namelist(), ["Ada", "Grace", "Edsger"]):
+            content = archive.read(member)
+            assert f"section{{{name}}}".encode() in content
+            assert b"Awards Addition" in content
+
+    # The row products were collected into the zip, whose entry in the product store also holds the logs of the rows,
+    # and the session's sources and rows are removed once it is compiled
+    entry_path = session_manager.product_store.entry_path(session.key)
+    assert set(os.listdir(entry_path)) == {"0.log", "1.log", "2.log", f"{session.key}.zip"}
+    assert not os.path.exists(session.rows_path)
+    assert not os.path.exists(os.path.join(session_manager.working_directory, session.key, "source"))
+
+
+def test_batch_session_merges_rows_to_pdf(fixture: TestFixture):
+    session = create_batch_session(fixture, ["Ada", "Grace"], output="pdf")
+    compile_latex(*finalize_session(fixture, session))
+
+    product = fixture.client.get(f"/api/sessions/{session.key}/product").data
+    assert product.index(b"section{Ada}") < product.index(b"section{Grace}")
+
+
+def test_batch_session_failed_row(fixture: TestFixture):
+    session = create_batch_session(fixture, ["Ada", "notarealarticle", "Edsger"])
+    result: RenderResult = compile_latex(*finalize_session(fixture, session))
+
+    assert not result.success
+    reloaded = session_manager.load_session(session.key)
+    assert reloaded.status == ERROR_TEXT
+    assert reloaded.compile_info["failed_rows"] == [1]
+
+    response: Response = fixture.client.get(f"/api/sessions/{session.key}/rows")
+    assert response.json["success"] == 2
+    assert response.json["error"] == 1
+    assert [row["success"] for row in response.json["results"]] == [True, False, True]
+    log_response = fixture.client.get(response.json["results"][1]["log"]["href"])
+    assert b"notarealarticle" in log_response.data
+
+
+def test_batch_chunk_failure_fails_its_rows(fixture: TestFixture, monkeypatch):
+    monkeypatch.setattr(ConfigBase, "BATCH_CHUNK_ROWS", 2)
+    session = create_batch_session(fixture, ["Ada", "Grace", "Edsger"])
+    queue_data = finalize_session(fixture, session)
+
+    # Copying the sources for the first chunk fails, before any of its rows are compiled
+    copytree = shutil.copytree
+    calls = []
+
+    def failing_copytree(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        return copytree(*args, **kwargs)
+
+    monkeypatch.setattr(shutil, "copytree", failing_copytree)
+    result: RenderResult = compile_latex(*queue_data)
+
+    assert not result.success
+    reloaded = session_manager.load_session(session.key)
+    assert reloaded.status == ERROR_TEXT
+    assert reloaded.compile_info["failed_rows"] == [0, 1]
+
+
+def test_batch_rows_fail_on_bad_request(fixture: TestFixture):
+    session = create_batch_session(fixture, ["Ada"])
+    url = f"/api/sessions/{session.key}/rows"
+    for data in ({"rows": {"name_1": "Ada"}}, {"rows": ["Ada"]}, {"rows": [], "output": "tar"}):
+        response: Response = fixture.client.post(url, json=data)
+        assert response.status_code == 400
+
+    fixture.app.config["BATCH_MAX_ROWS"] = 2
+    try:
+        response = fixture.client.post(url, json={"rows": [{"name_1": "Grace"}, {"name_1": "Edsger"}]})
+        assert response.status_code == 400
+    finally:
+        fixture.app.config["BATCH_MAX_ROWS"] = ConfigBase.BATCH_MAX_ROWS
+
+    finalize_session(fixture, session)
+    response = fixture.client.post(url, json={"rows": [{"name_1": "Grace"}]})
+    assert response.status_code == 403
+
+
+def register_sample_template(fixture: TestFixture, version: str) -> Response:
+    with open(os.path.join(find_test_asset_folder(), "sample_template1.tex"), "r") as handle:
+        data = {"name": "sample", "version": version, "text": handle.read()}
+    return fixture.client.post("/api/templates", json=data)
+
+
+def test_register_library_template(fixture: TestFixture):
+    response = register_sample_template(fixture, "1")
+    assert response.status_code == 201
+    assert response.json["id"] == "sample@1"
+    assert "text" not in response.json
+
+    fetched: Response = fixture.client.get(response.headers["location"])
+    assert fetched.json["digest"] == hashlib.sha256(fetched.json["text"].encode()).hexdigest()
+    assert "sample@1" in [entry["id"] for entry in fixture.client.get("/api/templates").json]
+
+    # Registering the same text again changes nothing, but the text of a version can't be changed
+    assert register_sample_template(fixture, "1").status_code == 200
+    response = fixture.client.post("/api/templates", json={"name": "sample", "version": "1", "text": "changed"})
+    assert response.status_code == 409
+    assert response.json["template"]["digest"] == fetched.json["digest"]
+
+
+def test_register_library_template_fails_on_bad_request(fixture: TestFixture):
+    bad_data = [
+        {"version": "1", "text": "text"},
+        {"name": "sample/letter", "version": "1", "text": "text"},
+        {"name": "sample", "version": "", "text": "text"},
+        {"name": "sample", "version": "1"},
+        {"name": "sample", "version": "1", "text": r"\BLOCK{ for i in range(5) }"},
+    ]
+    for data in bad_data:
+        response: Response = fixture.client.post("/api/templates", json=data)
+        assert response.status_code == 400
+
+
+def test_session_renders_library_template(fixture: TestFixture):
+    register_sample_template(fixture, "2")
+    response: Response = fixture.client.post("/api/sessions", json={"compiler": "xelatex", "target": "sample1.tex"})
+    session_key = response.json["key"]
+    template = {"target": "sample1.tex", "template": "sample@2", "data": {"name_1": "Library", "data2": {
+        "name": "Header", "items": ["One", "Two"]}}}
+    response = fixture.client.post(f"/api/sessions/{session_key}/templates", json=template)
+    assert response.status_code == 201
+    assert response.json["sample1.tex"]["template"] == "sample@2"
+
+    # Only the reference to the template and its data are stored with the session
+    body = fixture.client.get(f"/api/sessions/{session_key}/templates/sample1.tex").json
+    assert body["template"] == "sample@2"
+    assert "text" not in body
+
+    session = session_manager.load_session(session_key)
+    result: RenderResult = compile_latex(*finalize_session(fixture, session))
+    assert result.success
+    with open(session_manager.load_session(session_key).product, "rb") as handle:
+        assert b"\\section{Library}" in handle.read()
+
+
+def test_session_fails_on_unknown_library_template(fixture: TestFixture, monkeypatch):
+    response: Response = fixture.client.post("/api/sessions", json={"compiler": "xelatex", "target": "sample1.tex"})
+    template = {"target": "sample1.tex", "template": "missing@1", "data": {}}
+    response = fixture.client.post(f"/api/sessions/{response.json['key']}/templates", json=template)
+    assert response.status_code == 400
+
+    compile_in_request(monkeypatch)
+    data = {"compiler": "xelatex", "target": "sample1.tex", "templates": [template]}
+    response = fixture.client.post("/api/compile", json=data)
+    assert response.status_code == 400
+
+
+def test_remove_library_template(fixture: TestFixture):
+    location = register_sample_template(fixture, "3").headers["location"]
+
+    assert fixture.client.delete(location).status_code == 204
+    assert fixture.client.get(location).status_code == 404
+    assert fixture.client.delete(location).status_code == 404
+
+
+def test_session_fails_on_removed_library_template(fixture: TestFixture, monkeypatch):
+    location = register_sample_template(fixture, "4").headers["location"]
+    response: Response = fixture.client.post("/api/sessions", json={"compiler": "xelatex", "target": "sample1.tex"})
+    session_key = response.json["key"]
+    template = {"target": "sample1.tex", "template": "sample@4", "data": {"name_1": "Library", "data2": {
+        "name": "Header", "items": ["One"]}}}
+    assert fixture.client.post(f"/api/sessions/{session_key}/templates", json=template).status_code == 201
+
+    # The template can't be removed while the session refers to it
+    response = fixture.client.delete(location)
+    assert response.status_code == 409
+    assert response.json["sessions"] == [session_key]
+
+    # Removed anyway in between, by a worker which hasn't compiled the template yet, it fails the session
+    TemplateLibrary(redis_client, session_manager.instance_key).remove("sample@4")
+    monkeypatch.setattr(rendering, "_template_cache", TemplateCache(rendering._latex_env, 4))
+    result: RenderResult = compile_latex(*finalize_session(fixture, session_manager.load_session(session_key)))
+    assert not result.success
+
+    response = fixture.client.get(f"/api/sessions/{session_key}")
+    assert response.json["status"] == ERROR_TEXT
+    assert response.json["compile_info"]["reason"] == STOP_TEMPLATE_UNAVAILABLE
+    diagnostics = fixture.client.get(response.json["diagnostics"]["href"]).json
+    assert "sample@4" in diagnostics["errors"][0]["message"]
+
+
+def test_several_conversions_from_one_compile(fixture: TestFixture):
+    convert = [{"format": "png", "dpi": 72}, {"format": "png", "dpi": 300},
+               {"format": "jpeg", "dpi": 150, "pages": "all"}]
+    session = create_session_add_file(fixture, "small_doc.tex")
+    fixture.client.post(f"/api/sessions/{session.key}", json={"convert": convert})
+    result: RenderResult = compile_latex(*finalize_session(fixture, session))
+    assert result.success
+
+    response: Response = fixture.client.get(f"/api/sessions/{session.key}")
+    assert response.json["status"] == SUCCESS_TEXT
+    product = fixture.client.get(response.json["product"]["href"])
+    assert product.data.startswith(b"%PDF")
+
+    outputs = response.json["outputs"]
+    assert [(o["format"], o["dpi"]) for o in outputs] == [("png", 72), ("png", 300), ("jpeg", 150)]
+    low, high = (fixture.client.get(output["href"]).data for output in outputs[:2])
+    assert low.startswith(b"\x89PNG") and high.startswith(b"\x89PNG")
+    assert low != high
+
+    # The document has a single page, so converting all of its pages gives a single image
+    assert fixture.client.get(outputs[2]["href"]).headers["Content-Type"] == "image/jpeg"
+
+    assert fixture.client.get(f"/api/sessions/{session.key}/outputs/3").status_code == 404
+
+
+def test_batch_session_refuses_conversion_list(fixture: TestFixture):
+    session = create_batch_session(fixture, ["Ada"])
+    response = fixture.client.post(f"/api/sessions/{session.key}", json={"convert": [{"format": "png", "dpi": 72}]})
+    assert response.status_code == 400
+
+    response = fixture.client.post("/api/sessions", json={"compiler": "xelatex", "target": "cert.tex",
+                                                          "convert": [{"format": "png", "dpi": 72}]})
+    response = fixture.client.post(f"/api/sessions/{response.json['key']}/rows", json={"rows": [{"name_1": "Ada"}]})
+    assert response.status_code == 400
+
+
+def compiled_product_url(fixture: TestFixture) -> str:
+    session = create_session_add_file(fixture, "small_doc.tex")
+    compile_latex(*finalize_session(fixture, session))
+    return f"/api/sessions/{session.key}/product"
+
+
+def test_product_has_strong_etag(fixture: TestFixture):
+    url = compiled_product_url(fixture)
+    response: Response = fixture.client.get(url)
+
+    assert response.headers["ETag"] == f'"{hashlib.sha256(response.data).hexdigest()}"'
+    assert response.headers["Accept-Ranges"] == "bytes"
+
+    revalidated = fixture.client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+    assert revalidated.status_code == 304
+    assert revalidated.data == b""
+
+
+def test_product_range_request(fixture: TestFixture):
+    url = compiled_product_url(fixture)
+    full = fixture.client.get(url).data
+    etag = fixture.client.get(url).headers["ETag"]
+
+    response: Response = fixture.client.get(url, headers={"Range": "bytes=100-199", "If-Range": etag})
+    assert response.status_code == 206
+    assert response.data == full[100:200]
+    assert response.headers["Content-Range"] == f"bytes 100-199/{len(full)}"
+
+    # A resumed download of a file which has changed since gets the whole file instead
+    response = fixture.client.get(url, headers={"Range": "bytes=100-199", "If-Range": '"stale"'})
+    assert response.status_code == 200
+    assert response.data == full
+
+
+def test_product_sent_by_proxy(fixture: TestFixture):
+    url = compiled_product_url(fixture)
+    product = session_manager.load_session(url.split("/")[3]).product
+    try:
+        fixture.app.config["SENDFILE_MODE"] = "x-accel-redirect"
+        response: Response = fixture.client.get(url)
+        relative_path = os.path.relpath(product, session_manager.working_directory)
+        assert response.headers["X-Accel-Redirect"] == f"/protected/{relative_path}"
+        assert response.data == b""
+        assert response.headers["Content-Type"] == "application/pdf"
+        response = fixture.client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+        assert response.status_code == 304
+        assert "X-Accel-Redirect" not in response.headers
+
+        fixture.app.config["SENDFILE_MODE"] = "x-sendfile"
+        response = fixture.client.get(url)
+        assert response.headers["X-Sendfile"] == os.path.abspath(product)
+        assert response.data == b""
+        response = fixture.client.get(url, headers={"If-Match": '"stale"'})
+        assert response.status_code == 412
+        assert "X-Sendfile" not in response.headers
+    finally:
+        fixture.app.config["SENDFILE_MODE"] = ConfigBase.SENDFILE_MODE
+
+
+def test_app_refuses_unknown_sendfile_mode():
+    class BadConfig(TestConfig):
+        SENDFILE_MODE = "x-sendfiles"
+
+    with pytest.raises(ValueError):
+        create_app(BadConfig())
+
+
+def test_compile_does_not_change_shared_blob(fixture: TestFixture):
+    response = fixture.client.post("/api/sessions", json={"compiler": "xelatex", "target": "doc.tex"})
+    session = session_manager.load_session(response.json["key"])
+    aux = f"{session.key}.aux"
+    files = {"file0": (io.BytesIO(b"\\documentclass{article}\\begin{document}\\ref{x}\\end{document}"), "doc.tex"),
+             "file1": (io.BytesIO(b"uploaded aux"), aux)}
+    fixture.client.post(f"/api/sessions/{session.key}/files", data=files, content_type="multipart/form-data")
+    other = create_session_add_file(fixture, "sample1.tex")
+    assert other.link_files([("shared.aux", hashlib.sha256(b"uploaded aux").hexdigest())]) == []
+
+    # The compiler rewrites the uploaded .aux file, which must not reach the blob it was linked to
+    result: RenderResult = compile_latex(*finalize_session(fixture, session))
+    assert result.success
+    with open(os.path.join(other.source_files.root_path, "shared.aux"), "rb") as handle:
+        assert handle.read() == b"uploaded aux"
+
+
+def test_sources_released_after_compile(fixture: TestFixture):
+    session = create_session_add_file(fixture, "sample1.tex")
+    content = f"% {session.key}".encode()
+    fixture.client.post(f"/api/sessions/{session.key}/files", data={"file0": (io.BytesIO(content), "unique.tex")},
+                        content_type="multipart/form-data")
+    result: RenderResult = compile_latex(*finalize_session(fixture, session))
+
+    assert result.success
+    assert not os.path.exists(os.path.join(session_manager.working_directory, session.key, "source"))
+    assert "unique.tex" in fixture.client.get(f"/api/sessions/{session.key}").json["files"]
+
+    # The only session using the uploaded file is done with it, so its blob is kept only for the retention period
+    digest = hashlib.sha256(content).hexdigest()
+    assert redis_client.zscore(blobs_key(session_manager.instance_key), digest) is not None
+
+
+def test_evicted_product_is_gone(fixture: TestFixture):
+    url = compiled_product_url(fixture)
+    session_manager.product_store.remove(url.split("/")[3])
+
+    assert fixture.client.get(url).status_code == 410
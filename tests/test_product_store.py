@@ -0,0 +1,93 @@
+import os
+import uuid
+import tempfile
+
+import pytest
+import redis
+
+from latex.config import TestConfig
+from latex.services.product_store import ProductStore, product_store_keys
+
+
+class StoreFixture:
+    def __init__(self, temp_path: str, max_bytes: int):
+        self.client = redis.from_url(TestConfig.REDIS_URL)
+        self.instance = str(uuid.uuid4()).replace("-", "")[:10]
+        self.clock = 1000
+        self.store = ProductStore(os.path.join(temp_path, "store"), max_bytes, self.client, self.instance,
+                                  clock=lambda: self.clock)
+        self.work_path = os.path.join(temp_path, "work")
+        os.makedirs(self.work_path)
+
+    def write(self, name: str, size: int) -> str:
+        path = os.path.join(self.work_path, name)
+        with open(path, "wb") as handle:
+            handle.write(b"x" * size)
+        return path
+
+    def keep(self, session_id: str, size: int):
+        # Entries are ordered by when they were last used, so each one is kept at a distinct time
+        self.clock += 10
+        self.store.keep(session_id, [self.write(f"{session_id}.pdf", size)])
+
+    def total(self) -> int:
+        return int(self.client.get(self.store.keys[2]) or 0)
+
+
+@pytest.fixture()
+def fixture() -> StoreFixture:
+    with tempfile.TemporaryDirectory() as temp_path:
+        store_fixture = StoreFixture(temp_path, 1000)
+        yield store_fixture
+        store_fixture.client.delete(*product_store_keys(store_fixture.instance))
+
+
+def test_files_moved_into_entry(fixture: StoreFixture):
+    product = fixture.write("session1.pdf", 10)
+    log = fixture.write("session1.log", 10)
+
+    kept = fixture.store.keep("session1", [product, None, log])
+
+    entry_path = fixture.store.entry_path("session1")
+    assert kept == [os.path.join(entry_path, "session1.pdf"), None, os.path.join(entry_path, "session1.log")]
+    assert not os.path.exists(product)
+    assert os.path.exists(kept[0])
+
+
+def test_least_recently_used_entry_evicted(fixture: StoreFixture):
+    fixture.keep("session1", 400)
+    fixture.keep("session2", 400)
+    fixture.clock += 10
+    fixture.store.touch("session1")
+    fixture.keep("session3", 400)
+
+    assert sorted(os.listdir(fixture.store.root_path)) == ["session1", "session3"]
+    assert fixture.total() == 800
+
+
+def test_newest_entry_kept_even_over_budget(fixture: StoreFixture):
+    fixture.keep("session1", 400)
+    fixture.keep("session2", 2000)
+
+    assert os.listdir(fixture.store.root_path) == ["session2"]
+
+
+def test_entry_removed(fixture: StoreFixture):
+    fixture.keep("session1", 10)
+    fixture.store.remove("session1")
+
+    assert os.listdir(fixture.store.root_path) == []
+    assert fixture.total() == 0
+
+
+def test_file_linked_from_result_cache_counted(fixture: StoreFixture):
+    product = fixture.write("session1.pdf", 400)
+    cached = os.path.join(fixture.work_path, "cached.pdf")
+    os.link(product, cached)
+    fixture.store.keep("session1", [product, fixture.write("session1.log", 10)])
+    assert fixture.total() == 410
+
+    # Once the cache has let go of its link the entry holds the file alone, and the total is still right
+    os.remove(cached)
+    fixture.store.remove("session1")
+    assert fixture.total() == 0
@@ -1,13 +1,22 @@
 import os
+import sys
 import json
+import time
 import shutil
+import zipfile
+import threading
 import tempfile
 from hashlib import md5
 
 import pytest
 
 from tests.test_sessions import find_test_asset_folder
-from latex.rendering import _convert_image, _render_and_compile, _render_templates, RenderResult
+from latex import rendering
+from latex.config import ConfigBase
+from latex.rendering import _convert_image, _convert_outputs, _page_chunks, _render_and_compile, _render_templates, \
+    _run_limited, RenderResult, STOP_CONVERGED, STOP_NO_RERUN, STOP_FATAL_ERROR, STOP_TIMEOUT, STOP_CPU_LIMIT, \
+    STOP_MEMORY_LIMIT, CompileLimits
+from latex.services.format_cache import FormatCache
 
 
 _simple_template_data = {
@@ -89,6 +98,78 @@ def test_simple_compile_lualatex(render_fixture: RenderFixture):
     assert os.path.exists(result.log)
 
 
+def test_compile_with_format_cache(render_fixture: RenderFixture):
+    target_file = "small_doc.tex"
+    copy_test_file(target_file, render_fixture.source_dir)
+    format_cache = FormatCache(os.path.join(render_fixture.source_dir, "..", "formats"), 1024 * 1024 * 1024)
+    result = _render_and_compile("temp", "pdflatex", target_file, render_fixture.source_dir,
+                                 render_fixture.template_dir, format_cache)
+
+    assert result.product is not None
+    assert os.path.exists(result.product)
+    assert os.path.exists(os.path.join(render_fixture.source_dir, "temp-preamble.fmt"))
+
+
+def test_compile_stops_without_rerun(render_fixture: RenderFixture):
+    target_file = "small_doc.tex"
+    copy_test_file(target_file, render_fixture.source_dir)
+    result = _render_and_compile("temp", "pdflatex", target_file, render_fixture.source_dir, render_fixture.template_dir)
+
+    assert result.success
+    assert result.passes == 1
+    assert result.reason == STOP_NO_RERUN
+
+
+def test_compile_reruns_until_converged(render_fixture: RenderFixture):
+    target_file = "references.tex"
+    with open(os.path.join(render_fixture.source_dir, target_file), "w") as handle:
+        handle.write("\\documentclass{article}\n\\begin{document}\n\\section{One}\\label{sec:one}\n"
+                     "See section \\ref{sec:one}.\n\\end{document}\n")
+    result = _render_and_compile("temp", "pdflatex", target_file, render_fixture.source_dir, render_fixture.template_dir)
+
+    assert result.success
+    assert result.passes == 2
+    assert result.reason == STOP_CONVERGED
+
+
+def test_compile_fail_fast_stops_at_error(render_fixture: RenderFixture):
+    target_file = "bad_sample1.tex"
+    copy_test_file(target_file, render_fixture.source_dir)
+    result = _render_and_compile("temp", "pdflatex", target_file, render_fixture.source_dir,
+                                 render_fixture.template_dir, fail_fast=True)
+
+    assert not result.success
+    assert result.passes == 1
+    assert result.reason == STOP_FATAL_ERROR
+    assert result.diagnostics["error_count"] >= 1
+    assert "notarealarticle.cls" in result.diagnostics["errors"][0]["message"]
+
+
+def test_compile_stops_at_wall_time_limit(render_fixture: RenderFixture):
+    target_file = "loop.tex"
+    with open(os.path.join(render_fixture.source_dir, target_file), "w") as handle:
+        handle.write("\\documentclass{article}\n\\def\\loopforever{\\loopforever}\n"
+                     "\\begin{document}\n\\loopforever\n\\end{document}\n")
+    limits = CompileLimits(timeout=2, cpu=0, memory=0, file_size=0)
+    result = _render_and_compile("temp", "pdflatex", target_file, render_fixture.source_dir,
+                                 render_fixture.template_dir, limits=limits)
+
+    assert not result.success
+    assert result.passes == 1
+    assert result.reason == STOP_TIMEOUT
+
+
+def test_cpu_limit_told_apart_from_kill(render_fixture: RenderFixture):
+    limits = CompileLimits(timeout=30, cpu=1, memory=0, file_size=0)
+    _, reason = _run_limited([sys.executable, "-c", "while True: pass"], render_fixture.source_dir, limits, None)
+    assert reason == STOP_CPU_LIMIT
+
+    # A process killed outright before using up its cpu time was stopped by the OOM killer, not the cpu limit
+    command = [sys.executable, "-c", "import os, signal; os.kill(os.getpid(), signal.SIGKILL)"]
+    _, reason = _run_limited(command, render_fixture.source_dir, limits, None)
+    assert reason == STOP_MEMORY_LIMIT
+
+
 def test_render(render_fixture: RenderFixture):
     target_name = "sample_template1.tex"
     copy_template(target_name, _simple_template_data, render_fixture.template_dir)
@@ -168,3 +249,103 @@ def test_compile_and_convert_tiff(render_fixture: RenderFixture):
     assert os.path.exists(converted)
     assert converted.endswith(".tif")
 
+
+
+def compile_pages(render_fixture: RenderFixture, pages: int) -> RenderResult:
+    body = "\n\\newpage\n".join(f"Page {i + 1}" for i in range(pages))
+    with open(os.path.join(render_fixture.source_dir, "pages.tex"), "w") as handle:
+        handle.write(f"\\documentclass{{article}}\n\\begin{{document}}\n{body}\n\\end{{document}}\n")
+    return _render_and_compile("temp", "xelatex", "pages.tex", render_fixture.source_dir, render_fixture.template_dir)
+
+
+def test_convert_all_pages_to_zip(render_fixture: RenderFixture, monkeypatch):
+    monkeypatch.setattr(ConfigBase, "CONVERT_PROCESSES", 3)
+    result = compile_pages(render_fixture, 12)
+    converted = _convert_image(result.product, "png", 100, "all")
+
+    assert converted.endswith("temp.zip")
+    with zipfile.ZipFile(converted) as archive:
+        names = archive.namelist()
+        assert names == [f"temp-{page:02d}.png" for page in range(1, 13)]
+        assert all(archive.read(name).startswith(b"\x89PNG") for name in names)
+
+
+def test_convert_page_range(render_fixture: RenderFixture):
+    result = compile_pages(render_fixture, 5)
+    converted = _convert_image(result.product, "jpeg", 100, [2, 9])
+
+    with zipfile.ZipFile(converted) as archive:
+        assert archive.namelist() == ["temp-2.jpg", "temp-3.jpg", "temp-4.jpg", "temp-5.jpg"]
+        assert all(archive.read(name).startswith(b"\xff\xd8") for name in archive.namelist())
+
+
+def test_convert_single_page_of_range(render_fixture: RenderFixture):
+    result = compile_pages(render_fixture, 3)
+    converted = _convert_image(result.product, "jpeg", 100, [2, 2])
+    first = _convert_image(result.product, "jpeg", 100, [1, 1], name="first")
+
+    assert converted.endswith("temp.jpg")
+    assert first.endswith("first.jpg")
+    with open(converted, "rb") as handle, open(first, "rb") as first_handle:
+        image = handle.read()
+        assert image.startswith(b"\xff\xd8")
+        assert image != first_handle.read()
+
+
+def test_convert_range_past_last_page_fails(render_fixture: RenderFixture):
+    result = compile_pages(render_fixture, 2)
+    assert _convert_image(result.product, "jpeg", 100, [3, 4]) is None
+    assert _convert_image(result.product, "jpeg", 100, [3, 3]) is None
+
+
+def test_page_chunks_split_evenly():
+    assert _page_chunks(1, 10, 4) == [(1, 3), (4, 6), (7, 8), (9, 10)]
+    assert _page_chunks(3, 4, 8) == [(3, 3), (4, 4)]
+    assert _page_chunks(1, 5, 1) == [(1, 5)]
+
+
+def test_convert_several_outputs(render_fixture: RenderFixture):
+    result = compile_pages(render_fixture, 3)
+    conversions = [{"format": "png", "dpi": 72}, {"format": "png", "dpi": 300, "pages": "all"}]
+    outputs = _convert_outputs(result.product, conversions, "temp")
+
+    assert [os.path.basename(o) for o in outputs] == ["temp-0.png", "temp-1.zip"]
+    with zipfile.ZipFile(outputs[1]) as archive:
+        assert archive.namelist() == ["temp-1-1.png", "temp-1-2.png", "temp-1-3.png"]
+
+
+def test_conversions_share_process_limit(render_fixture: RenderFixture, monkeypatch):
+    monkeypatch.setattr(ConfigBase, "CONVERT_PROCESSES", 2)
+    result = compile_pages(render_fixture, 6)
+
+    # Count the pdftoppm processes running at once across every conversion
+    run_limited = rendering._run_limited
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def counting_run_limited(*args):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        try:
+            time.sleep(0.05)
+            return run_limited(*args)
+        finally:
+            with lock:
+                running[0] -= 1
+
+    monkeypatch.setattr(rendering, "_run_limited", counting_run_limited)
+    conversions = [{"format": "png", "dpi": 72, "pages": "all"} for _ in range(4)]
+    outputs = _convert_outputs(result.product, conversions, "temp")
+
+    assert all(outputs)
+    assert running[1] == 2
+
+
+def test_conversion_limited_by_deadline_and_page_dpi(render_fixture: RenderFixture, monkeypatch):
+    result = compile_pages(render_fixture, 12)
+    assert _convert_image(result.product, "png", 100, deadline=time.monotonic() - 1) is None
+
+    monkeypatch.setattr(ConfigBase, "CONVERT_MAX_PAGE_DPI", 1000)
+    assert _convert_image(result.product, "png", 100, "all") is None
+    assert _convert_image(result.product, "png", 100, [1, 10]).endswith("temp.zip")
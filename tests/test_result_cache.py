@@ -0,0 +1,104 @@
+import os
+import time
+import pytest
+import tempfile
+
+from latex.services.result_cache import ResultCache, manifest_digest
+
+
+class CacheFixture:
+    def __init__(self, temp_path):
+        self.cache_dir = os.path.join(temp_path, "cache")
+        self.source_dir = os.path.join(temp_path, "source")
+        self.template_dir = os.path.join(temp_path, "templates")
+        self.output_dir = os.path.join(temp_path, "output")
+        for path in (self.source_dir, self.template_dir, self.output_dir):
+            os.makedirs(path)
+
+
+@pytest.fixture(scope="function")
+def cache_fixture() -> CacheFixture:
+    with tempfile.TemporaryDirectory() as temp_path:
+        yield CacheFixture(temp_path)
+
+
+def write_file(path: str, content: str):
+    with open(path, "w") as handle:
+        handle.write(content)
+
+
+def make_product(folder: str, name: str, size: int):
+    product = os.path.join(folder, name + ".pdf")
+    log = os.path.join(folder, name + ".log")
+    write_file(product, "x" * size)
+    write_file(log, "log for " + name)
+    return product, log
+
+
+def test_digest_is_stable():
+    files = {"a.tex": {"path": "a.tex", "digest": "1" * 64}}
+    templates = {"t1": {"target": "t1", "digest": "2" * 64}}
+    args = ("xelatex", "a.tex", None, files, templates)
+    assert manifest_digest(*args) == manifest_digest(*args)
+
+
+def test_digest_changes_with_settings():
+    manifests = ({"a.tex": {"path": "a.tex", "digest": "1" * 64}}, {})
+    digests = {manifest_digest("xelatex", "a.tex", None, *manifests),
+               manifest_digest("pdflatex", "a.tex", None, *manifests),
+               manifest_digest("xelatex", "b.tex", None, *manifests),
+               manifest_digest("xelatex", "a.tex", {"format": "png", "dpi": 300}, *manifests)}
+    assert len(digests) == 4
+
+
+def test_manifest_digest_depends_on_file_digests():
+    files = {"a.tex": {"path": "a.tex", "digest": "1" * 64}}
+    templates = {"t.tex": {"target": "t.tex", "digest": "2" * 64}}
+    first = manifest_digest("xelatex", "a.tex", None, files, templates)
+    assert manifest_digest("xelatex", "a.tex", None, dict(files), dict(templates)) == first
+
+    changed = {"a.tex": {"path": "a.tex", "digest": "3" * 64}}
+    assert manifest_digest("xelatex", "a.tex", None, changed, templates) != first
+    assert manifest_digest("xelatex", "a.tex", None, templates, files) != first
+
+
+def test_manifest_digest_depends_on_fail_fast():
+    files = {"a.tex": {"path": "a.tex", "digest": "1" * 64}}
+    # A document with errors may still produce a product, which mustn't be handed to a fail-fast session
+    assert manifest_digest("xelatex", "a.tex", None, files, {}) != \
+        manifest_digest("xelatex", "a.tex", None, files, {}, fail_fast=True)
+
+
+def test_fetch_miss_returns_none(cache_fixture: CacheFixture):
+    cache = ResultCache(cache_fixture.cache_dir, 1024 * 1024)
+    assert cache.fetch("0" * 64, cache_fixture.output_dir, "session") is None
+
+
+def test_store_then_fetch(cache_fixture: CacheFixture):
+    cache = ResultCache(cache_fixture.cache_dir, 1024 * 1024)
+    product, log = make_product(cache_fixture.source_dir, "original", 100)
+    cache.store("a" * 64, product, log)
+
+    cached = cache.fetch("a" * 64, cache_fixture.output_dir, "session")
+
+    assert cached.product == os.path.join(cache_fixture.output_dir, "session.pdf")
+    assert cached.log == os.path.join(cache_fixture.output_dir, "session.log")
+    with open(cached.product, "r") as handle:
+        assert handle.read() == "x" * 100
+    with open(cached.log, "r") as handle:
+        assert handle.read() == "log for original"
+
+
+def test_eviction_removes_least_recently_used(cache_fixture: CacheFixture):
+    cache = ResultCache(cache_fixture.cache_dir, 2500)
+    for i, digest in enumerate(("a" * 64, "b" * 64)):
+        cache.store(digest, *make_product(cache_fixture.source_dir, f"p{i}", 1000))
+        os.utime(os.path.join(cache_fixture.cache_dir, digest), (time.time() - 100 + i, time.time() - 100 + i))
+
+    # Reading the older entry makes the other one the least recently used
+    assert cache.fetch("a" * 64, cache_fixture.output_dir, "session") is not None
+    cache.store("c" * 64, *make_product(cache_fixture.source_dir, "p2", 1000))
+
+    assert cache.fetch("b" * 64, cache_fixture.output_dir, "session") is None
+    assert cache.fetch("a" * 64, cache_fixture.output_dir, "session") is not None
+    assert cache.fetch("c" * 64, cache_fixture.output_dir, "session") is not None
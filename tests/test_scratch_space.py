@@ -0,0 +1,93 @@
+import os
+import errno
+import pytest
+import tempfile
+
+from latex.services.scratch_space import ScratchSpace, tree_size
+
+
+class ScratchFixture:
+    def __init__(self, temp_path):
+        self.scratch_dir = os.path.join(temp_path, "scratch")
+        self.source_dir = os.path.join(temp_path, "source")
+        self.session_dir = os.path.join(temp_path, "session")
+        os.makedirs(os.path.join(self.source_dir, "images"))
+        os.makedirs(self.session_dir)
+        write_file(os.path.join(self.source_dir, "doc.tex"), "document")
+        write_file(os.path.join(self.source_dir, "images", "figure.png"), "x" * 1000)
+
+
+@pytest.fixture(scope="function")
+def scratch_fixture() -> ScratchFixture:
+    with tempfile.TemporaryDirectory() as temp_path:
+        yield ScratchFixture(temp_path)
+
+
+def write_file(path: str, content: str):
+    with open(path, "w") as handle:
+        handle.write(content)
+
+
+def test_tree_size(scratch_fixture: ScratchFixture):
+    assert tree_size(scratch_fixture.source_dir) == 1008
+
+
+def test_stage_copies_source_tree(scratch_fixture: ScratchFixture):
+    scratch = ScratchSpace(scratch_fixture.scratch_dir, 64 * 1024 * 1024)
+    staged = scratch.stage("session", scratch_fixture.source_dir)
+
+    assert staged.startswith(scratch_fixture.scratch_dir)
+    with open(os.path.join(staged, "images", "figure.png"), "r") as handle:
+        assert handle.read() == "x" * 1000
+
+
+def test_stage_refuses_tree_over_ceiling(scratch_fixture: ScratchFixture):
+    scratch = ScratchSpace(scratch_fixture.scratch_dir, 1024 * 1024)
+    assert scratch.stage("session", scratch_fixture.source_dir) is None
+    assert os.listdir(scratch_fixture.scratch_dir) == []
+
+
+def test_retrieve_copies_file_back(scratch_fixture: ScratchFixture):
+    scratch = ScratchSpace(scratch_fixture.scratch_dir, 64 * 1024 * 1024)
+    staged = scratch.stage("session", scratch_fixture.source_dir)
+    write_file(os.path.join(staged, "session.pdf"), "product")
+
+    retrieved = scratch.retrieve(os.path.join(staged, "session.pdf"), scratch_fixture.session_dir)
+
+    assert retrieved == os.path.join(scratch_fixture.session_dir, "session.pdf")
+    with open(retrieved, "r") as handle:
+        assert handle.read() == "product"
+    assert scratch.retrieve(os.path.join(staged, "missing.pdf"), scratch_fixture.session_dir) is None
+
+
+def test_release_removes_staged_tree(scratch_fixture: ScratchFixture):
+    scratch = ScratchSpace(scratch_fixture.scratch_dir, 64 * 1024 * 1024)
+    staged = scratch.stage("session", scratch_fixture.source_dir)
+    scratch.release(staged)
+    assert os.listdir(scratch_fixture.scratch_dir) == []
+
+
+def test_stage_reserves_room_for_output(scratch_fixture: ScratchFixture):
+    scratch = ScratchSpace(scratch_fixture.scratch_dir, 40 * 1024 * 1024)
+    first = scratch.stage("first", scratch_fixture.source_dir)
+    assert scratch.output_room(first) == 16 * 1024 * 1024
+
+    # The small trees leave the directory nearly empty, but the room reserved for their output is counted
+    second = scratch.stage("second", scratch_fixture.source_dir)
+    assert second is not None
+    assert scratch.stage("third", scratch_fixture.source_dir) is None
+
+    scratch.release(first)
+    assert scratch.stage("third", scratch_fixture.source_dir) is not None
+
+
+def test_out_of_room_found_in_log(scratch_fixture: ScratchFixture):
+    scratch = ScratchSpace(scratch_fixture.scratch_dir, 64 * 1024 * 1024)
+    staged = scratch.stage("session", scratch_fixture.source_dir)
+    log = os.path.join(staged, "session.log")
+    write_file(log, "! I can't write on file `session.pdf'.\n")
+    assert not scratch.out_of_room(log)
+    assert not scratch.out_of_room(None)
+
+    write_file(log, f"!pdfTeX error: pdflatex: {os.strerror(errno.ENOSPC)}\n")
+    assert scratch.out_of_room(log)
@@ -1,14 +1,24 @@
+import io
 import os
+import json
+import shutil
 import tempfile
 import re
+import time
 import uuid
+import itertools
+import threading
 import hashlib
 import pytest
 import redis
 
 from latex.config import TestConfig
-from latex.session import Session, SessionManager, to_key, clear_expired_sessions
+from latex.session import Session, SessionManager, to_key, expiry_key, status_key, blobs_key, rows_key, \
+    clear_expired_sessions, ALL_STATUSES, EDITABLE_TEXT, FINALIZED_TEXT, SUCCESS_TEXT, \
+    ERROR_TEXT
 from latex.services.time_service import TimeService, TestClock
+from latex.services.callbacks import callbacks_key
+from latex.services.product_store import product_store_keys
 
 redis_url_pattern = re.compile(r"redis:\/\/:(\S*)@(\S+):(\d+)\/(\d+)")
 
@@ -79,6 +89,12 @@ def fixture() -> TestFixture:
 
         element_key = to_key(element.decode())
         client.delete(element_key)
+    client.delete(expiry_key(instance_key))
+    client.delete(blobs_key(instance_key))
+    client.delete(callbacks_key(instance_key))
+    client.delete(*product_store_keys(instance_key))
+    for status in ALL_STATUSES:
+        client.delete(status_key(instance_key, status))
 
 
 def test_redis_connection_writeable(fixture):
@@ -114,6 +130,113 @@ def test_session_saves_to_redis(fixture: TestFixture):
     assert original.created == 12345
 
 
+def test_session_saves_only_given_fields(fixture: TestFixture):
+    """ Tests that saving a session with field names writes only those fields to its redis hash """
+    session = fixture.manager.create_session("pdflatex", "latextest.tex")
+    session.target = "changed.tex"
+    session.finalize()
+
+    stored = fixture.client.hgetall(to_key(session.key))
+    assert json.loads(stored[b"status"]) == FINALIZED_TEXT
+    assert json.loads(stored[b"target"]) == "latextest.tex"
+
+
+def test_session_load_fields(fixture: TestFixture):
+    """ Tests that individual fields of a session can be read without loading the whole session """
+    session = fixture.manager.create_session("pdflatex", "latextest.tex")
+    fields = fixture.manager.load_fields(session.key, "status", "compiler")
+    assert fields == {"status": EDITABLE_TEXT, "compiler": "pdflatex"}
+    assert fixture.manager.load_fields("notasession", "status") is None
+
+
+def test_wait_for_result(fixture: TestFixture):
+    session = fixture.manager.create_session("xelatex", "sample1.tex")
+    session.finalize()
+    assert fixture.manager.wait_for_result(session.key, 0.1) == FINALIZED_TEXT
+
+    session.set_complete("sample1.pdf", "sample1.log")
+    assert fixture.manager.wait_for_result(session.key, 10) == SUCCESS_TEXT
+    assert fixture.manager.wait_for_result("not-a-session", 10) is None
+
+
+def test_wait_for_result_woken_by_status_change(fixture: TestFixture):
+    """ Tests that a waiting caller learns of a status change when it is published, well before the status would be
+    read again from the record """
+    session = fixture.manager.create_session("xelatex", "sample1.tex")
+    session.finalize()
+    threading.Timer(0.2, session.set_complete, ("sample1.pdf", "sample1.log")).start()
+
+    start = time.monotonic()
+    assert fixture.manager.wait_for_result(session.key, 30) == SUCCESS_TEXT
+    assert time.monotonic() - start < 2
+
+
+def test_wait_for_result_woken_by_delete(fixture: TestFixture):
+    session = fixture.manager.create_session("xelatex", "sample1.tex")
+    session.finalize()
+    threading.Timer(0.2, fixture.manager.delete_session, (session,)).start()
+
+    start = time.monotonic()
+    assert fixture.manager.wait_for_result(session.key, 30) is None
+    assert time.monotonic() - start < 2
+
+
+def test_status_changes_heartbeat(fixture: TestFixture):
+    session = fixture.manager.create_session("xelatex", "sample1.tex")
+    changes = fixture.manager.status_changes(session.key, 30, heartbeat=0.1)
+    assert list(itertools.islice(changes, 3)) == [EDITABLE_TEXT] * 3
+
+    session.finalize()
+    session.set_errored("sample1.log")
+    assert list(changes) == [FINALIZED_TEXT, ERROR_TEXT]
+
+
+def test_completed_session_queues_callback(fixture: TestFixture):
+    """ Tests that the notification of a session's callback is queued when the session is compiled, holding the final
+    session document with absolute links under the external url, and that sessions without a callback queue nothing """
+    fixture.manager.external_url = "https://latex.example.com/"
+    session = fixture.manager.create_session("xelatex", "sample1.tex", callback="http://example.com/hook")
+    plain = fixture.manager.create_session("xelatex", "sample1.tex")
+    fixture.clock.set_time(500)
+    for s in (session, plain):
+        s.finalize()
+    assert fixture.client.zcard(callbacks_key(fixture.instance)) == 0
+
+    for s in (session, plain):
+        s.set_errored("sample1.log")
+
+    [(member, due)] = fixture.client.zrange(callbacks_key(fixture.instance), 0, -1, withscores=True)
+    notification = json.loads(member)
+    assert due == 500
+    assert notification["url"] == "http://example.com/hook"
+    assert notification["document"]["key"] == session.key
+    assert notification["document"]["status"] == "error"
+    session_url = f"https://latex.example.com/api/sessions/{session.key}"
+    assert notification["document"]["log"] == {"href": f"{session_url}/log"}
+    assert notification["document"]["events"] == {"href": f"{session_url}/events"}
+    assert notification["document"]["finalize"]["href"] == session_url
+
+
+def test_session_directories_created_with_session(fixture: TestFixture):
+    """ Tests that creating a session makes its source and template directories """
+    session = fixture.manager.create_session("pdflatex", "latextest.tex")
+    session_path = os.path.join(fixture.manager.working_directory, session.key)
+    assert os.path.isdir(os.path.join(session_path, "source"))
+    assert os.path.isdir(os.path.join(session_path, "templates"))
+
+
+def test_session_load_does_not_touch_disk(fixture: TestFixture):
+    """ Tests that loading a session doesn't create file services or directories until its files are used """
+    original = fixture.manager.create_session("pdflatex", "latextest.tex")
+    session_path = os.path.join(fixture.manager.working_directory, original.key)
+    shutil.rmtree(session_path)
+
+    loaded = fixture.manager.load_session(original.key)
+    assert loaded.status == EDITABLE_TEXT
+    assert loaded._root_files is None
+    assert not os.path.exists(session_path)
+
+
 def test_session_saved_added_to_instance_list(fixture: TestFixture):
     """ Tests that when a session is created, the instance list of sessions now contains
     the new session. Verify that this works with multiple sessions. """
@@ -154,12 +277,52 @@ def test_session_deleted_is_gone_from_redis_and_disk(fixture: TestFixture):
     original = fixture.manager.create_session("xelatex", "sample1.tex")
 
     session = fixture.manager.load_session(original.key)
+    session_path = session._file_service.root_path
     fixture.manager.delete_session(session)
 
     reloaded = fixture.manager.load_session(original.key)
 
     assert reloaded is None
-    assert not os.path.exists(session._file_service.root_path)
+    assert not os.path.exists(session_path)
+
+
+def test_failed_upload_leaves_no_file(fixture: TestFixture):
+    """ Tests that a file whose stream fails part of the way through is neither left on disk nor recorded """
+    class FailingStream:
+        def __init__(self):
+            self.reads = 0
+
+        def read(self, size):
+            self.reads += 1
+            if self.reads > 1:
+                raise ValueError("archive member is over the size limit")
+            return b"partial"
+
+    session = fixture.manager.create_session("xelatex", "sample1.tex")
+    with pytest.raises(ValueError):
+        session.add_files([("good.tex", io.BytesIO(b"good")), ("bad.tex", FailingStream())])
+
+    assert not os.path.exists(os.path.join(session.source_files.root_path, "bad.tex"))
+    assert fixture.manager.load_session(session.key).files == ["good.tex"]
+
+
+def test_batch_session_rows(fixture: TestFixture):
+    """ Tests that the data rows of a batch session are stored and read back in order, and that the result of each row
+    is recorded and counted without rewriting the session """
+    session = fixture.manager.create_session("xelatex", "cert.tex")
+    session.add_rows([{"name": "Ada"}, {"name": "Grace"}])
+    assert session.add_rows([{"name": "Edsger"}]) == 3
+    assert session.read_rows(1, 3) == [{"name": "Grace"}, {"name": "Edsger"}]
+
+    fixture.manager.record_row_result(session, 0, {"success": True, "passes": 1})
+    fixture.manager.record_row_result(session, 2, {"success": False, "passes": 2})
+    reloaded = fixture.manager.load_session(session.key)
+    assert reloaded.public["rows"] == {"total": 3, "success": 1, "error": 1, "output": "zip"}
+    assert fixture.manager.load_row_results(session.key) == {0: {"success": True, "passes": 1},
+                                                             2: {"success": False, "passes": 2}}
+
+    fixture.manager.delete_session(session)
+    assert not fixture.client.exists(rows_key(session.key))
 
 
 def test_session_deleted_is_gone_from_instance_list(fixture: TestFixture):
@@ -212,3 +375,105 @@ def test_clear_expired_sessions_clears_expired(fixture: TestFixture):
         else:
             assert loaded is not None
             assert loaded.key == s.key
+
+
+def test_session_record_has_ttl(fixture: TestFixture):
+    """ Tests that session records carry a redis TTL matching the session lifetime """
+    session = fixture.manager.create_session("xelatex", "sample1.tex")
+    ttl = fixture.client.ttl(to_key(session.key))
+    assert 0 < ttl <= fixture.manager.session_ttl
+
+
+def test_session_indexed_by_expiration(fixture: TestFixture):
+    """ Tests that created sessions are added to the expiration index and removed from it on deletion """
+    fixture.clock.set_time(100)
+    session = fixture.manager.create_session("xelatex", "sample1.tex")
+    assert fixture.client.zscore(expiry_key(fixture.instance), session.key) == session.expires_at
+
+    fixture.manager.delete_session(session)
+    assert fixture.client.zscore(expiry_key(fixture.instance), session.key) is None
+
+
+def test_clear_expired_sessions_in_batches(fixture: TestFixture, monkeypatch):
+    """ Tests that more expired sessions than fit in one batch are all cleared """
+    monkeypatch.setattr("latex.session.EXPIRY_BATCH_SIZE", 2)
+    sessions = [fixture.manager.create_session("xelatex", "sample1.tex") for _ in range(5)]
+    fixture.clock.set_time(fixture.clock.now + fixture.manager.session_ttl + 1.0)
+
+    clear_expired_sessions(fixture.manager.working_directory,
+                           fixture.manager.instance_key,
+                           time_service=fixture.time_service)
+    for s in sessions:
+        assert fixture.manager.load_session(s.key) is None
+        assert not os.path.exists(os.path.join(fixture.manager.working_directory, s.key))
+    assert fixture.client.zcard(expiry_key(fixture.instance)) == 0
+
+
+def test_clear_expired_sessions_with_missing_record(fixture: TestFixture):
+    """ Tests that an expired session whose redis record has already gone is still cleared from disk """
+    session = fixture.manager.create_session("xelatex", "sample1.tex")
+    fixture.client.delete(to_key(session.key))
+    fixture.clock.set_time(fixture.clock.now + fixture.manager.session_ttl + 1.0)
+
+    clear_expired_sessions(fixture.manager.working_directory,
+                           fixture.manager.instance_key,
+                           time_service=fixture.time_service)
+    assert not os.path.exists(os.path.join(fixture.manager.working_directory, session.key))
+    assert not fixture.client.sismember(fixture.instance, session.key)
+
+
+def test_session_status_counts(fixture: TestFixture):
+    """ Tests that the per-status counts follow sessions through their status transitions and deletion """
+    sessions = [fixture.manager.create_session("xelatex", "sample1.tex") for _ in range(3)]
+    assert fixture.manager.status_counts()[EDITABLE_TEXT] == 3
+
+    sessions[0].finalize()
+    sessions[1].finalize()
+    sessions[1].set_complete("product.pdf", "product.log")
+    assert fixture.manager.status_counts() == {EDITABLE_TEXT: 1, FINALIZED_TEXT: 1, SUCCESS_TEXT: 1, "error": 0}
+
+    fixture.manager.delete_session(sessions[2])
+    assert fixture.manager.status_counts()[EDITABLE_TEXT] == 0
+
+
+def test_deleted_session_not_saved_again(fixture: TestFixture):
+    """ Tests that a worker finishing a session which was deleted in the meantime doesn't bring its record back, count
+    it in a status or queue its callback """
+    session = fixture.manager.create_session("xelatex", "sample1.tex", callback="http://example.com/done")
+    session.finalize()
+    fixture.manager.delete_session(session)
+
+    session.set_complete("product.pdf", "product.log")
+    assert not fixture.client.exists(to_key(session.key))
+    assert sum(fixture.manager.status_counts().values()) == 0
+    assert fixture.client.zcard(callbacks_key(fixture.instance)) == 0
+
+
+def test_oldest_finalized_session(fixture: TestFixture):
+    """ Tests that the time the longest waiting session was finalized is reported """
+    assert fixture.manager.oldest_in_status(FINALIZED_TEXT) is None
+    for t in (100, 200):
+        fixture.clock.set_time(t)
+        fixture.manager.create_session("xelatex", "sample1.tex").finalize()
+    assert fixture.manager.oldest_in_status(FINALIZED_TEXT) == 100
+
+
+def test_deleted_session_releases_blobs(fixture: TestFixture):
+    """ Tests that blobs left unused by a deleted session are kept until the retention period passes, while blobs
+    still used by another session are not removed """
+    first = fixture.manager.create_session("xelatex", "sample1.tex")
+    shared = first.add_file("shared.sty", io.BytesIO(b"shared"))
+    only = first.add_file("only.sty", io.BytesIO(b"only"))
+    second = fixture.manager.create_session("xelatex", "sample1.tex")
+    assert second.link_files([("shared.sty", shared["digest"])]) == []
+
+    fixture.clock.set_time(1000)
+    fixture.manager.delete_session(first)
+    assert fixture.client.zscore(blobs_key(fixture.instance), only["digest"]) == 1000
+    assert fixture.client.zscore(blobs_key(fixture.instance), shared["digest"]) is None
+
+    fixture.manager.sweep_blobs(999)
+    assert fixture.manager.blob_store.has(only["digest"])
+    fixture.manager.sweep_blobs(1000)
+    assert not fixture.manager.blob_store.has(only["digest"])
+    assert fixture.manager.blob_store.has(shared["digest"])
@@ -0,0 +1,102 @@
+import os
+import uuid
+
+import jinja2
+import redis
+
+from latex.config import TestConfig
+from latex.services.template_cache import TemplateCache, TemplateBytecodeCache, read_template_stats, \
+    sweep_template_bytecode, template_stats_key
+
+
+class CountingEnvironment(jinja2.Environment):
+    """ An environment which counts how many template texts it has compiled to Python """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.compiled = 0
+
+    def compile(self, *args, **kwargs):
+        self.compiled += 1
+        return super().compile(*args, **kwargs)
+
+
+def test_repeat_template_compiled_once():
+    environment = CountingEnvironment()
+    cache = TemplateCache(environment, 10)
+
+    assert cache.render("Hello {{ name }}", {"name": "world"}) == "Hello world"
+    assert cache.render("Hello {{ name }}", {"name": "again"}) == "Hello again"
+
+    assert environment.compiled == 1
+
+
+def test_least_recently_used_template_dropped():
+    environment = CountingEnvironment()
+    cache = TemplateCache(environment, 2)
+
+    first = cache.get("first")
+    cache.get("second")
+    assert cache.get("first") is first
+    cache.get("third")
+
+    # The second template was the least recently used when the third was added
+    assert cache.get("first") is first
+    cache.get("second")
+    assert environment.compiled == 4
+
+
+def test_template_loaded_from_bytecode_cache(tmp_path):
+    first = CountingEnvironment(bytecode_cache=jinja2.FileSystemBytecodeCache(str(tmp_path)))
+    TemplateCache(first, 10).get("{{ a + b }}")
+
+    # A second process starts with nothing in memory but finds the compiled code in the shared directory
+    second = CountingEnvironment(bytecode_cache=jinja2.FileSystemBytecodeCache(str(tmp_path)))
+    cache = TemplateCache(second, 10)
+    assert cache.render("{{ a + b }}", {"a": 1, "b": 2}) == "3"
+    assert second.compiled == 0
+
+
+def test_stats_flushed_to_redis(tmp_path):
+    client = redis.from_url(TestConfig.REDIS_URL)
+    key = template_stats_key(str(uuid.uuid4()).replace("-", "")[:10])
+    cache = TemplateCache(CountingEnvironment(bytecode_cache=jinja2.FileSystemBytecodeCache(str(tmp_path))), 10)
+    try:
+        cache.render("{{ x }}", {"x": 1})
+        cache.render("{{ x }}", {"x": 2})
+        cache.flush_stats(client, key)
+        cache.flush_stats(client, key)
+
+        stats = read_template_stats(client, key)
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["bytecode_hits"] == 0
+        assert stats["renders"] == 2
+        assert stats["mean_render_ms"] >= 0
+    finally:
+        client.delete(key)
+
+
+def test_stats_empty_before_any_render():
+    client = redis.from_url(TestConfig.REDIS_URL)
+    stats = read_template_stats(client, template_stats_key("unused"))
+    assert stats["renders"] == 0
+    assert stats["mean_render_ms"] is None
+
+
+def test_bytecode_swept_least_recently_used_first(tmp_path):
+    bytecode_cache = TemplateBytecodeCache(str(tmp_path))
+    first = TemplateCache(CountingEnvironment(bytecode_cache=bytecode_cache), 10)
+    for number in range(3):
+        first.get(f"Template {number} {{{{ name }}}}")
+    paths = {os.path.join(tmp_path, name) for name in os.listdir(tmp_path)}
+    for path in paths:
+        os.utime(path, (1000, 1000))
+    size = os.path.getsize(next(iter(paths)))
+
+    # Loading a template's bytecode in another worker marks it as used, so it is the one kept
+    second = TemplateCache(CountingEnvironment(bytecode_cache=bytecode_cache), 10)
+    second.get("Template 1 {{ name }}")
+    sweep_template_bytecode(str(tmp_path), size)
+
+    [kept] = os.listdir(tmp_path)
+    assert os.stat(os.path.join(tmp_path, kept)).st_mtime > 1000
@@ -0,0 +1,54 @@
+import uuid
+
+import pytest
+import redis
+
+from latex.config import TestConfig
+from latex.services.template_library import TemplateLibrary, library_key, validate_template_name
+
+
+@pytest.fixture(scope="function")
+def library() -> TemplateLibrary:
+    client = redis.from_url(TestConfig.REDIS_URL)
+    instance = str(uuid.uuid4()).replace("-", "")[:10]
+    yield TemplateLibrary(client, instance)
+    client.delete(library_key(instance))
+
+
+def test_register_keeps_first_version(library: TemplateLibrary):
+    entry, created = library.register("letter", "1", "Dear \\EXPR{name}", 100)
+    assert created
+    assert entry["id"] == "letter@1"
+
+    again, created = library.register("letter", "1", "Changed", 200)
+    assert not created
+    assert again == entry
+    assert library.body("letter@1")["text"] == "Dear \\EXPR{name}"
+
+
+def test_entries_listed_without_text(library: TemplateLibrary):
+    library.register("letter", "2", "two", 100)
+    library.register("letter", "1", "one", 100)
+
+    assert [e["id"] for e in library.entries()] == ["letter@1", "letter@2"]
+    assert all("text" not in e for e in library.entries())
+
+
+def test_text_checks_digest(library: TemplateLibrary):
+    entry, _ = library.register("letter", "1", "one", 100)
+    assert library.text("letter@1", entry["digest"]) == "one"
+
+    # A template removed and registered again with different text is not the one the session was given
+    library.remove("letter@1")
+    with pytest.raises(ValueError):
+        library.text("letter@1", entry["digest"])
+    library.register("letter", "1", "other", 200)
+    with pytest.raises(ValueError):
+        library.text("letter@1", entry["digest"])
+
+
+def test_template_names_validated():
+    assert validate_template_name("letter-2.1_a", "name") == "letter-2.1_a"
+    for value in ("", "a/b", "a@b", "a" * 101, 1, None):
+        with pytest.raises(ValueError):
+            validate_template_name(value, "name")
@@ -0,0 +1,84 @@
+import os
+import pytest
+import tempfile
+
+from latex.texlog import iter_log_lines, scan_log, MAX_PRINT_LINE
+
+
+@pytest.fixture(scope="function")
+def log_path() -> str:
+    with tempfile.TemporaryDirectory() as temp_path:
+        yield os.path.join(temp_path, "test.log")
+
+
+def write_log(path: str, lines):
+    with open(path, "w") as handle:
+        handle.write("\n".join(lines) + "\n")
+
+
+def test_iter_log_lines_rejoins_wrapped_lines(log_path):
+    first = "a" * MAX_PRINT_LINE
+    write_log(log_path, [first, "continued", "next line"])
+    assert list(iter_log_lines(log_path)) == [first + "continued", "next line"]
+
+
+def test_iter_log_lines_tolerates_invalid_utf8(log_path):
+    with open(log_path, "wb") as handle:
+        handle.write(b"before \xff\xfe after\n")
+    lines = list(iter_log_lines(log_path))
+    assert len(lines) == 1
+    assert lines[0].startswith("before")
+
+
+def test_scan_log_file_line_error(log_path):
+    write_log(log_path, ["(./doc.tex",
+                         "./doc.tex:12: Undefined control sequence.",
+                         "l.12 \\foo",
+                         ")"])
+    summary = scan_log(log_path)
+    assert summary.error_count == 1
+    assert summary.errors[0] == {"file": "./doc.tex", "line": 12, "message": "Undefined control sequence."}
+
+
+def test_scan_log_classic_error_uses_file_stack_and_context_line(log_path):
+    write_log(log_path, ["This is pdfTeX (preloaded format=pdflatex)",
+                         "(./doc.tex (/usr/share/texmf/tex/latex/base/article.cls",
+                         "Document Class: article (standard LaTeX document class)",
+                         ") (./chapter.tex",
+                         "! Missing $ inserted.",
+                         "<inserted text> ",
+                         "                $",
+                         "l.7 x^",
+                         "      2",
+                         "))"])
+    summary = scan_log(log_path)
+    assert summary.errors == [{"file": "./chapter.tex", "line": 7, "message": "Missing $ inserted."}]
+
+
+def test_scan_log_warnings(log_path):
+    write_log(log_path, ["(./doc.tex",
+                         "LaTeX Warning: Reference `fig:one' on page 1 undefined on input line 22.",
+                         "",
+                         "Package natbib Warning: Citation `knuth' on page 1 undefined on input line",
+                         "(natbib)                30.",
+                         ")"])
+    summary = scan_log(log_path)
+    assert summary.warning_count == 2
+    assert summary.warnings[0] == {"file": "./doc.tex", "line": 22,
+                                   "message": "Reference `fig:one' on page 1 undefined on input line 22."}
+    assert summary.warnings[1]["line"] == 30
+    assert summary.warnings[1]["message"] == "Citation `knuth' on page 1 undefined on input line 30."
+
+
+def test_scan_log_limits_items_but_counts_all(log_path):
+    write_log(log_path, [f"./doc.tex:{i}: Undefined control sequence." for i in range(1, 11)])
+    summary = scan_log(log_path, max_items=3)
+    assert summary.error_count == 10
+    assert len(summary.errors) == 3
+
+
+def test_scan_log_reports_rerun(log_path):
+    write_log(log_path, ["LaTeX Warning: Label(s) may have changed. Rerun to get cross-references right."])
+    summary = scan_log(log_path)
+    assert summary.rerun
+    assert summary.warning_count == 1